@@ -9,12 +9,16 @@ Author: Amir Zeldes
 
 import cgitb
 import cgi
+import datetime
 import errno
+import time
 from os.path import isfile, join
 from os import listdir
 import _version
 from modules.logintools import login, createuser
 from modules.rstweb_sql import *
+from modules.rstweb_export import export_corpus
+from modules.rstweb_templates import get_help_section, render_template
 from modules.configobj import ConfigObj
 from modules.pathutils import *
 
@@ -44,10 +48,6 @@ def admin_main(user, admin, mode, **kwargs):
 
 	config = ConfigObj(userdir + 'config.ini')
 	templatedir = scriptpath + config['controltemplates'].replace("/",os.sep)
-	template = "main_header.html"
-	header = readfile(templatedir+template)
-	header = header.replace("**page_title**","Administration")
-	header = header.replace("**user**",user)
 
 	importdir = scriptpath + config['importdir'].replace("/",os.sep)
 	def_relfile = scriptpath + config['default_rels'].replace("/",os.sep)
@@ -55,10 +55,10 @@ def admin_main(user, admin, mode, **kwargs):
 	cpout = ""
 	if mode == "server":
 		cpout += "Content-Type: text/html\n\n\n"
-		header = header.replace("**logout_control**",'(<a href="logout.py">log out</a>)')
+		logout_control = '(<a href="logout.py">log out</a>)'
 	else:
-		header = header.replace("**logout_control**",'')
-	cpout += header
+		logout_control = ''
+	cpout += render_template(templatedir+"main_header.html",page_title="Administration",user=user,logout_control=logout_control)
 
 	if "current_doc" in theform:
 		current_doc = theform["current_doc"]
@@ -67,45 +67,32 @@ def admin_main(user, admin, mode, **kwargs):
 		current_doc = ""
 		current_project = ""
 
-	edit_bar = "edit_bar.html"
-	edit_bar = readfile(templatedir+edit_bar)
-	edit_bar = edit_bar.replace("**doc**",current_doc)
-	edit_bar = edit_bar.replace("**project**",current_project)
-	edit_bar = edit_bar.replace("**structure_disabled**",'')
-	edit_bar = edit_bar.replace("**segment_disabled**",'')
-	edit_bar = edit_bar.replace("**relations_disabled**",'')
-	edit_bar = edit_bar.replace("**submit_target**",'admin.py')
-	edit_bar = edit_bar.replace("**action_type**",'')
-	edit_bar = edit_bar.replace("**serve_mode**",mode)
-	edit_bar = edit_bar.replace("**open_disabled**",'')
-	edit_bar = edit_bar.replace("**reset_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**quickexp_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**screenshot_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**save_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**undo_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**redo_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**admin_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace('id="nav_admin" class="nav_button"','id="nav_admin" class="nav_button nav_button_inset"')
-
-
 	if admin == "0":
 		cpout += '<p class="warn">User '+ user+' does not have administrator rights!</p></body></html>'
 		return cpout
-	else:
-		edit_bar = edit_bar.replace("**admin_disabled**",'')
 
+	edit_bar = render_template(templatedir+"edit_bar.html",
+		doc=current_doc,
+		project=current_project,
+		structure_disabled='',
+		segment_disabled='',
+		relations_disabled='',
+		submit_target='admin.py',
+		action_type='',
+		serve_mode=mode,
+		open_disabled='',
+		reset_disabled='disabled="disabled"',
+		quickexp_disabled='disabled="disabled"',
+		screenshot_disabled='disabled="disabled"',
+		save_disabled='disabled="disabled"',
+		undo_disabled='disabled="disabled"',
+		redo_disabled='disabled="disabled"',
+		admin_disabled='disabled="disabled"')
+	edit_bar = edit_bar.replace('id="nav_admin" class="nav_button"','id="nav_admin" class="nav_button nav_button_inset"')
 	cpout += edit_bar
 
-	help = "help.html"
-	help = readfile(templatedir+help)
-	help_match = re.search(r'(<div id="help_admin".*?</div>)',help,re.MULTILINE|re.DOTALL)
-	help = help_match.group(1)
-	cpout += help
-
-	about = "about.html"
-	about = readfile(templatedir+about)
-	about = about.replace("**version**", _version.__version__)
-	cpout += about
+	cpout += get_help_section(templatedir+"help.html","help_admin")
+	cpout += render_template(templatedir+"about.html",version=_version.__version__)
 
 	if "wipe" in theform:
 		if theform["wipe"] =="wipe":
@@ -340,6 +327,7 @@ def admin_main(user, admin, mode, **kwargs):
 	'''
 
 	fail = 0
+	import_stats = {}
 	if "file" in theform and "imp_project" in theform:
 		fileitem = theform['file']
 		imp_project = theform["imp_project"]
@@ -353,13 +341,13 @@ def admin_main(user, admin, mode, **kwargs):
 					open(importdir + fn, 'wb').write(filelist_item.file.read())
 					message += 'The file "' + fn + '" was uploaded successfully<br/>'
 					if theform['import_file_type'] == "rs3":
-						fail = import_document(importdir + fn,imp_project,user,do_tokenize=do_tokenize)
+						fail = import_document(importdir + fn,imp_project,user,do_tokenize=do_tokenize,stats=import_stats)
 					elif theform['import_file_type'] == "plain":
 						if len(def_relfile) > 0:
 							rel_hash = read_relfile(def_relfile)
 						else:
 							rel_hash = {}
-						fail = import_plaintext(importdir + fn,imp_project,user,rel_hash,do_tokenize=do_tokenize)
+						fail = import_plaintext(importdir + fn,imp_project,user,rel_hash,do_tokenize=do_tokenize,stats=import_stats)
 				else:
 					message = 'No file was uploaded'
 		else:
@@ -369,18 +357,20 @@ def admin_main(user, admin, mode, **kwargs):
 				open(importdir + fn, 'wb').write(fileitem.file.read())
 				message = 'The file "' + fn + '" was uploaded successfully'
 				if theform['import_file_type'] == "rs3":
-					fail = import_document(importdir + fn,imp_project,user,do_tokenize=do_tokenize)
+					fail = import_document(importdir + fn,imp_project,user,do_tokenize=do_tokenize,stats=import_stats)
 				elif theform['import_file_type'] == "plain":
 					if len(def_relfile) > 0:
 						rel_hash = read_relfile(def_relfile)
 					else:
 						rel_hash = {}
-					fail = import_plaintext(importdir + fn,imp_project,user,rel_hash,do_tokenize=do_tokenize)
+					fail = import_plaintext(importdir + fn,imp_project,user,rel_hash,do_tokenize=do_tokenize,stats=import_stats)
 			else:
 				message = 'No file was uploaded'
 
 		if isinstance(fail,basestring):
 			message = fail
+		elif "rows" in import_stats:
+			message += '<br/>Imported %d rows in %.2f seconds (%d rows/sec)' % (import_stats["rows"], import_stats["seconds"], import_stats["rows_per_sec"])
 		cpout += """
 		<p class="warn">%s</p>
 		""" % (message,)
@@ -422,6 +412,8 @@ def admin_main(user, admin, mode, **kwargs):
 	cpout += '''
 	<p>Export selected document(s) to export folder as .rs3 file(s):</p>
 	<button onclick="admin('export');">Export</button>
+	<p>Export all annotated versions of the selected document(s) to a ZIP file in the export folder:</p>
+	<button onclick="admin('export_zip');">Export ZIP</button>
 	<p>Delete selected document(s):</p>
 	<button onclick="admin('delete_doc');">Delete</button>
 	'''
@@ -435,6 +427,13 @@ def admin_main(user, admin, mode, **kwargs):
 			else:
 				export_document(export_docs.split("/")[1],export_docs.split("/")[0],exportdir)
 			cpout += '<p class="warn">Export complete</p>'
+		elif len(export_doc_list) > 0 and theform["export"]== "zip":
+			export_docs = [(doc.split("/")[1],doc.split("/")[0]) for doc in export_doc_list.split(";")]
+			zip_name = "rstweb_export_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + ".zip"
+			start = time.time()
+			# Render in this thread: admin pages run in server threads, from which worker processes may not be forked
+			exported = export_corpus(exportdir + zip_name, docs=export_docs, processes=1)
+			cpout += '<p class="warn">Exported %d document versions to %s in %.1f seconds</p>' % (exported, zip_name, time.time() - start)
 
 
 	# Handle user add and delete before showing user list
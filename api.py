@@ -16,15 +16,18 @@ import io
 import json
 import os
 from tempfile import mkdtemp, NamedTemporaryFile
-import time
 
 
 import cherrypy  # pylint: disable=import-error
-from selenium import webdriver
-from selenium.common.exceptions import WebDriverException
 
 from modules import rstweb_sql
+from modules.rstweb_artifacts import get_artifact, get_artifact_key, iter_artifact
+from modules.rstweb_browser import SCREENSHOT_TIMEOUT, take_screenshot
+from modules.rstweb_export import iter_corpus_zip, parse_since
+from modules.rstweb_jobs import delete_job, get_job, start_job
 from modules.rstweb_sql import generic_query as sql
+from modules.rstweb_svg import RENDERER_VERSION, can_render_png, draw_tree_svg, get_tree_png, get_tree_svg, svg_to_png
+from modules.rstweb_tree import parse_nodes
 from quick_export import quickexp_main
 
 
@@ -40,11 +43,22 @@ def get_all_docs(user, project):
 def get_png(file_name, project_name, user, mode='local'):
     """Returns the png image of the given rs3 file as a string of bytes.
 
+    The image is drawn on the server if cairosvg is installed. Otherwise,
+    it is a screenshot taken in a headless browser.
+    """
+    if can_render_png():
+        return get_tree_png(file_name, project_name, user)
+    return get_browser_png(file_name, project_name, user, mode=mode)
+
+
+def get_browser_png(file_name, project_name, user, mode='local'):
+    """Returns a screenshot of the given rs3 file as a string of bytes.
+
     It is generated by a Javascript function in the rstWeb frontend.
     Thus, we need to use a headless browser (Selenium plus Firefox with
-    geckodriver) to download the file.
+    geckodriver), taken from a pool of running browsers.
     """
-    download_dir = mkdtemp()
+    from selenium.common.exceptions import TimeoutException  # pylint: disable=import-error
 
     # We need to set the host name and port of the request to _this_ running
     # instance of CherryPy. Otherwise, the host name / port of the originating
@@ -52,79 +66,117 @@ def get_png(file_name, project_name, user, mode='local'):
     # docker-compose setup).
     cherrypy_host, cherrypy_port = cherrypy.server.bound_addr
     path = '/structure' if mode == 'local' else '/structure.py'
-    params = '?current_doc={0}&current_project={1}'.format(file_name, project_name)
+    # Screenshots show the whole tree, also of documents the editor renders in windows
+    params = '?current_doc={0}&current_project={1}&full_tree=1'.format(file_name, project_name)
     request_url = 'http://{0}:{1}{2}{3}'.format(cherrypy_host, cherrypy_port, path, params)
 
     redirect = cherrypy.HTTPRedirect(request_url)
     screenshot_url = redirect.urls[0]
 
-    # use headless (i.e. invisible) browser
-    opts = webdriver.firefox.options.Options()
-    opts.add_argument('--headless')
-
-    # this prevents the download dialog to pop up
-    profile = webdriver.FirefoxProfile()
-    profile.set_preference('browser.download.folderList', 2)  # custom location
-    profile.set_preference('browser.download.manager.showWhenStarting', False)
-    profile.set_preference('browser.download.dir', download_dir)
-    profile.set_preference('browser.helperApps.neverAsk.saveToDisk', 'image/png')
-
-    driver = webdriver.Firefox(options=opts, firefox_profile=profile)
-    driver.get(screenshot_url)
+    try:
+        return take_screenshot(screenshot_url)
+    except TimeoutException:
+        raise cherrypy.HTTPError(
+            408, ("Could not generate RST image of {0} within {1} seconds.".format(
+                file_name, SCREENSHOT_TIMEOUT)))
 
-    screenshot_button = driver.find_element_by_id('nav_screenshot')
-    screenshot_button.click()
 
-    doc_name = file_name.split('.')[0]
-    screenshot_filepath = os.path.join(download_dir, doc_name + '.png')
+def get_image(file_name, project_name, user, output_format='png'):
+    """Returns an image of the rhetorical structure tree of a document as bytes,
+    either as a `png` or as an `svg` image. Images are cached until the document
+    changes (see modules/rstweb_artifacts.py).
+    """
+    if output_format == 'svg':
+        renderer = 'svg-' + RENDERER_VERSION
 
-    # file download might not be finished, yet
-    retries = 30
-    error_msg = "Could not generate RST image {0} within {1} seconds.".format(
-        screenshot_filepath, retries)
-    while retries > 0:
-        if os.path.isfile(screenshot_filepath):
-            with open(screenshot_filepath, 'rb') as screenshot_file:
-                return screenshot_file.read()
-        retries -= 1
-        time.sleep(1)
+        def render():
+            return get_tree_svg(file_name, project_name, user).encode('utf-8')
+    else:
+        # screenshots and images drawn on the server look different
+        renderer = 'png-' + RENDERER_VERSION if can_render_png() else 'png-browser'
 
-    raise cherrypy.HTTPError(
-            408, ("Could not generate RST image {0} within {1} seconds.".format(screenshot_filepath, retries)))
+        def render():
+            return get_png(file_name, project_name, user=user, mode='local')
+    key = get_artifact_key(renderer, file_name, project_name, user)
+    return get_artifact(key, output_format, render)
 
 
 def get_screenshot(file_name, project_name, user, output_format='png'):
     """Produces a screenshot of the rhetorical structure tree of a document from
-    the given user in the given project and returns it.
+    the given user in the given project and returns it (see `send_image`).
+    """
+    if output_format == 'svg':
+        image = get_image(file_name, project_name, user, output_format='svg')
+    elif output_format in ('png', 'png-base64'):
+        image = get_image(file_name, project_name, user, output_format='png')
+    else:
+        raise cherrypy.HTTPError(
+            400, ("Unknown screenshot format '{0}'. Supported formats: "
+                  "png, png-base64, svg.").format(output_format))
+    return send_image(image, file_name, output_format)
+
+
+def send_image(image, file_name, output_format):
+    """Returns an image of a document (given as bytes) with the headers of its format.
 
     If `output_format` is `png`, return the image as a download (which will trigger
     the "save file" dialog on the client side.
     If `output_format` is `png-base64`, return a base64-encoded string of the png
     image.
+    If `output_format` is `svg`, return the tree as an SVG image.
     """
-    png_bytes = get_png(file_name, project_name, user=user, mode='local')
-
-    if output_format == 'png':
+    if output_format == 'svg':
+        cherrypy.response.headers['Content-Type'] = "image/svg+xml"
+        return image
+    elif output_format == 'png':
         cherrypy.response.headers['Content-Type'] = "application/download"
         cherrypy.response.headers['Content-Disposition'] = \
             'attachment; filename="{0}.png"'.format(file_name)
-        return png_bytes
-    elif output_format == 'png-base64':
-        cherrypy.response.headers['Content-Type'] = "data:image/png;base64"
-        return base64.b64encode(png_bytes)
-    else:
+        return image
+    cherrypy.response.headers['Content-Type'] = "data:image/png;base64"
+    return base64.b64encode(image)
+
+
+def convert_image(rs3_text, file_name, output_format='png'):
+    """Draws the rhetorical structure tree of the contents of an .rs3 file
+    without storing the document and returns it (see `send_image`).
+    """
+    try:
+        parsed = parse_nodes(rs3_text)
+    except (IOError, KeyError, ValueError) as err:  # broken references between nodes or signals
+        parsed = str(err)
+    if not isinstance(parsed, tuple):
         raise cherrypy.HTTPError(
-            400, ("Unknown screenshot format '{0}'. Supported formats: "
-                  "png, png-base64.").format(output_format))
+            400, "Cannot read input file. Reason: '{0}'".format(parsed))
+    nodes, rel_types = parsed
+    if output_format == 'svg':
+        image = draw_tree_svg(nodes, rel_types).encode('utf-8')
+    else:
+        image = svg_to_png(draw_tree_svg(nodes, rel_types, scale=2))
+    return send_image(image, file_name, output_format)
+
+
+def read_upload(upload):
+    """Returns the content of an uploaded file or form field as a unicode string."""
+    content = upload if isinstance(upload, basestring) else upload.file.read()
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return content
 
 
 def get_rs3_file(file_name, project_name, user):
-    """Returns a .rs3 file as a download."""
-    kwargs = {'quickexp_doc': file_name, 'quickexp_project': project_name}
+    """Returns a .rs3 file as a download, as a generator of encoded chunks."""
     cherrypy.response.headers['Content-Type'] = "application/download"
     cherrypy.response.headers['Content-Disposition'] = \
         'attachment; filename="{0}"'.format(file_name)
-    return quickexp_main(user=user, admin='3', mode='local', **kwargs)
+    return iter_rs3_file(file_name, project_name, user)
+
+
+def iter_rs3_file(file_name, project_name, user):
+    """Generates the encoded chunks of a .rs3 file, which is cached until the document changes."""
+    kwargs = {'quickexp_doc': file_name, 'quickexp_project': project_name}
+    key = get_artifact_key('rs3', file_name, project_name, user)
+    return iter_artifact(key, 'rs3', quickexp_main(user=user, admin='3', mode='local', **kwargs))
 
 
 def edit_document(file_name, project_name):
@@ -294,7 +346,7 @@ class APIController(object):
     @cherrypy.expose
     def get_document(self, project_name, file_name, output='rs3'):
         """Handler for /documents/{project_name}/{file_name} (GET).
-        Returns a document either as an `rs3` file, a `png` image of an RST tree,
+        Returns a document either as an `rs3` file, a `png` or `svg` image of an RST tree,
         a base64-encoded png image or opens it in the structure editor.
         """
         # only proceed if the project and file exist (for the user 'local')
@@ -310,6 +362,8 @@ class APIController(object):
             return get_screenshot(file_name, project_name, 'local', output_format='png')
         elif output == 'png-base64':
             return get_screenshot(file_name, project_name, 'local', output_format='png-base64')
+        elif output == 'svg':
+            return get_screenshot(file_name, project_name, 'local', output_format='svg')
         elif output == 'editor':
             # This will raise a cherrypy.HTTPRedirect to rstWeb's Structure Editor
             # opened with the given document.
@@ -318,6 +372,36 @@ class APIController(object):
             raise cherrypy.HTTPError(
                 400, 'Unknown output format: {0}'.format(output))
 
+    # .rs3 files are sent while they are generated by the exporter
+    get_document._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def export_corpus(self, project_name=None, user=None, modified_since=None):  # pylint: disable=no-self-use
+        """Handler for /export (GET).
+        Returns a ZIP archive with the .rs3 files of all annotated document
+        versions, optionally only those of one project and/or user and those
+        modified since a date (YYYY-MM-DD) or Unix time.
+
+        Usage example:
+
+            curl "http://localhost:8080/api/export?project_name=myproject&modified_since=2020-01-31" > corpus.zip
+        """
+        projects = None if project_name is None else [project_name]
+        users = None if user is None else [user]
+        try:
+            since = None if modified_since is None else parse_since(modified_since)
+        except ValueError:
+            raise cherrypy.HTTPError(
+                400, 'Invalid modified_since value: {0}'.format(modified_since))
+        cherrypy.response.headers['Content-Type'] = 'application/zip'
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="rstweb_export.zip"'
+        # Render in this thread: forking worker processes from a server thread can deadlock the children on
+        # locks held by other threads, and would start a pool of processes per concurrent request
+        return iter_corpus_zip(projects=projects, users=users, modified_since=since, processes=1)
+
+    # The archive is sent while the documents are being rendered
+    export_corpus._cp_config = {'response.stream': True}
+
     @cherrypy.expose
     def add_document(self, project_name, file_name, rs3_file):
         """Handler for /documents/{project_name}/{file_name} (POST)
@@ -402,11 +486,135 @@ class APIController(object):
                 500, "Cannot delete document '{0}' from project '{1}' ".format(
                     file_name, project_name))
 
+    @cherrypy.tools.json_out()
+    def start_render_job(self, project_name, file_name=None, output_format='png'):
+        """Handler for /jobs/render (POST).
+        Starts rendering images of all documents of a project (of the user 'local'),
+        or of the given documents in it, in the background. Returns the job
+        status (see `get_render_job`), whose `id` identifies the job.
+
+        Parameters
+        ----------
+        project_name : str
+            project of the documents
+        file_name : str or list of str
+            documents to render (can be repeated); all documents of the project by default
+        output_format : str
+            format of the images, `png` or `svg`
+
+        Usage example:
+
+            curl -XPOST "http://localhost:8080/api/jobs/render?project_name=myproject&output_format=png"
+        """
+        if output_format not in ('png', 'svg'):
+            raise cherrypy.HTTPError(
+                400, "Unknown output format: '{0}'".format(output_format))
+        documents = get_all_docs('local', project_name)
+        if file_name is not None:
+            file_names = file_name if isinstance(file_name, list) else [file_name]
+            missing = [name for name in file_names if name not in documents]
+            if missing:
+                raise cherrypy.HTTPError(
+                    404, "Files not available in project '{0}': {1}".format(project_name, missing))
+            documents = file_names
+        elif project_name not in self.get_projects():
+            raise cherrypy.HTTPError(404, "Unknown project: '{0}'".format(project_name))
+
+        def render(doc, project):
+            return get_image(doc, project, 'local', output_format=output_format)
+
+        job = start_job([(project_name, doc) for doc in documents], output_format, render)
+        cherrypy.response.status = 202
+        cherrypy.response.headers['Location'] = '{0}/jobs/{1}'.format(cherrypy.request.script_name, job.id)
+        return job.get_status()
+
+    @cherrypy.tools.json_out()
+    def warm_artifact_cache(self, project_name, output_format='rs3,png'):
+        """Handler for /cache/{project_name} (POST).
+        Starts filling the cache of .rs3 files and images with all documents of
+        a project (of the user 'local') in the background, so that they are
+        served without rendering later. Returns the status of the job
+        (see `get_render_job`).
+
+        Parameters
+        ----------
+        project_name : str
+            project of the documents
+        output_format : str
+            comma separated formats to cache: `rs3`, `png` and `svg`
+
+        Usage example:
+
+            curl -XPOST -d "" "http://localhost:8080/api/cache/myproject?output_format=rs3,svg"
+        """
+        formats = output_format.split(',')
+        unknown = [fmt for fmt in formats if fmt not in ('rs3', 'png', 'svg')]
+        if unknown:
+            raise cherrypy.HTTPError(
+                400, "Unknown output formats: {0}".format(unknown))
+        if project_name not in self.get_projects():
+            raise cherrypy.HTTPError(404, "Unknown project: '{0}'".format(project_name))
+
+        def warm(doc, project):
+            for fmt in formats:
+                if fmt == 'rs3':
+                    for chunk in iter_rs3_file(doc, project, 'local'):
+                        pass
+                else:
+                    get_image(doc, project, 'local', output_format=fmt)
+
+        documents = get_all_docs('local', project_name)
+        job = start_job([(project_name, doc) for doc in documents], output_format, warm)
+        cherrypy.response.status = 202
+        cherrypy.response.headers['Location'] = '{0}/jobs/{1}'.format(cherrypy.request.script_name, job.id)
+        return job.get_status()
+
+    @cherrypy.tools.json_out()
+    def get_render_job(self, job_id):  # pylint: disable=no-self-use
+        """Handler for /jobs/{job_id} (GET).
+        Returns the progress of a render job (`status` is `running` or `finished`,
+        with counts of `done` and `failed` documents) and the `status` of each
+        document (`pending`, `done` or `failed`, with an `error`).
+        """
+        job = get_job(job_id)
+        if job is None:
+            raise cherrypy.HTTPError(404, "Unknown job: '{0}'".format(job_id))
+        return job.get_status()
+
+    @cherrypy.expose
+    def get_render_job_output(self, job_id):  # pylint: disable=no-self-use
+        """Handler for /jobs/{job_id}/output (GET).
+        Returns a ZIP archive of the images a render job has finished so far.
+
+        Usage example:
+
+            curl "http://localhost:8080/api/jobs/0123456789abcdef0123456789abcdef/output" > images.zip
+        """
+        job = get_job(job_id)
+        if job is None:
+            raise cherrypy.HTTPError(404, "Unknown job: '{0}'".format(job_id))
+        cherrypy.response.headers['Content-Type'] = 'application/zip'
+        cherrypy.response.headers['Content-Disposition'] = \
+            'attachment; filename="rstweb_{0}.zip"'.format(job.output)
+        return job.iter_zip()
+
+    get_render_job_output._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def delete_render_job(self, job_id):  # pylint: disable=no-self-use
+        """Handler for /jobs/{job_id} (DELETE).
+        Stops a render job and deletes its images.
+        """
+        if not delete_job(job_id):
+            raise cherrypy.HTTPError(404, "Unknown job: '{0}'".format(job_id))
+
     @cherrypy.expose
     def convert_file(self, input_file, input_format='rs3', output_format='png'):
         """Handler for /convert (POST).
         Converts an RST document into another format without (permanently)
-        storing it in the database.
+        storing it in the database. Images are drawn without storing the
+        document at all, unless png images need a browser to take screenshots
+        (see `get_png`) or the output is the editor.
 
         Parameters
         ----------
@@ -425,7 +633,12 @@ class APIController(object):
         """
         error = None
 
-        if input_format == 'rs3':
+        if input_format == 'rs3' and (output_format == 'svg' or
+                                      output_format in ('png', 'png-base64') and can_render_png()):
+            # draw the tree straight from the uploaded file, without importing it
+            file_name = getattr(input_file, 'filename', None) or 'converted.rs3'
+            return convert_image(read_upload(input_file), file_name, output_format)
+        elif input_format == 'rs3':
             # create temp file, fill it with POSTed file content, import into db,
             # remove temp file.
             temp_file = NamedTemporaryFile(suffix='.rs3', dir=self.import_dir, delete=False)
@@ -447,7 +660,7 @@ class APIController(object):
                         input_filepath, error))
 
             # convert to given output format
-            if output_format in ('png', 'png-base64'):
+            if output_format in ('png', 'png-base64', 'svg'):
                 response = self.get_document(TEMP_PROJECT, input_filename, output_format)
             elif output_format == 'editor':
                 # This will raise a cherrypy.HTTPRedirect to rstWeb's Structure Editor
@@ -586,6 +799,48 @@ def create_api_dispatcher():
                        controller=APIController(),
                        conditions={'method': ['DELETE']})
 
+    # /export (GET)
+    dispatcher.connect(name='export',
+                       route='/export',
+                       action='export_corpus',
+                       controller=APIController(),
+                       conditions={'method': ['GET']})
+
+    # /cache/{project_name} (POST)
+    dispatcher.connect(name='cache',
+                       route='/cache/{project_name}',
+                       action='warm_artifact_cache',
+                       controller=APIController(),
+                       conditions={'method': ['POST']})
+
+    # /jobs/render (POST)
+    dispatcher.connect(name='jobs',
+                       route='/jobs/render',
+                       action='start_render_job',
+                       controller=APIController(),
+                       conditions={'method': ['POST']})
+
+    # /jobs/{job_id} (GET)
+    dispatcher.connect(name='jobs',
+                       route='/jobs/{job_id}',
+                       action='get_render_job',
+                       controller=APIController(),
+                       conditions={'method': ['GET']})
+
+    # /jobs/{job_id} (DELETE)
+    dispatcher.connect(name='jobs',
+                       route='/jobs/{job_id}',
+                       action='delete_render_job',
+                       controller=APIController(),
+                       conditions={'method': ['DELETE']})
+
+    # /jobs/{job_id}/output (GET)
+    dispatcher.connect(name='jobs',
+                       route='/jobs/{job_id}/output',
+                       action='get_render_job_output',
+                       controller=APIController(),
+                       conditions={'method': ['GET']})
+
     # /convert (POST)
     dispatcher.connect(name='documents',
                        route='/convert',
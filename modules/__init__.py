@@ -29,6 +29,7 @@ from .dateutils import *
 
 from .rstweb_classes import *
 from .rstweb_sql import *
+from .rstweb_session import *
 from .rstweb_reader import *
 
 
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Disk cache of files derived from documents, such as .rs3 exports and images of RST trees. Files are named by a
+hash of the document version (see VERSION_TRIGGERS in rstweb_sql.py), so that any change to a document's nodes or
+signals makes its old files unused, and of the renderer and rstWeb versions that made them. The folder is kept
+below artifact_cache_size megabytes by deleting the least recently used files (see config.ini).
+Author: Amir Zeldes
+"""
+
+import os
+import threading
+
+import _version
+from modules import rstweb_sql
+from modules.configobj import ConfigObj
+from modules.rstweb_cache import get_digest, get_root_dir
+from modules.rstweb_sql import get_doc_version, get_relation_catalog
+
+ARTIFACT_CACHE_SIZE = 256  # Megabytes of files kept, unless artifact_cache_size is set in config.ini
+EVICTION_TARGET = 0.9  # Eviction frees space down to this share of the size bound, so that it runs rarely
+
+_artifact_cache = None
+_artifact_cache_lock = threading.Lock()
+
+
+class ArtifactCache:
+	def __init__(self, cache_dir, max_bytes):
+		"""Files by key in cache_dir, using at most max_bytes; safe for threads and for processes sharing cache_dir"""
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		self.size = sum(size for path, size, used in self.list_files())
+
+	def get_path(self, key, extension):
+		return os.path.join(self.cache_dir, get_digest(key) + "." + extension)
+
+	def get(self, key, extension):
+		"""Returns the bytes stored for key, or None"""
+		path = self.get_path(key, extension)
+		try:
+			with open(path, "rb") as f:
+				data = f.read()
+			os.utime(path, None)  # The modification time records the last use
+		except (IOError, OSError):  # Missing, or evicted by another process meanwhile
+			return None
+		return data
+
+	def put(self, key, extension, data):
+		path = self.get_path(key, extension)
+		# Write to a temporary file first, so that other processes never read a partial file
+		temp_path = path + "." + str(os.getpid()) + "." + str(threading.current_thread().ident)
+		with open(temp_path, "wb") as f:
+			f.write(data)
+		try:
+			replaced = os.path.getsize(path)  # Another request may have stored the same file meanwhile
+		except OSError:
+			replaced = 0
+		try:
+			os.rename(temp_path, path)
+		except OSError:  # On Windows, another process already stored the same file
+			os.remove(temp_path)
+			return
+		with self.lock:
+			self.size += len(data) - replaced
+			evict = self.size > self.max_bytes
+		if evict:
+			self.evict()
+
+	def list_files(self):
+		"""Returns (path, size, last use) for each stored file"""
+		files = []
+		for name in os.listdir(self.cache_dir):
+			if name.count(".") != 1:  # Temporary files being written
+				continue
+			path = os.path.join(self.cache_dir, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			files.append((path, stat.st_size, stat.st_mtime))
+		return files
+
+	def evict(self):
+		"""Deletes the least recently used files until the folder is below the eviction target"""
+		with self.lock:
+			files = sorted(self.list_files(), key=lambda file_info: file_info[2])
+			size = sum(file_info[1] for file_info in files)
+			for path, file_size, used in files:
+				if size <= self.max_bytes * EVICTION_TARGET:
+					break
+				try:
+					os.remove(path)
+				except OSError:  # Already evicted by another process
+					pass
+				size -= file_size
+			self.size = size
+
+
+def get_artifact_cache():
+	"""
+	Returns the process-wide artifact cache, configured by artifact_cache_dir and artifact_cache_size in config.ini,
+	or None if artifact_cache_dir is empty
+	"""
+	global _artifact_cache
+	with _artifact_cache_lock:
+		if _artifact_cache is None:
+			config = ConfigObj(rstweb_sql.CONFIG_PATH)
+			cache_dir = str(config.get("artifact_cache_dir", "")).strip()
+			if cache_dir == "":
+				_artifact_cache = False
+			else:
+				if not os.path.isabs(cache_dir):
+					cache_dir = os.path.join(get_root_dir(), cache_dir)
+				max_bytes = float(config.get("artifact_cache_size", ARTIFACT_CACHE_SIZE)) * 1024 * 1024
+				_artifact_cache = ArtifactCache(cache_dir, max_bytes)
+	return _artifact_cache or None
+
+
+def get_artifact_key(renderer, doc, project, user):
+	"""
+	Returns the cache key of the file a renderer makes from a document version and the relations declared for the
+	document, or None if there is no such document
+	"""
+	version = get_doc_version(doc, project, user)
+	if version is None:
+		return None
+	relations = get_digest(get_relation_catalog(doc, project).rels)  # Relation types are not part of the version
+	return [renderer, doc, project, user, version, relations, _version.__version__]
+
+
+def get_artifact(key, extension, render):
+	"""Returns the cached bytes for key, or makes them by calling render() and stores them"""
+	cache = get_artifact_cache()
+	if cache is None or key is None:
+		return render()
+	data = cache.get(key, extension)
+	if data is None:
+		data = render()
+		cache.put(key, extension, data)
+	return data
+
+
+def iter_artifact(key, extension, chunks):
+	"""
+	Yields the cached bytes for key if there are any, or else the chunks of bytes of the freshly made file, which is
+	stored once all chunks have been sent. Files are not stored if key is None or the chunks are not all sent.
+	"""
+	cache = get_artifact_cache()
+	if cache is None or key is None:
+		for chunk in chunks:
+			yield chunk
+		return
+	data = cache.get(key, extension)
+	if data is not None:
+		yield data
+		return
+	sent = []
+	for chunk in chunks:
+		sent.append(chunk)
+		yield chunk
+	cache.put(key, extension, b"".join(sent))
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Pool of headless Firefox browsers, used by the REST API to take screenshots of RST trees when they cannot be
+drawn on the server (see rstweb_svg.py). Browsers are started on demand up to browser_pool_size, reused for
+browser_max_uses screenshots and then replaced, and replaced early if they stop responding (see config.ini).
+Author: Amir Zeldes
+"""
+
+import atexit
+import base64
+import threading
+from contextlib import contextmanager
+
+from modules import rstweb_sql
+from modules.configobj import ConfigObj
+
+BROWSER_POOL_SIZE = 2  # Browsers kept running per server process, unless browser_pool_size is set in config.ini
+BROWSER_MAX_USES = 50  # Screenshots taken by a browser before it is replaced, unless browser_max_uses is set
+SCREENSHOT_TIMEOUT = 30  # Seconds to wait for a screenshot
+
+# Runs make_screenshot in nav.js and returns the data URL of the image to Selenium once it is ready
+SCREENSHOT_SCRIPT = "make_screenshot(arguments[arguments.length - 1]);"
+
+_browser_pool = None
+
+
+def start_firefox():
+	from selenium import webdriver  # pylint: disable=import-error
+	opts = webdriver.firefox.options.Options()
+	opts.add_argument('--headless')
+	driver = webdriver.Firefox(options=opts)
+	driver.set_script_timeout(SCREENSHOT_TIMEOUT)
+	return driver
+
+
+def is_responsive(driver):
+	try:
+		return driver.execute_script("return 1;") == 1
+	except Exception:  # Crashed browsers raise various WebDriverExceptions and connection errors
+		return False
+
+
+def quit_driver(driver):
+	try:
+		driver.quit()
+	except Exception:
+		pass
+
+
+class BrowserPool:
+	def __init__(self, max_size=BROWSER_POOL_SIZE, max_uses=BROWSER_MAX_USES, factory=start_firefox):
+		"""Thread safe pool of at most max_size WebDriver instances created by factory"""
+		self.max_size = max_size
+		self.max_uses = max_uses
+		self.factory = factory
+		self.idle = []  # (driver, uses) of browsers waiting for work, most recently used last
+		self.size = 0  # Browsers started and not yet quit, idle or in use
+		self.condition = threading.Condition()
+
+	def acquire(self):
+		"""Returns a responsive browser and the number of times it was used, waiting while all browsers are busy"""
+		while True:
+			with self.condition:
+				while not self.idle and self.size >= self.max_size:
+					self.condition.wait()
+				if self.idle:
+					driver, uses = self.idle.pop()
+				else:
+					driver = None
+					self.size += 1
+			if driver is None:
+				try:
+					return self.factory(), 0
+				except Exception:
+					self.forget()
+					raise
+			if is_responsive(driver):
+				return driver, uses
+			self.discard(driver)
+
+	def release(self, driver, uses, healthy=True):
+		"""Returns a browser to the pool after one more use, or quits it if it is worn out or failed"""
+		uses += 1
+		if healthy and uses < self.max_uses:
+			with self.condition:
+				self.idle.append((driver, uses))
+				self.condition.notify()
+		else:
+			self.discard(driver)
+
+	def discard(self, driver):
+		quit_driver(driver)
+		self.forget()
+
+	def forget(self):
+		with self.condition:
+			self.size -= 1
+			self.condition.notify()
+
+	@contextmanager
+	def browser(self):
+		"""Lends a browser for a with block; browsers are discarded if the block raises an exception"""
+		driver, uses = self.acquire()
+		try:
+			yield driver
+		except Exception:
+			self.release(driver, uses, healthy=False)
+			raise
+		self.release(driver, uses)
+
+	def close(self):
+		"""Quits all idle browsers"""
+		with self.condition:
+			idle = self.idle
+			self.idle = []
+		for driver, uses in idle:
+			self.discard(driver)
+
+
+def get_browser_pool():
+	"""Returns the process-wide browser pool, configured by browser_pool_size and browser_max_uses in config.ini"""
+	global _browser_pool
+	if _browser_pool is None:
+		config = ConfigObj(rstweb_sql.CONFIG_PATH)
+		_browser_pool = BrowserPool(int(config.get("browser_pool_size", BROWSER_POOL_SIZE)),
+									int(config.get("browser_max_uses", BROWSER_MAX_USES)))
+		atexit.register(_browser_pool.close)
+	return _browser_pool
+
+
+def take_screenshot(url):
+	"""Returns the png image of the RST tree on the structure editor page at url as bytes"""
+	with get_browser_pool().browser() as driver:
+		driver.get(url)
+		data_url = driver.execute_async_script(SCREENSHOT_SCRIPT)
+	return base64.b64decode(data_url.split(",", 1)[1])
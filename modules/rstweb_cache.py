@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Cache of rendered editor pages. Pages are keyed by the document version, which changes with every
+write to the document (see VERSION_TRIGGERS in rstweb_sql.py), and by everything else they depend on,
+such as settings, project validations and templates. Pages are kept in memory with least recently used
+eviction, and optionally as files in render_cache_dir (see config.ini), which survive restarts and are
+shared by CGI processes. The same key gives the ETag sent to browsers to revalidate pages.
+Author: Amir Zeldes
+"""
+
+import codecs
+import collections
+import hashlib
+import json
+import os
+import threading
+
+import _version
+from modules import rstweb_sql
+from modules.configobj import ConfigObj
+from modules.rstweb_sql import get_cached_settings, get_doc_version, get_guidelines_url, get_project_validations
+
+RENDER_CACHE_SIZE = 64  # Pages kept in memory per process, unless render_cache_size is set in config.ini
+
+# Form fields which make a request change the document or its log, so that its page is not cached
+WRITE_FIELDS = ["action", "seg_action", "reset", "logging"]
+# Form fields which change how a page is rendered, and so are part of its key
+PAGE_FIELDS = ["full_tree"]
+
+_render_cache = None
+_template_dir = None
+
+
+class RenderCache:
+	def __init__(self, max_entries=RENDER_CACHE_SIZE, cache_dir=None):
+		"""Thread safe LRU cache of pages by key, optionally backed by files in cache_dir"""
+		self.max_entries = max_entries
+		self.cache_dir = cache_dir
+		self.pages = collections.OrderedDict()
+		self.lock = threading.Lock()
+		if cache_dir is not None and not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+	def get(self, key):
+		"""Returns the page stored for key, or None"""
+		digest = get_digest(key)
+		with self.lock:
+			page = self.pages.pop(digest, None)
+			if page is not None:
+				self.pages[digest] = page  # Most recently used pages are last
+				return page
+		if self.cache_dir is not None:
+			path = os.path.join(self.cache_dir, digest + ".html")
+			if os.path.isfile(path):
+				with codecs.open(path, "r", "utf-8") as f:
+					page = f.read()
+				self.remember(digest, page)
+		return page
+
+	def put(self, key, page):
+		digest = get_digest(key)
+		self.remember(digest, page)
+		if self.cache_dir is not None:
+			# Write to a temporary file first, so that other processes never read a partial page
+			path = os.path.join(self.cache_dir, digest + ".html")
+			temp_path = path + "." + str(os.getpid()) + "." + str(threading.current_thread().ident)
+			with codecs.open(temp_path, "w", "utf-8") as f:
+				f.write(page)
+			try:
+				os.rename(temp_path, path)
+			except OSError:  # On Windows, another process already stored the same page
+				os.remove(temp_path)
+
+	def remember(self, digest, page):
+		with self.lock:
+			self.pages.pop(digest, None)
+			self.pages[digest] = page
+			while len(self.pages) > self.max_entries:
+				self.pages.popitem(last=False)
+
+	def clear(self):
+		with self.lock:
+			self.pages.clear()
+
+
+def get_render_cache():
+	"""Returns the process-wide page cache, configured by render_cache_size and render_cache_dir in config.ini"""
+	global _render_cache
+	if _render_cache is None:
+		config = ConfigObj(rstweb_sql.CONFIG_PATH)
+		cache_dir = str(config.get("render_cache_dir", "")).strip()
+		if cache_dir == "":
+			cache_dir = None
+		elif not os.path.isabs(cache_dir):
+			cache_dir = os.path.join(get_root_dir(), cache_dir)
+		_render_cache = RenderCache(int(config.get("render_cache_size", RENDER_CACHE_SIZE)), cache_dir)
+	return _render_cache
+
+
+def get_root_dir():
+	return os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def get_template_stamp():
+	"""Returns the names and modification times of the control templates, which pages are made from"""
+	global _template_dir
+	if _template_dir is None:
+		config = ConfigObj(rstweb_sql.CONFIG_PATH)
+		_template_dir = os.path.join(get_root_dir(), config["controltemplates"].replace("/", os.sep))
+	return sorted((name, os.path.getmtime(os.path.join(_template_dir, name))) for name in os.listdir(_template_dir))
+
+
+def get_settings_hash(project):
+	"""Hashes the settings, project configuration, config.ini, templates and rstWeb version a rendered page depends on"""
+	cached = get_cached_settings()
+	state = [cached["schema"], sorted(cached["settings"].items()), get_guidelines_url(project),
+			 get_project_validations(project), _version.__version__, get_template_stamp(),
+			 os.path.getmtime(rstweb_sql.CONFIG_PATH)]  # Options such as structure_window change pages
+	return hashlib.sha1(json.dumps(state).encode("utf-8")).hexdigest()
+
+
+def get_render_key(view, user, admin, mode, theform):
+	"""
+	Returns the cache key for the page of an editor view (structure or segment) requested with the form fields in
+	theform, or None if the request changes the document or does not show one, so that the page cannot be cached.
+	"""
+	if user == "demo" or "current_doc" not in theform or "current_project" not in theform:
+		return None
+	for field in WRITE_FIELDS:
+		if len(theform.get(field, "")) > 1:
+			return None
+	doc = theform["current_doc"]
+	project = theform["current_project"]
+	version = get_doc_version(doc, project, user)
+	if version is None:
+		return None
+	page_fields = [field for field in PAGE_FIELDS if field in theform]
+	return [view, doc, project, user, admin, mode, version, get_settings_hash(project)] + page_fields
+
+
+def iter_cached_page(key, chunks):
+	"""
+	Yields the cached page for key if there is one, or else the chunks of the freshly rendered page, which is
+	stored once all chunks have been sent. Pages are not cached if key is None or the chunks are not all sent.
+	"""
+	if key is None:
+		for chunk in chunks:
+			yield chunk
+		return
+	cache = get_render_cache()
+	page = cache.get(key)
+	if page is not None:
+		yield page
+		return
+	sent = []
+	for chunk in chunks:
+		sent.append(chunk)
+		yield chunk
+	cache.put(key, "".join(sent))
+
+
+def get_digest(key):
+	return hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def get_etag(key):
+	return '"' + get_digest(key) + '"'
+
+
+def etag_matches(etag, if_none_match):
+	"""Checks an ETag against the value of an If-None-Match request header"""
+	if if_none_match is None:
+		return False
+	for candidate in if_none_match.split(","):
+		candidate = candidate.strip()
+		if candidate.startswith("W/"):  # Weak comparison suffices for revalidation
+			candidate = candidate[2:]
+		if candidate == etag or candidate == "*":
+			return True
+	return False
+
+
+def send_cgi_etag(key):
+	"""
+	Prints the ETag header for a page in a CGI response. Returns True if the browser's copy is still valid,
+	in which case a complete 304 Not Modified response has been printed and the page need not be rendered.
+	"""
+	if key is None or os.environ.get("REQUEST_METHOD", "GET") != "GET":
+		return False
+	etag = get_etag(key)
+	if etag_matches(etag, os.environ.get("HTTP_IF_NONE_MATCH")):
+		print("Status: 304 Not Modified\nETag: " + etag + "\n")
+		return True
+	print("ETag: " + etag + "\nCache-Control: no-cache")
+	return False
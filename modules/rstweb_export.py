@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Corpus export: renders many document versions as .rs3 files in a pool of worker processes and writes
+them into a ZIP archive, which can be a file or a stream such as an HTTP download. Pools are only for the command
+line: the server exports with processes=1, since forking from a server thread can deadlock the children.
+Can also be run from the rstWeb folder, e.g.: python -m modules.rstweb_export --project myproject corpus.zip
+Author: Amir Zeldes
+"""
+
+import datetime
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+from modules import rstweb_sql
+from modules.rstweb_sql import get_doc_versions, get_export_string
+
+
+MIN_DOCS_PER_PROCESS = 20  # Smaller exports are rendered in the calling process, since starting workers costs more
+
+
+class ChunkBuffer:
+	def __init__(self):
+		"""Unseekable file object collecting what a ZipFile writes, so that the archive can be sent in chunks"""
+		self.chunks = []
+		self.position = 0
+
+	def write(self, data):
+		self.chunks.append(bytes(data))
+		self.position += len(data)
+		return len(data)
+
+	def tell(self):
+		return self.position
+
+	def flush(self):
+		pass
+
+	def drain(self):
+		data = b"".join(self.chunks)
+		self.chunks = []
+		return data
+
+
+def get_archive_name(doc, project, user):
+	# Same file names as the export folder written by rstweb_sql.export_document
+	return project + "_" + doc + "_" + user + ".rs3"
+
+
+def init_worker(db_path):
+	rstweb_sql.DB_PATH = db_path
+
+
+def render_version(version):
+	doc, project, user, modified = version
+	return version, get_export_string(doc, project, user).encode("utf-8")
+
+
+def iter_rendered(versions, processes=None):
+	"""Yields (version, rs3 bytes) for each version in order of completion, rendering in parallel if worthwhile"""
+	if processes is None:
+		processes = min(multiprocessing.cpu_count(), len(versions) // MIN_DOCS_PER_PROCESS)
+	if processes < 2:
+		for version in versions:
+			yield render_version(version)
+		return
+	pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(rstweb_sql.DB_PATH,))
+	try:
+		for result in pool.imap_unordered(render_version, versions, chunksize=4):
+			yield result
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def write_corpus(archive, versions, processes=None, progress=None):
+	"""
+	Writes the rs3 files of the given (doc, project, user, modified) versions into an open ZipFile, yielding after
+	each file. progress, if given, is called with the number of files written so far and the total.
+	"""
+	done = 0
+	for version, data in iter_rendered(versions, processes):
+		doc, project, user, modified = version
+		date_time = time.localtime(max(modified or time.time(), 315532800))[:6]  # ZIP dates start in 1980
+		info = zipfile.ZipInfo(get_archive_name(doc, project, user), date_time)
+		info.compress_type = zipfile.ZIP_DEFLATED
+		info.external_attr = 0o644 << 16
+		archive.writestr(info, data)
+		done += 1
+		if progress is not None:
+			progress(done, len(versions))
+		yield done
+
+
+def parse_since(value):
+	"""Converts a date (YYYY-MM-DD, local time) or a Unix time given as a string into a Unix time"""
+	try:
+		return float(value)
+	except ValueError:
+		return time.mktime(datetime.datetime.strptime(value, "%Y-%m-%d").timetuple())
+
+
+def select_versions(projects=None, users=None, modified_since=None, docs=None):
+	"""Returns the versions to export; docs optionally restricts them to a list of (doc, project) tuples"""
+	versions = get_doc_versions(projects=projects, users=users, modified_since=modified_since)
+	if docs is not None:
+		docs = set(docs)
+		versions = [version for version in versions if (version[0], version[1]) in docs]
+	return versions
+
+
+def export_corpus(target, projects=None, users=None, modified_since=None, docs=None, processes=None, progress=None):
+	"""
+	Exports the selected document versions to a ZIP archive at target, which is a file name or a writable file
+	object, and returns the number of files exported. See get_doc_versions for the selection arguments.
+	"""
+	versions = select_versions(projects, users, modified_since, docs)
+	archive = zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED)
+	try:
+		for done in write_corpus(archive, versions, processes, progress):
+			pass
+	finally:
+		archive.close()
+	return len(versions)
+
+
+def iter_corpus_zip(projects=None, users=None, modified_since=None, docs=None, processes=None, progress=None):
+	"""Generates the bytes of a ZIP archive of the selected document versions while they are being rendered"""
+	versions = select_versions(projects, users, modified_since, docs)
+	if sys.version_info[0] == 2:  # Python 2 can only write ZIP files to seekable files
+		with tempfile.TemporaryFile() as spool:
+			archive = zipfile.ZipFile(spool, "w", zipfile.ZIP_DEFLATED)
+			for done in write_corpus(archive, versions, processes, progress):
+				pass
+			archive.close()
+			spool.seek(0)
+			data = spool.read(65536)
+			while data:
+				yield data
+				data = spool.read(65536)
+		return
+	buf = ChunkBuffer()
+	archive = zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED)
+	for done in write_corpus(archive, versions, processes, progress):
+		yield buf.drain()
+	archive.close()
+	yield buf.drain()
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Export annotated rstWeb documents to a ZIP archive of .rs3 files")
+	parser.add_argument("target", help="ZIP file to write")
+	parser.add_argument("--project", action="append", help="only export this project (can be repeated)")
+	parser.add_argument("--user", action="append", help="only export this user's versions (can be repeated)")
+	parser.add_argument("--since", help="only export versions modified since this date (YYYY-MM-DD)")
+	parser.add_argument("--processes", type=int, default=None, help="number of worker processes (default: automatic)")
+	parser.add_argument("--db", default=rstweb_sql.DB_PATH, help="database file (default: rstweb.db)")
+	options = parser.parse_args()
+
+	rstweb_sql.DB_PATH = os.path.abspath(options.db)
+	since = None
+	if options.since is not None:
+		since = parse_since(options.since)
+
+	def report(done, total):
+		sys.stderr.write("\rExported %d of %d documents" % (done, total))
+
+	count = export_corpus(options.target, options.project, options.user, since, processes=options.processes, progress=report)
+	sys.stderr.write("\nWrote %d documents to %s\n" % (count, options.target))
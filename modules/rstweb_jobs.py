@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Background jobs rendering images of many documents for the REST API. Jobs run in a pool of worker threads
+(render_job_workers in config.ini), keep their images in a temporary folder until they are deleted or
+replaced by newer jobs, and report progress per document. Finished images can be downloaded as a ZIP archive.
+Author: Amir Zeldes
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+from modules import rstweb_sql
+from modules.configobj import ConfigObj
+from modules.rstweb_export import ChunkBuffer
+
+RENDER_JOB_WORKERS = 2  # Documents rendered at the same time, unless render_job_workers is set in config.ini
+MAX_FINISHED_JOBS = 20  # Finished jobs kept for download; the oldest are deleted first
+
+_jobs = {}  # Jobs by ID
+_jobs_lock = threading.Lock()
+_worker_pool = None
+
+
+class RenderJob:
+	def __init__(self, documents, output, render):
+		"""
+		Job rendering a list of (project, doc) tuples in the given output format (the file extension of the images),
+		by calling render(doc, project), which returns the image as bytes, or None if there is nothing to keep.
+		"""
+		self.id = uuid.uuid4().hex
+		self.output = output
+		self.render = render
+		self.created = time.time()
+		self.finished = None
+		self.folder = tempfile.mkdtemp(prefix="rstweb_job_")
+		self.documents = [{"project": project, "doc": doc, "status": "pending"} for project, doc in documents]
+		self.done = 0
+		self.failed = 0
+		self.lock = threading.Lock()
+
+	def render_document(self, index):
+		document = self.documents[index]
+		try:
+			data = self.render(document["doc"], document["project"])
+			if data is not None:
+				with open(os.path.join(self.folder, str(index)), "wb") as f:
+					f.write(data)
+			status, error = "done", None
+		except Exception as e:
+			status, error = "failed", str(e)
+		finally:
+			rstweb_sql.close_connection()  # Worker threads outlive jobs, and should not keep databases open
+		with self.lock:
+			document["status"] = status
+			if error is None:
+				self.done += 1
+			else:
+				document["error"] = error
+				self.failed += 1
+			if self.done + self.failed == len(self.documents):
+				self.finished = time.time()
+
+	def get_status(self):
+		"""Returns the progress of the job and the status of each document as a JSON serializable dictionary"""
+		with self.lock:
+			return {"id": self.id, "output": self.output, "status": "running" if self.finished is None else "finished",
+					"total": len(self.documents), "done": self.done, "failed": self.failed,
+					"documents": [dict(document) for document in self.documents]}
+
+	def get_archive_name(self, document):
+		return document["project"] + "_" + document["doc"] + "." + self.output
+
+	def write_zip(self, archive):
+		"""Writes the images rendered so far into an open ZipFile, yielding after each file"""
+		for index, document in enumerate(self.documents):
+			path = os.path.join(self.folder, str(index))
+			if document["status"] != "done" or not os.path.isfile(path):
+				continue
+			archive.write(path, self.get_archive_name(document))
+			yield index
+
+	def iter_zip(self):
+		"""Generates the bytes of a ZIP archive of the images rendered so far"""
+		if sys.version_info[0] == 2:  # Python 2 can only write ZIP files to seekable files
+			with tempfile.TemporaryFile() as spool:
+				archive = zipfile.ZipFile(spool, "w", zipfile.ZIP_DEFLATED)
+				for index in self.write_zip(archive):
+					pass
+				archive.close()
+				spool.seek(0)
+				data = spool.read(65536)
+				while data:
+					yield data
+					data = spool.read(65536)
+			return
+		buf = ChunkBuffer()
+		archive = zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED)
+		for index in self.write_zip(archive):
+			yield buf.drain()
+		archive.close()
+		yield buf.drain()
+
+	def remove(self):
+		shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def get_worker_pool():
+	"""Returns the process-wide pool of threads rendering job documents"""
+	global _worker_pool
+	if _worker_pool is None:
+		config = ConfigObj(rstweb_sql.CONFIG_PATH)
+		_worker_pool = ThreadPool(int(config.get("render_job_workers", RENDER_JOB_WORKERS)))
+	return _worker_pool
+
+
+def start_job(documents, output, render):
+	"""Creates a RenderJob and queues its documents for rendering; see RenderJob for the arguments"""
+	job = RenderJob(documents, output, render)
+	with _jobs_lock:
+		_jobs[job.id] = job
+		finished = sorted((old for old in _jobs.values() if old.finished is not None), key=lambda old: old.finished)
+		expired = finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]
+		for old in expired:
+			del _jobs[old.id]
+	for old in expired:
+		old.remove()
+	if len(job.documents) == 0:
+		job.finished = time.time()
+	pool = get_worker_pool()
+	for index in range(len(job.documents)):
+		pool.apply_async(job.render_document, (index,))
+	return job
+
+
+def get_job(job_id):
+	"""Returns the job with the given ID, or None"""
+	with _jobs_lock:
+		return _jobs.get(job_id)
+
+
+def delete_job(job_id):
+	"""Forgets a job and removes its images; documents still queued are skipped. Returns False for unknown jobs."""
+	with _jobs_lock:
+		job = _jobs.pop(job_id, None)
+	if job is None:
+		return False
+	job.render = cancelled
+	job.remove()
+	return True
+
+
+def cancelled(doc, project):
+	raise RuntimeError("The job was deleted")
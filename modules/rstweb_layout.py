@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Layout of RST trees: graphical depth and the span of EDUs covered by each node, computed for all
+nodes at once from an index of their children, without recursion. Used by the importer and by structure.py.
+Author: Amir Zeldes
+"""
+
+
+def get_tree_order(nodes):
+	"""
+	Returns the IDs of all nodes reachable from a root in top-down order (parents before children)
+	and a dictionary from each node ID to the IDs of its children.
+	"""
+	children = dict((node_id, []) for node_id in nodes)
+	roots = []
+	for node_id in sorted(nodes):
+		parent = nodes[node_id].parent
+		if parent == "0":
+			roots.append(node_id)
+		else:
+			children[nodes[parent].id].append(node_id)
+
+	order = []
+	stack = list(reversed(roots))
+	while stack:
+		node_id = stack.pop()
+		order.append(node_id)
+		stack.extend(reversed(children[node_id]))
+	return order, children
+
+
+def set_depths(nodes, order=None):
+	"""
+	Adds the graphical nesting depth of each node to its depth and sortdepth, as rstweb_classes.get_depth does.
+	Note that RST parentage without span/multinuc does NOT increase depth, but attaching to an EDU increases sortdepth.
+	"""
+	if order is None:
+		order = get_tree_order(nodes)[0]
+	above = {}  # Depth and sortdepth added by the path from each node to its root
+	for node_id in order:
+		node = nodes[node_id]
+		depth = sortdepth = 0
+		if node.parent != "0":
+			parent = nodes[node.parent]
+			depth, sortdepth = above[parent.id]
+			if parent.kind != "edu" and (node.relname == "span" or parent.kind == "multinuc" and node.relkind == "multinuc"):
+				depth += 1
+				sortdepth += 1
+			elif parent.kind == "edu":
+				sortdepth += 1
+		above[node_id] = (depth, sortdepth)
+	for node_id in order:
+		depth, sortdepth = above[node_id]
+		nodes[node_id].depth += depth
+		nodes[node_id].sortdepth += sortdepth
+
+
+def set_left_right(nodes, rel_hash, order=None, children=None):
+	"""
+	Sets the leftmost and rightmost EDU covered by each node, as calling rstweb_classes.get_left_right for every EDU does.
+	A node covers its span and multinuc children together with everything attached to them, including satellites.
+	"""
+	if order is None or children is None:
+		order, children = get_tree_order(nodes)
+	extent = {}  # Leftmost and rightmost EDU anywhere below each node, including the node itself
+	for node_id in reversed(order):
+		node = nodes[node_id]
+		min_left = node.left
+		max_right = node.right
+		for child_id in children[node_id]:
+			child_left, child_right = extent[child_id]
+			if child_left == 0:  # Nothing below the child has a position
+				continue
+			child = nodes[child_id]
+			if child.relname == "span" or (child.relname in rel_hash and node.kind == "multinuc" and rel_hash[child.relname] == "multinuc"):
+				if node.left > child_left or node.left == 0:
+					node.left = child_left
+				if node.right < child_right:
+					node.right = child_right
+			if min_left > child_left or min_left == 0:
+				min_left = child_left
+			if max_right < child_right:
+				max_right = child_right
+		extent[node_id] = (min_left, max_right)
+
+
+def layout_nodes(nodes, rel_hash):
+	"""Sets depth, sortdepth, left and right of all nodes in a dictionary of NODE objects"""
+	order, children = get_tree_order(nodes)
+	set_depths(nodes, order)
+	set_left_right(nodes, rel_hash, order, children)
+
+
+def get_multinuc_extents(nodes):
+	"""
+	Returns a dictionary from each multinuc ID to the leftmost and rightmost EDU covered by its multinuc children
+	(not including other rst children) and the IDs of the children at those edges.
+	"""
+	extents = {}
+	for node_id in nodes:
+		node = nodes[node_id]
+		if node.parent == "0" or node.relkind != "multinuc" or nodes[node.parent].kind != "multinuc":
+			continue
+		if node.parent not in extents:
+			extents[node.parent] = [node.left, node.right, node_id, node_id]
+			continue
+		extent = extents[node.parent]
+		if node.left < extent[0]:
+			extent[0], extent[2] = node.left, node_id
+		if node.right > extent[1]:
+			extent[1], extent[3] = node.right, node_id
+	return extents
+
+
+def get_anchors(nodes):
+	"""
+	Calculates where the line to each node's parent connects to it, once all nodes have been laid out.
+	Returns the proportional position of the anchor within the node's width and its horizontal pixel position.
+	"""
+	anchors = {}
+	multinuc_extents = get_multinuc_extents(nodes)
+
+	# First get proportional position for anchor; deeper nodes come first, so their anchors are known
+	for key in sorted(nodes, key = lambda id: nodes[id].depth, reverse=True):
+		node = nodes[key]
+		if node.kind=="edu":
+			anchors[node.id] = 0.5
+		if node.parent!="0":
+			parent = nodes[node.parent]
+			parent_wid = float((parent.right- parent.left+1) * 100 - 4)  # Spans are integers, divide as floats
+			child_wid = (node.right- node.left+1) * 100 - 4
+			if node.relname == "span":
+				if node.id in anchors:
+					anchors[parent.id] = ((node.left - parent.left)*100)/parent_wid+anchors[node.id]*(child_wid/parent_wid)
+				else:
+					anchors[parent.id] = ((node.left - parent.left)*100)/parent_wid+(0.5*child_wid)/parent_wid
+			elif node.relkind=="multinuc" and parent.kind =="multinuc":
+				# For multinucs, the anchor is in the middle between leftmost and rightmost of the multinuc children
+				lr_left, lr_right, left_child, right_child = multinuc_extents[parent.id]
+				if left_child == right_child:
+					anchors[parent.id] = 0.5
+				elif left_child in anchors and right_child in anchors: #both leftmost and rightmost multinuc children have been found
+					len_left = nodes[left_child].right-nodes[left_child].left+1
+					len_right = nodes[right_child].right-nodes[right_child].left+1
+					anchors[parent.id] = ((anchors[left_child] * len_left*100 + anchors[right_child] * len_right * 100 + (nodes[right_child].left - parent.left) * 100)/2)/parent_wid
+				else:
+					anchors[parent.id] = ((lr_left + lr_right) / 2.0 - parent.left+1) / float(parent.right - parent.left+1)
+			elif not parent.id in anchors:
+				anchors[parent.id] = 0.5
+
+	# Place anchor element to center on proportional position relative to parent
+	pix_anchors = {}
+	for key in nodes:
+		node = nodes[key]
+		pix_anchors[node.id] = int(3+node.left * 100 -100 - 39 + anchors[node.id]*((node.right- node.left+1) * 100 - 4))
+	return anchors, pix_anchors
@@ -12,14 +12,20 @@ import collections
 from xml.dom import minidom
 from xml.parsers.expat import ExpatError
 from modules.rstweb_classes import *
+from modules.rstweb_layout import set_left_right
 from modules.whitespace_tokenize import tokenize
 
 
 def read_rst(filename, rel_hash, do_tokenize=False):
 
-	f = codecs.open(filename, "r", "utf-8")
+	with codecs.open(filename, "r", "utf-8") as f:
+		return parse_rst(f.read(), rel_hash, do_tokenize=do_tokenize)
+
+
+def parse_rst(text, rel_hash, do_tokenize=False):
+	"""Reads the contents of an .rs3 file given as a string, like read_rst"""
 	try:
-		xmldoc = minidom.parseString(codecs.encode (f.read(), "utf-8"))
+		xmldoc = minidom.parseString(codecs.encode(text, "utf-8"))
 	except ExpatError:
 		message = "Invalid .rs3 file"
 		return message
@@ -168,9 +174,7 @@ def read_rst(filename, rel_hash, do_tokenize=False):
 	for row in nodes:
 		elements[row[0]] = NODE(row[0],row[1],row[2],row[3],row[4],row[5],row[6],row[7],"")
 
-	for element in elements:
-		if elements[element].kind == "edu":
-			get_left_right(element, elements,0,0,rel_hash)
+	set_left_right(elements, rel_hash)
 
 	return elements, signals
 
@@ -186,6 +190,7 @@ def read_text(filename,rel_hash,do_tokenize=False):
 		rel_hash["joint_m"] = "multinuc"
 
 	rels = collections.OrderedDict(sorted(rel_hash.items()))
+	def_relname, def_relkind = list(rels.items())[0]
 
 	for line in f:
 		contents = line.strip()
@@ -201,8 +206,9 @@ def read_text(filename,rel_hash,do_tokenize=False):
 				contents = tokenize(contents)
 				contents = " ".join(contents)
 
-			nodes[str(id_counter)] = NODE(str(id_counter),id_counter,id_counter,"0",0,"edu",contents,list(rels.keys())[0],list(rels.values())[0])
+			nodes[str(id_counter)] = NODE(str(id_counter),id_counter,id_counter,"0",0,"edu",contents,def_relname,def_relkind)
 
+	f.close()
 	return nodes
 
 
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Unit of work for editing the RST structure of one document version. The session loads the nodes of a
+(doc, project, user) triple once, applies tree edits in memory with the same semantics as the
+corresponding functions in rstweb_sql, and writes back only the changed rows in a single transaction.
+Author: Amir Zeldes
+"""
+
+from modules.rstweb_sql import get_connection, get_relation_catalog, get_rst_doc, touch_doc, transaction
+
+# Positions of the node fields kept in memory (same order as the rst_nodes columns)
+ID, LEFT, RIGHT, PARENT, DEPTH, KIND, CONTENTS, RELNAME = range(8)
+
+
+class DocumentSession:
+	def __init__(self, doc, project, user):
+		self.doc = doc
+		self.project = project
+		self.user = user
+
+		self.catalog = get_relation_catalog(doc, project)
+
+		self.nodes = {}
+		self.children = {}
+		for row in get_rst_doc(doc, project, user):
+			self.nodes[row[ID]] = list(row[:8])
+			self.children.setdefault(row[PARENT], set()).add(row[ID])
+		self.original = self.snapshot()
+
+		self.signals = None  # Replacement signal rows, if signals were updated in this session
+		self.deleted_sources = set()  # Deleted nodes whose stored signals must be removed
+
+	def snapshot(self):
+		return dict((node_id, tuple(node)) for node_id, node in self.nodes.items())
+
+	def node_exists(self, node_id):
+		return node_id in self.nodes
+
+	def get_parent(self, node_id):
+		return self.nodes[node_id][PARENT]
+
+	def get_rel(self, node_id):
+		return self.nodes[node_id][RELNAME]
+
+	def get_kind(self, node_id):
+		if node_id == "0":
+			return "none"
+		return self.nodes[node_id][KIND]
+
+	def get_node_lr(self, node_id):
+		return [self.nodes[node_id][LEFT], self.nodes[node_id][RIGHT]]
+
+	def get_children(self, node_id):
+		return sorted(self.children.get(node_id, ()), key=int)
+
+	def get_max_node_id(self):
+		return max(int(node_id) for node_id in self.nodes)
+
+	def get_rel_type(self, relname):
+		return self.catalog.get_rel_type(relname)
+
+	def get_def_rel(self, relkind):
+		return self.catalog.get_def_rel(relkind)
+
+	def get_multirel(self, node_id, exclude_child):
+		"""
+		Returns the multinuclear relation with which a multinuc is currently dominating its children
+		"""
+		for child in self.get_children(node_id):
+			if child != exclude_child and self.catalog.types.get(self.get_rel(child)) == "multinuc":
+				return self.get_rel(child)
+		return self.get_def_rel("multinuc")
+
+	def count_children(self, node_id):
+		return len(self.children.get(node_id, ()))
+
+	def count_span_children(self, node_id):
+		return len([child for child in self.children.get(node_id, ()) if self.get_rel(child) == "span"])
+
+	def count_multinuc_children(self, node_id):
+		return len([child for child in self.children.get(node_id, ()) if self.catalog.types.get(self.get_rel(child)) == "multinuc"])
+
+	def set_parent(self, node_id, parent):
+		self.children[self.get_parent(node_id)].discard(node_id)
+		self.children.setdefault(parent, set()).add(node_id)
+		self.nodes[node_id][PARENT] = parent
+
+	def set_rel(self, node_id, relname):
+		self.nodes[node_id][RELNAME] = relname
+
+	def add_node(self, node_id, left, right, parent, rel_name, text, node_kind):
+		self.nodes[node_id] = [node_id, left, right, parent, 0, node_kind, text, rel_name]
+		self.children.setdefault(parent, set()).add(node_id)
+
+	def remove_node(self, node_id):
+		self.children[self.get_parent(node_id)].discard(node_id)
+		del self.nodes[node_id]
+		if self.signals is None:
+			self.deleted_sources.add(node_id)
+		else:
+			self.signals = [signal for signal in self.signals if signal[0] != node_id]
+
+	def update_parent(self, node_id, new_parent_id):
+		prev_parent = self.get_parent(node_id)
+		self.set_parent(node_id, new_parent_id)
+		if new_parent_id == "0":
+			self.update_rel(node_id, self.get_def_rel("rst"))
+		if new_parent_id != "0":
+			if self.get_kind(new_parent_id) == "multinuc":
+				multi_rel = self.get_multirel(new_parent_id, node_id)
+				self.update_rel(node_id, multi_rel)
+			elif self.get_rel(node_id) == "span" and self.get_kind(new_parent_id) != "span":  # A span child was just attached to a non-span
+				self.update_rel(node_id, self.get_def_rel("rst"))
+		if prev_parent:
+			if not self.count_children(prev_parent) > 0 and not prev_parent == "0":  # Parent has no more children, delete it
+				self.delete_node(prev_parent)
+			elif self.get_kind(prev_parent) == "span" and self.count_span_children(prev_parent) == 0:  # Span just lost its last span child, delete it
+				self.delete_node(prev_parent)
+			elif self.get_kind(prev_parent) == "multinuc" and self.count_multinuc_children(prev_parent) == 0:  # Multinuc just lost its last multinuc child, delete it
+				self.delete_node(prev_parent)
+
+	def update_rel(self, node_id, new_rel):
+		parent_id = self.get_parent(node_id)
+		if self.get_kind(parent_id) == "multinuc":
+			new_rel_type = self.get_rel_type(new_rel)
+			if new_rel_type == "rst":
+				# Check if the last multinuc child of a multinuc just changed to rst
+				if self.count_multinuc_children(parent_id) == 1 and self.get_rel_type(self.get_rel(node_id)) == "multinuc":
+					new_rel = self.get_def_rel("rst")
+					for child in self.get_children(parent_id):
+						self.update_parent(child, "0")
+				self.set_rel(node_id, new_rel)
+			else:  # New multinuc relation for a multinuc child, change all children to this relation
+				self.set_rel(node_id, new_rel)
+				for child in self.get_children(parent_id):
+					if self.get_rel_type(self.get_rel(child)) == "multinuc":
+						self.set_rel(child, new_rel)
+		else:
+			self.set_rel(node_id, new_rel)
+
+	def delete_node(self, node_id):
+		if self.node_exists(node_id):
+			parent = self.get_parent(node_id)
+			if not self.get_kind(node_id) == "edu":  # If it's not an EDU, it may be deleted
+				# If there are still any children, such as rst relations to a deleted span or multinuc, set their parent to 0
+				for child in self.get_children(node_id):
+					self.update_parent(child, "0")
+				if self.node_exists(node_id):
+					self.remove_node(node_id)
+			if not parent == "0":
+				if not self.count_children(parent) > 0:
+					self.delete_node(parent)
+				elif self.get_kind(parent) == "span" and self.count_span_children(parent) == 0:  # Span just lost its last span child, delete it
+					self.delete_node(parent)
+				elif self.get_kind(parent) == "multinuc" and self.count_multinuc_children(parent) == 0:  # Multinuc just lost its last multinuc child, delete it
+					self.delete_node(parent)
+
+	def insert_parent(self, node_id, new_rel, node_kind):
+		lr = self.get_node_lr(node_id)
+		old_parent = self.get_parent(node_id)
+		old_rel = self.get_rel(node_id)
+		new_parent = str(self.get_max_node_id() + 1)
+		self.add_node(new_parent, lr[0], lr[1], old_parent, old_rel, "", node_kind)
+		self.update_parent(node_id, new_parent)
+		self.update_rel(node_id, new_rel)
+
+	def update_signals(self, signals_blob):
+		"""
+		:param signals_blob: list of strings, each containing a comma separated quadruple of signal specs (see rstweb_sql.update_signals)
+		:return: None
+		"""
+		self.signals = []
+		self.deleted_sources = set()
+		for signal in signals_blob:
+			source, sig_type, subtype, tokens = signal.split(",")
+			tokens = tokens.replace("-", ",")
+			self.signals.append((source, sig_type, subtype, tokens))
+
+	def flush(self):
+		"""Writes all changes since loading (or the last flush) to the database in one transaction"""
+		doc_key = (self.doc, self.project, self.user)
+		removed = [(node_id,) + doc_key for node_id in self.original if node_id not in self.nodes]
+		changed = [tuple(node) + doc_key for node_id, node in self.nodes.items() if self.original.get(node_id) != tuple(node)]
+
+		if len(removed) == 0 and len(changed) == 0 and self.signals is None:
+			return
+
+		with transaction():
+			cur = get_connection().cursor()
+			cur.executemany("DELETE FROM rst_nodes WHERE id=? and doc=? and project=? and user=?", removed)
+			cur.executemany("INSERT INTO rst_nodes VALUES(?,?,?,?,?,?,?,?,?,?,?)", changed)
+			if self.signals is not None:
+				cur.execute("DELETE FROM rst_signals WHERE doc=? and project=? and user=?", doc_key)
+				cur.executemany("INSERT INTO rst_signals VALUES (?,?,?,?,?,?,?)", [signal + doc_key for signal in self.signals])
+			else:
+				cur.executemany("DELETE FROM rst_signals WHERE source=? and doc=? and project=? and user=?",
+								[(node_id,) + doc_key for node_id in self.deleted_sources])
+			touch_doc(self.doc, self.project, self.user)
+
+		self.original = self.snapshot()
+		self.signals = None
+		self.deleted_sources = set()
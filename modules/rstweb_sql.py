@@ -9,10 +9,14 @@ Author: Amir Zeldes
 
 import sqlite3
 from modules.rstweb_reader import *
+from modules.configobj import ConfigObj
 import codecs
 import os
 import re
 import json
+import threading
+import time
+from contextlib import contextmanager
 
 try:
 	basestring
@@ -20,10 +24,125 @@ except NameError:
 	basestring = str
 
 
-def setup_db():
-	dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
+DB_PATH = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
+CONFIG_PATH = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"users"+os.sep+"config.ini"
+CACHED_STATEMENTS = 256  # Prepared statements kept per connection by the sqlite3 module
+EXPORT_CHUNK_SIZE = 65536  # Characters of rs3 XML collected by iter_export before a chunk is yielded
+
+# SQLite connection options, each of which can be overridden by a db_<option> entry in users/config.ini.
+# WAL lets annotators read while another annotator saves, and savers queue for up to busy_timeout milliseconds.
+DB_OPTIONS = {"journal_mode": "WAL", "busy_timeout": "30000", "synchronous": "NORMAL", "cache_size": "-16000", "mmap_size": "67108864"}
+
+SCHEMA_VERSION = 10
+
+# Node IDs, parents, EDU spans and signal sources are integers. Queries may still pass IDs as strings, which
+# the INTEGER column affinity converts, and functions returning IDs cast them back to text for their callers.
+RST_NODES_TABLE = '''CREATE TABLE IF NOT EXISTS rst_nodes
+	             (id integer, left integer, right integer, parent integer, depth real, kind text, contents text, relname text, doc text, project text, user text, UNIQUE (id, doc, project, user) ON CONFLICT REPLACE)'''
+RST_SIGNALS_TABLE = '''CREATE TABLE IF NOT EXISTS rst_signals
+	             (source integer, type text, subtype text, tokens text, doc text, project text, user text, UNIQUE (source, type, subtype, tokens, doc, project, user) ON CONFLICT REPLACE)'''
+
+# Indexes for the hot access paths: children of a node, EDUs of a document, signals of a document
+# and relation lookups by type. All lead with the document key so that every per-document query is a range scan.
+INDEXES = [
+	"CREATE INDEX IF NOT EXISTS rst_nodes_parent_idx ON rst_nodes (doc, project, user, parent, relname, id)",
+	"CREATE INDEX IF NOT EXISTS rst_nodes_kind_idx ON rst_nodes (doc, project, user, kind, id)",
+	"CREATE INDEX IF NOT EXISTS rst_signals_source_idx ON rst_signals (doc, project, user, source)",
+	"CREATE INDEX IF NOT EXISTS rst_relations_reltype_idx ON rst_relations (doc, project, reltype, relname)",
+	"CREATE INDEX IF NOT EXISTS docs_user_idx ON docs (user, project, doc)",
+]
+
+# Every write to the nodes or signals of a document version, and every new docs row, gives the version a new number
+# from the counter in version_counter, so that cached renderings of a document can be recognized as out of date.
+# Numbers are never reused, even if a document is deleted and imported again.
+VERSION_COUNTER_TABLE = "CREATE TABLE IF NOT EXISTS version_counter (version integer)"
+VERSION_TRIGGER = """CREATE TRIGGER IF NOT EXISTS {0}_{1}_version AFTER {1} ON {0}
+	BEGIN
+		UPDATE version_counter SET version = version + 1;
+		UPDATE docs SET version = (SELECT version FROM version_counter) WHERE {2};
+	END"""
+VERSION_TRIGGERS = list(VERSION_TRIGGER.format(table, event, "doc={0}.doc and project={0}.project and user={0}.user".format(row))
+						for table in ["rst_nodes", "rst_signals"] for event, row in [("insert", "NEW"), ("update", "NEW"), ("delete", "OLD")])
+VERSION_TRIGGERS.append(VERSION_TRIGGER.format("docs", "insert", "rowid=NEW.rowid"))
+
+SETTINGS_CHECK_INTERVAL = 1.0  # Seconds for which a thread trusts the settings cache without asking SQLite
+
+# Patterns used by the rs3 exporter: relation type suffixes and ampersands that do not start an entity
+REL_SUFFIX = re.compile(r'_[rm]$')
+AMP_BEFORE_SPACE = re.compile(r'&([^ ;]*) ')
+AMP_AT_END = re.compile(r'&$')
+
+_local = threading.local()
+_db_options = None
+_settings_cache = {}  # Schema version, settings and relation catalogs per database path, shared by all threads of the process
+
+
+def get_connection():
+	"""
+	Returns the database connection of the calling thread, opening it on first use. Connections are
+	reused by all data access functions for the lifetime of the thread (one per CherryPy worker thread,
+	one per CGI process) and keep their own cache of prepared statements.
+	"""
+	conn = getattr(_local, "conn", None)
+	# A connection may not be shared with forked child processes or survive a change of database path
+	if conn is None or _local.pid != os.getpid() or _local.path != DB_PATH:
+		options = get_db_options()
+		# Writing transactions take the write lock when they begin, so they wait for each other in the busy
+		# handler instead of failing when a concurrent save invalidates their read snapshot
+		conn = sqlite3.connect(DB_PATH, timeout=options["busy_timeout"] / 1000.0, cached_statements=CACHED_STATEMENTS, isolation_level="IMMEDIATE")
+		conn.execute("PRAGMA journal_mode=" + options["journal_mode"])
+		conn.execute("PRAGMA synchronous=" + options["synchronous"])
+		conn.execute("PRAGMA cache_size=" + str(options["cache_size"]))
+		conn.execute("PRAGMA mmap_size=" + str(options["mmap_size"]))
+		_local.conn = conn
+		_local.pid = os.getpid()
+		_local.path = DB_PATH
+		_local.data_version = None  # data_version values are only comparable on the same connection
+		_local.settings_checked = 0
+		_local.schema = None
+		upgrade_if_needed(conn)
+	return conn
+
+
+def upgrade_if_needed(conn):
+	"""Brings a database created by an older version up to date before its first use"""
+	schema = conn.execute("PRAGMA user_version").fetchone()[0]
+	if schema < SCHEMA_VERSION:
+		tables = conn.execute("SELECT count(*) FROM sqlite_master WHERE type='table' and name='rst_nodes'").fetchone()[0]
+		if tables > 0:  # Databases without tables are about to be set up from scratch
+			update_schema()
+
+
+def get_db_options():
+	"""Returns the SQLite connection options, reading the overrides in users/config.ini once per process"""
+	global _db_options
+	if _db_options is None:
+		config = ConfigObj(CONFIG_PATH)
+		options = {}
+		for option in DB_OPTIONS:
+			value = str(config.get("db_" + option, DB_OPTIONS[option])).strip()
+			if option in ["journal_mode", "synchronous"]:
+				if re.match(r'^[A-Za-z]+$', value) is None:  # Values are inserted into PRAGMA statements
+					raise ValueError("Invalid value for db_" + option + " in config.ini: " + value)
+				options[option] = value.upper()
+			else:
+				options[option] = int(value)
+		_db_options = options
+	return _db_options
 
-	conn = sqlite3.connect(dbpath)
+
+def close_connection():
+	"""Closes the calling thread's connection, if any; the next query will open a new one"""
+	conn = getattr(_local, "conn", None)
+	if conn is not None:
+		if _local.pid == os.getpid():
+			conn.close()
+		_local.conn = None
+
+
+def setup_db():
+	conn = get_connection()
+	invalidate_cache()
 
 	cur = conn.cursor()
 
@@ -38,19 +157,18 @@ def setup_db():
 	cur.execute("DROP TABLE IF EXISTS projects")
 	cur.execute("DROP TABLE IF EXISTS logging")
 	cur.execute("DROP TABLE IF EXISTS settings")
+	cur.execute("DROP TABLE IF EXISTS version_counter")
 	conn.commit()
 
 	# Create tables
-	cur.execute('''CREATE TABLE IF NOT EXISTS rst_nodes
-	             (id text, left real, right real, parent text, depth real, kind text, contents text, relname text, doc text, project text, user text, UNIQUE (id, doc, project, user) ON CONFLICT REPLACE)''')
-	cur.execute('''CREATE TABLE IF NOT EXISTS rst_signals
-	             (source text, type text, subtype text, tokens text, doc text, project text, user text, UNIQUE (source, type, subtype, tokens, doc, project, user) ON CONFLICT REPLACE)''')
+	cur.execute(RST_NODES_TABLE)
+	cur.execute(RST_SIGNALS_TABLE)
 	cur.execute('''CREATE TABLE IF NOT EXISTS rst_signal_types
 	             (majtype text, subtype text, doc text, project text, UNIQUE (majtype, subtype, doc, project) ON CONFLICT REPLACE)''')
 	cur.execute('''CREATE TABLE IF NOT EXISTS rst_relations
 	             (relname text, reltype text, doc text, project text, UNIQUE (relname, reltype, doc, project) ON CONFLICT REPLACE)''')
 	cur.execute('''CREATE TABLE IF NOT EXISTS docs
-	             (doc text, project text, user text,  UNIQUE (doc, project, user) ON CONFLICT REPLACE)''')
+	             (doc text, project text, user text, modified real, version integer DEFAULT 0, UNIQUE (doc, project, user) ON CONFLICT REPLACE)''')
 	cur.execute('''CREATE TABLE IF NOT EXISTS users
 	             (user text, timestamp text, UNIQUE (user) ON CONFLICT REPLACE)''')
 	cur.execute('''CREATE TABLE IF NOT EXISTS projects
@@ -59,25 +177,23 @@ def setup_db():
 	             (doc text, project text, user text, actions text, mode text, timestamp text)''')
 	cur.execute('''CREATE TABLE IF NOT EXISTS settings
 	             (setting text, svalue text, UNIQUE (setting) ON CONFLICT REPLACE)''')
+	create_indexes(cur)
+	create_triggers(cur)
 
 	conn.commit()
-	conn.close()
 
 	initialize_settings()
 
 
 def update_schema():
-	dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
-	conn = sqlite3.connect(dbpath)
+	conn = get_connection()
 	cur = conn.cursor()
 
 	# Create tables
-	cur.execute('''CREATE TABLE IF NOT EXISTS rst_nodes
-	             (id text, left real, right real, parent text, depth real, kind text, contents text, relname text, doc text, project text, user text, UNIQUE (id, doc, project, user) ON CONFLICT REPLACE)''')
+	cur.execute(RST_NODES_TABLE)
 	cur.execute('''CREATE TABLE IF NOT EXISTS rst_relations
 	             (relname text, reltype text, doc text, project text, UNIQUE (relname, reltype, doc, project) ON CONFLICT REPLACE)''')
-	cur.execute('''CREATE TABLE IF NOT EXISTS rst_signals
-	             (source text, type text, subtype text, tokens text, doc text, project text, user text, UNIQUE (source, type, subtype, tokens, doc, project, user) ON CONFLICT REPLACE)''')
+	cur.execute(RST_SIGNALS_TABLE)
 	cur.execute('''CREATE TABLE IF NOT EXISTS rst_signal_types
 	             (majtype text, subtype text, doc text, project text, UNIQUE (majtype, subtype, doc, project) ON CONFLICT REPLACE)''')
 	cur.execute('''CREATE TABLE IF NOT EXISTS docs
@@ -99,14 +215,69 @@ def update_schema():
 		cur.execute('ALTER TABLE users ADD COLUMN timestamp text')
 	if schema < 5:  # versions below 5 do not validations
 		cur.execute('ALTER TABLE projects ADD COLUMN validations text')
+	if schema < 9:  # versions below 9 do not record when a document version was last modified
+		cur.execute('ALTER TABLE docs ADD COLUMN modified real')
+		cur.execute('UPDATE docs SET modified=?',(time.time(),))
+	if schema < 10:  # versions below 10 do not number the changes to each document version
+		cur.execute('ALTER TABLE docs ADD COLUMN version integer DEFAULT 0')
 
 	conn.commit()
-	conn.close()
 
 	if schema < 6:
 		initialize_signal_types_on_existing_docs()
+	if schema < 7:  # versions below 7 have no indexes beyond the UNIQUE constraints
+		create_indexes(cur)
+		conn.commit()
+	if schema < 8:  # versions below 8 store node IDs as text and EDU spans as real numbers
+		migrate_integer_ids(conn)
+	if schema < 10:
+		create_triggers(cur)
+		conn.commit()
+	if schema < 8:  # Update query planner statistics once all new indexes and tables are in place
+		cur.execute("ANALYZE")
+		conn.commit()
 
-	initialize_settings()
+	invalidate_cache()
+	initialize_settings(overwrite=False)
+
+
+def create_indexes(cur):
+	for index in INDEXES:
+		cur.execute(index)
+
+
+def create_triggers(cur):
+	cur.execute(VERSION_COUNTER_TABLE)
+	if cur.execute("SELECT count(*) FROM version_counter").fetchone()[0] == 0:
+		cur.execute("INSERT INTO version_counter SELECT ifnull(max(version), 0) FROM docs")
+	for trigger in VERSION_TRIGGERS:
+		cur.execute(trigger)
+
+
+def migrate_integer_ids(conn):
+	"""
+	Rebuilds rst_nodes and rst_signals with INTEGER IDs, parents, spans and signal sources in one transaction.
+	Values are converted by column affinity, so '12' and 12.0 both become 12 and other values are kept as they are.
+	"""
+	conn.commit()
+	isolation_level = conn.isolation_level
+	conn.isolation_level = None  # Manage the transaction manually, so that the DDL statements are part of it
+	cur = conn.cursor()
+	try:
+		cur.execute("BEGIN")
+		for table, create_stmt in [("rst_nodes", RST_NODES_TABLE), ("rst_signals", RST_SIGNALS_TABLE)]:
+			cur.execute("ALTER TABLE " + table + " RENAME TO " + table + "_text")
+			cur.execute(create_stmt)
+			cur.execute("INSERT INTO " + table + " SELECT * FROM " + table + "_text")
+			cur.execute("DROP TABLE " + table + "_text")  # Also drops the indexes and triggers, which moved with the old table
+		create_indexes(cur)
+		create_triggers(cur)
+		cur.execute("COMMIT")
+	except:
+		cur.execute("ROLLBACK")
+		raise
+	finally:
+		conn.isolation_level = isolation_level
 
 
 def initialize_signal_types_on_existing_docs():
@@ -120,31 +291,61 @@ def initialize_signal_types_on_existing_docs():
 
 
 def get_schema():
-	dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
-	conn = sqlite3.connect(dbpath)
-	with conn:
-		cur = conn.cursor()
-		cur.execute('PRAGMA user_version')
-		return cur.fetchall()[0][0]
+	return get_cached_settings()["schema"]
 
 
 def set_schema(version):
-	dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
-	conn = sqlite3.connect(dbpath)
-	with conn:
-		cur = conn.cursor()
-		pragma_stmt = 'PRAGMA user_version=' +str(version)
-		cur.execute(pragma_stmt)
+	pragma_stmt = 'PRAGMA user_version=' +str(version)
+	generic_query(pragma_stmt,())
+	invalidate_cache()
+
+
+def get_cached_settings():
+	"""
+	Returns the schema version, settings and relation catalogs of the database from the process-wide cache, so
+	that reading them costs no SQL. The cache is reloaded after a commit by another connection, which the calling thread detects
+	through PRAGMA data_version at most once every SETTINGS_CHECK_INTERVAL seconds. Inside a transaction no PRAGMA is run,
+	since Python 2 commits the open transaction before such statements, and the schema version last read by the thread is used.
+	"""
+	conn = get_connection()
+	cache = _settings_cache.get(DB_PATH)
+	now = time.time()
+	if in_transaction():
+		if cache is not None:
+			return cache
+	elif cache is None or now - _local.settings_checked >= SETTINGS_CHECK_INTERVAL:
+		_local.settings_checked = now
+		data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+		if data_version != _local.data_version:
+			_local.data_version = data_version
+			cache = None
+	if cache is None:
+		if in_transaction():
+			schema = _local.schema
+		else:
+			schema = conn.execute("PRAGMA user_version").fetchone()[0]
+			_local.schema = schema
+		settings = {}
+		if schema > 1:
+			settings = dict(conn.execute("SELECT setting, svalue FROM settings").fetchall())
+		cache = {"schema": schema, "settings": settings, "relations": {}}
+		_settings_cache[DB_PATH] = cache
+	return cache
+
 
+def invalidate_cache():
+	"""Drops the cached schema version, settings and relations after they were changed through this process"""
+	_settings_cache.pop(DB_PATH, None)
 
-def initialize_settings():
-	# Initialize settings to default values
-	save_setting("logging", "off")
-	save_setting("signals", "False")
-	save_setting("signals_file", "default.json")
-	save_setting("use_span_buttons", "True")
-	save_setting("use_multinuc_buttons", "True")
-	set_schema('6')
+
+def initialize_settings(overwrite=True):
+	# Initialize settings to default values, keeping existing values when updating the schema
+	set_schema(SCHEMA_VERSION)
+	defaults = [("logging", "off"), ("signals", "False"), ("signals_file", "default.json"),
+				("use_span_buttons", "True"), ("use_multinuc_buttons", "True")]
+	for setting, svalue in defaults:
+		if overwrite or not setting_exists(setting):
+			save_setting(setting, svalue)
 
 
 def check_refresh(user, timestamp):
@@ -209,12 +410,7 @@ def read_signals_file():
 	except IOError:
 		return {}
 
-def import_document(filename, project, user, do_tokenize=False):
-	dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
-	conn = sqlite3.connect(dbpath)
-
-	cur = conn.cursor()
-
+def import_document(filename, project, user, do_tokenize=False, stats=None):
 	doc=os.path.basename(filename)
 
 	rel_hash = {}
@@ -227,94 +423,99 @@ def import_document(filename, project, user, do_tokenize=False):
 	if isinstance(rst_nodes,basestring):
 		return rst_nodes
 
-	# First delete any old copies of this document, if they are already imported
-	delete_document(doc,project)
-
-	for key in rst_nodes:
-		node = rst_nodes[key]
-		cur.execute("INSERT INTO rst_nodes VALUES(?,?,?,?,?,?,?,?,?,?,?)", (node.id,node.left,node.right,node.parent,node.depth,node.kind,node.text,node.relname,doc,project,user)) #user's instance
-		cur.execute("INSERT INTO rst_nodes VALUES(?,?,?,?,?,?,?,?,?,?,?)", (node.id,node.left,node.right,node.parent,node.depth,node.kind,node.text,node.relname,doc,project,"_orig")) #backup instance
-
-	for signal in rst_signals:
-		cur.execute("INSERT INTO rst_signals VALUES(?,?,?,?,?,?,?)", (signal[0],signal[1],signal[2],signal[3],doc,project,user)) #user's instance
-		cur.execute("INSERT INTO rst_signals VALUES(?,?,?,?,?,?,?)", (signal[0],signal[1],signal[2],signal[3],doc,project,"_orig")) #backup instance
-
-	signal_types = read_signals_file()
-	for majtype, subtypes in signal_types.items():
-		for subtype in subtypes:
-			cur.execute("INSERT INTO rst_signal_types VALUES(?,?,?,?)",
-			(majtype, subtype, doc, project))
-
-	for key in rel_hash:
-		rel_name = key
-		rel_type = rel_hash[key]
-		cur.execute("INSERT INTO rst_relations VALUES(?,?,?,?)", (rel_name, rel_type, doc, project))
-
-	cur.execute("INSERT INTO docs VALUES (?,?,?)", (doc,project,user))
-	cur.execute("INSERT INTO docs VALUES (?,?,'_orig')", (doc,project))
-
-	conn.commit()
-	conn.close()
+	store_document(doc, project, user, rst_nodes, rst_signals, rel_hash, stats=stats)
 
 
-def import_plaintext(filename, project, user, rel_hash, do_tokenize=False):
+def import_plaintext(filename, project, user, rel_hash, do_tokenize=False, stats=None):
 
 	doc=os.path.basename(filename)
 
 	rst_nodes = read_text(filename, rel_hash, do_tokenize=do_tokenize)
 
-	for key in rst_nodes:
-		node = rst_nodes[key]
-		generic_query("INSERT INTO rst_nodes VALUES(?,?,?,?,?,?,?,?,?,?,?)", (node.id,node.left,node.right,node.parent,node.depth,node.kind,node.text,node.relname,doc,project,user)) #user's instance
-		generic_query("INSERT INTO rst_nodes VALUES(?,?,?,?,?,?,?,?,?,?,?)", (node.id,node.left,node.right,node.parent,node.depth,node.kind,node.text,node.relname,doc,project,"_orig")) #backup instance
+	store_document(doc, project, user, rst_nodes, [], rel_hash, stats=stats)
 
-	for key in rel_hash:
-		rel_name = key
-		rel_type = rel_hash[key]
-		generic_query("INSERT INTO rst_relations VALUES(?,?,?,?)", (rel_name, rel_type, doc, project))
 
+def store_document(doc, project, user, rst_nodes, rst_signals, rel_hash, stats=None):
+	"""
+	Writes an imported document for the user and as the '_orig' backup in a single transaction, replacing any
+	earlier copies of the document. If a stats dict is given, the number of rows written, the time taken
+	and the resulting rows per second are added to it.
+	"""
+	start = time.time()
+	node_rows = [(node.id,node.left,node.right,node.parent,node.depth,node.kind,node.text,node.relname,doc,project,user) for node in rst_nodes.values()]
+	signal_rows = [(signal[0],signal[1],signal[2],signal[3],doc,project,user) for signal in rst_signals]
 	signal_types = read_signals_file()
-	for majtype, subtypes in signal_types.items():
-		for subtype in subtypes:
-			cur.execute("INSERT INTO rst_signal_types VALUES(?,?,?,?)",
-			(majtype, subtype, doc, project))
+	type_rows = [(majtype, subtype, doc, project) for majtype in signal_types for subtype in signal_types[majtype]]
+	rel_rows = [(rel_name, rel_hash[rel_name], doc, project) for rel_name in rel_hash]
 
-	generic_query("INSERT INTO docs VALUES (?,?,?)", (doc,project,user))
+	with transaction():
+		cur = get_connection().cursor()
 
+		# First delete any old copies of this document, if they are already imported
+		delete_document(doc,project)
 
-def get_rst_doc(doc,project,user):
-	dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
-	conn = sqlite3.connect(dbpath)
+		cur.executemany("INSERT INTO rst_nodes VALUES(?,?,?,?,?,?,?,?,?,?,?)", node_rows)  # user's instance
+		cur.execute("""INSERT INTO rst_nodes SELECT id, left, right, parent, depth, kind, contents, relname, doc, project, '_orig'
+		            FROM rst_nodes WHERE doc=? and project=? and user=?""", (doc,project,user))  # backup instance
+		cur.executemany("INSERT INTO rst_signals VALUES(?,?,?,?,?,?,?)", signal_rows)
+		cur.execute("""INSERT INTO rst_signals SELECT source, type, subtype, tokens, doc, project, '_orig'
+		            FROM rst_signals WHERE doc=? and project=? and user=?""", (doc,project,user))
+		cur.executemany("INSERT INTO rst_signal_types VALUES(?,?,?,?)", type_rows)
+		cur.executemany("INSERT INTO rst_relations VALUES(?,?,?,?)", rel_rows)
+		cur.execute("INSERT INTO docs (doc, project, user, modified) VALUES (?,?,?,?)", (doc,project,user,start))
+		cur.execute("INSERT INTO docs (doc, project, user, modified) VALUES (?,?,'_orig',?)", (doc,project,start))
 
-	with conn:
-		cur = conn.cursor()
-		cur.execute("SELECT id, left, right, parent, depth, kind, contents, relname, doc, project, user FROM rst_nodes WHERE doc=? and project=? and user=? ORDER BY CAST(id AS int)", (doc,project,user))
+	invalidate_cache()  # The document may have been imported before with other relations
 
-		rows = cur.fetchall()
-		return rows
+	if stats is not None:  # Totals accumulate if the same dict is passed for several imports
+		stats["rows"] = stats.get("rows", 0) + 2 * (len(node_rows) + len(signal_rows) + 1) + len(type_rows) + len(rel_rows)
+		stats["seconds"] = stats.get("seconds", 0.0) + time.time() - start
+		stats["rows_per_sec"] = stats["rows"] / max(stats["seconds"], 0.000001)
+
+
+def get_rst_doc(doc,project,user):
+	return generic_query("SELECT CAST(id AS text), left, right, CAST(parent AS text), depth, kind, contents, relname, doc, project, user FROM rst_nodes WHERE doc=? and project=? and user=? ORDER BY id", (doc,project,user))
 
 
 def get_def_rel(relkind, doc, project):
-	rel_row = generic_query("SELECT relname FROM rst_relations WHERE reltype = ? and doc=? and project=? ORDER BY relname",(relkind,doc,project))
-	if len(rel_row) == 0:
-		if relkind == "rst":
+	return get_relation_catalog(doc,project).get_def_rel(relkind)
+
+
+class RelationCatalog:
+	def __init__(self, doc, project):
+		"""Relations declared for one document, loaded once for constant time lookups of types and defaults"""
+		self.rels = get_rst_rels(doc,project)  # (relname, reltype) tuples ordered by relname
+		self.types = {}
+		self.defaults = {}
+		for relname, reltype in self.rels:
+			self.types[relname] = reltype
+			if reltype not in self.defaults:  # The first relation of each type by name is its default
+				self.defaults[reltype] = relname
+
+	def get_rel_type(self, relname):
+		if relname == "span" or relname == "":
+			return "span"
+		return self.types[relname]
+
+	def get_def_rel(self, relkind):
+		if relkind in self.defaults:
+			return self.defaults[relkind]
+		elif relkind == "rst":
 			return "--_r"
 		else:
 			return "--_m"
-	else:
-		return rel_row[0][0]
 
 
-def get_rst_rels(doc,project):
-	dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
-	conn = sqlite3.connect(dbpath)
+def get_relation_catalog(doc, project):
+	"""Returns the cached RelationCatalog of a document, which is reloaded together with the settings cache"""
+	catalogs = get_cached_settings()["relations"]
+	if (doc, project) not in catalogs:
+		catalogs[(doc, project)] = RelationCatalog(doc, project)
+	return catalogs[(doc, project)]
 
-	with conn:
-		cur = conn.cursor()
-		cur.execute("SELECT relname, reltype FROM rst_relations WHERE doc=? and project=? ORDER BY relname", (doc,project))
 
-		rows = cur.fetchall()
-		return rows
+def get_rst_rels(doc,project):
+	return generic_query("SELECT relname, reltype FROM rst_relations WHERE doc=? and project=? ORDER BY relname", (doc,project))
 
 
 def get_docs_by_project(user):
@@ -325,6 +526,25 @@ def get_all_docs_by_project():
 	return generic_query("SELECT DISTINCT doc, project FROM docs ORDER BY project, doc COLLATE NOCASE",())
 
 
+def get_doc_versions(projects=None, users=None, modified_since=None):
+	"""
+	Returns (doc, project, user, modified) rows for all annotated document versions, i.e. excluding the '_orig'
+	backups, optionally restricted to lists of projects and users and to versions modified since a Unix time
+	"""
+	sql = "SELECT doc, project, user, modified FROM docs WHERE not user='_orig'"
+	params = []
+	if projects is not None:
+		sql += " and project IN (" + ",".join("?" * len(projects)) + ")"
+		params += list(projects)
+	if users is not None:
+		sql += " and user IN (" + ",".join("?" * len(users)) + ")"
+		params += list(users)
+	if modified_since is not None:
+		sql += " and modified >= ?"
+		params.append(modified_since)
+	return generic_query(sql + " ORDER BY project, doc, user",params)
+
+
 def add_node(node_id,left,right,parent,rel_name,text,node_kind,doc,project,user):
 	generic_query("INSERT INTO rst_nodes VALUES(?,?,?,?,?,?,?,?,?,?,?)", (node_id,left,right,parent,0,node_kind,text,rel_name,doc,project,user))
 
@@ -362,15 +582,16 @@ def get_multirel(node_id,exclude_child,doc,project,user):
 	Returns the multinuclear relation with which a multinuc is currently dominating its children
 	"""
 
-	rel_row = generic_query("SELECT rst_nodes.relname FROM rst_nodes JOIN rst_relations ON rst_nodes.relname = rst_relations.relname and rst_nodes.doc = rst_relations.doc and rst_nodes.project = rst_relations.project WHERE rst_relations.reltype = 'multinuc' and rst_nodes.parent=? and not rst_nodes.id=? and rst_nodes.doc=? and rst_nodes.project=? and rst_nodes.user=?",(node_id,exclude_child,doc,project,user))
-	if len(rel_row) > 0:
-		return rel_row[0][0]
-	else:
-		return get_def_rel("multinuc",doc,project)
+	catalog = get_relation_catalog(doc,project)
+	rel_rows = generic_query("SELECT relname FROM rst_nodes WHERE parent=? and not id=? and doc=? and project=? and user=?",(node_id,exclude_child,doc,project,user))
+	for row in rel_rows:
+		if catalog.types.get(row[0]) == "multinuc":
+			return row[0]
+	return catalog.get_def_rel("multinuc")
 
 
 def get_parent(node_id,doc,project,user):
-	parent_row = generic_query("SELECT parent FROM rst_nodes WHERE id=? and doc=? and project=? and user=?",(node_id,doc,project,user))
+	parent_row = generic_query("SELECT CAST(parent AS text) FROM rst_nodes WHERE id=? and doc=? and project=? and user=?",(node_id,doc,project,user))
 	return parent_row[0][0]
 
 
@@ -388,13 +609,14 @@ def get_kind(node_id,doc,project,user):
 
 
 def update_rel(node_id,new_rel,doc,project,user):
+	catalog = get_relation_catalog(doc,project)
 	parent_id = get_parent(node_id,doc,project,user)
 	if get_kind(parent_id,doc,project,user)=="multinuc":
-		new_rel_type = get_rel_type(new_rel,doc,project)
+		new_rel_type = catalog.get_rel_type(new_rel)
 		if new_rel_type == "rst":
 			# Check if the last multinuc child of a multinuc just changed to rst
-			if count_multinuc_children(parent_id,doc,project,user) == 1 and get_rel_type(get_rel(node_id,doc,project,user),doc,project) == "multinuc":
-				new_rel = get_def_rel("rst",doc,project)
+			if count_multinuc_children(parent_id,doc,project,user) == 1 and catalog.get_rel_type(get_rel(node_id,doc,project,user)) == "multinuc":
+				new_rel = catalog.get_def_rel("rst")
 				children = get_children(parent_id,doc,project,user)
 				for child in children:
 					update_parent(child[0],"0",doc,project,user)
@@ -403,7 +625,7 @@ def update_rel(node_id,new_rel,doc,project,user):
 			generic_query("UPDATE rst_nodes SET relname=? WHERE id=? and doc=? and project=? and user=?",(new_rel,node_id,doc,project,user))
 			children = get_children(parent_id,doc,project,user)
 			for child in children:
-				if get_rel_type(get_rel(child[0],doc,project,user),doc,project) == "multinuc":
+				if catalog.get_rel_type(get_rel(child[0],doc,project,user)) == "multinuc":
 					generic_query("UPDATE rst_nodes SET relname=? WHERE id=? and doc=? and project=? and user=?",(new_rel,child[0],doc,project,user))
 	else:
 		generic_query("UPDATE rst_nodes SET relname=? WHERE id=? and doc=? and project=? and user=?",(new_rel,node_id,doc,project,user))
@@ -425,8 +647,8 @@ def get_multinuc_children_lr(node_id,doc,project,user):
 
 
 def get_multinuc_children_lr_ids(node_id,left,right,doc,project,user):
-	id_left = generic_query("SELECT id FROM rst_nodes JOIN rst_relations ON rst_nodes.relname = rst_relations.relname and rst_nodes.doc = rst_relations.doc and rst_nodes.project = rst_relations.project WHERE reltype = 'multinuc' and parent=? and rst_nodes.left=? and rst_nodes.doc=? and rst_nodes.project=? and user=? ORDER BY rst_nodes.left",(node_id,left,doc,project,user))
-	id_right = generic_query("SELECT id FROM rst_nodes JOIN rst_relations ON rst_nodes.relname = rst_relations.relname and rst_nodes.doc = rst_relations.doc and rst_nodes.project = rst_relations.project WHERE reltype = 'multinuc' and parent=? and rst_nodes.right=? and rst_nodes.doc=? and rst_nodes.project=? and user=? ORDER BY rst_nodes.left",(node_id,right,doc,project,user))
+	id_left = generic_query("SELECT CAST(id AS text) FROM rst_nodes JOIN rst_relations ON rst_nodes.relname = rst_relations.relname and rst_nodes.doc = rst_relations.doc and rst_nodes.project = rst_relations.project WHERE reltype = 'multinuc' and parent=? and rst_nodes.left=? and rst_nodes.doc=? and rst_nodes.project=? and user=? ORDER BY rst_nodes.left",(node_id,left,doc,project,user))
+	id_right = generic_query("SELECT CAST(id AS text) FROM rst_nodes JOIN rst_relations ON rst_nodes.relname = rst_relations.relname and rst_nodes.doc = rst_relations.doc and rst_nodes.project = rst_relations.project WHERE reltype = 'multinuc' and parent=? and rst_nodes.right=? and rst_nodes.doc=? and rst_nodes.project=? and user=? ORDER BY rst_nodes.left",(node_id,right,doc,project,user))
 	return id_left[0][0],id_right[0][0]
 
 
@@ -441,10 +663,7 @@ def node_exists(node_id,doc,project,user):
 
 
 def get_rel_type(relname,doc,project):
-	if relname=="span" or relname=="":
-		return "span"
-	else:
-		return generic_query("SELECT reltype from rst_relations WHERE relname=? and doc=? and project=?",(relname,doc,project))[0][0]
+	return get_relation_catalog(doc,project).get_rel_type(relname)
 
 
 def delete_node(node_id,doc,project,user):
@@ -484,14 +703,28 @@ def reset_rst_doc(doc,project,user):
 	generic_query("DELETE FROM rst_signals WHERE doc=? and project=? and user=?",(doc,project,user))
 	generic_query("""INSERT INTO rst_signals (source, type, subtype, tokens, doc, project, user)
 	              SELECT source, type, subtype, tokens, doc, project, '""" + user + "' FROM rst_signals WHERE doc=? and project=? and user='_orig'""",(doc,project))
+	touch_doc(doc,project,user)
+
+
+def touch_doc(doc,project,user):
+	"""Records that a document version was just modified"""
+	generic_query("UPDATE docs SET modified=? WHERE doc=? and project=? and user=?",(time.time(),doc,project,user))
+
+
+def get_doc_version(doc,project,user):
+	"""Returns the number of the last change to a document version, or None if the user has no such document"""
+	version = generic_query("SELECT version FROM docs WHERE doc=? and project=? and user=?",(doc,project,user))
+	if len(version) == 0:
+		return None
+	return version[0][0]
 
 
 def get_children(parent,doc,project,user):
-	return generic_query("SELECT id from rst_nodes WHERE parent=? and doc=? and project=? and user=?",(parent,doc,project,user))
+	return generic_query("SELECT CAST(id AS text) from rst_nodes WHERE parent=? and doc=? and project=? and user=?",(parent,doc,project,user))
 
 
 def get_max_node_id(doc,project,user):
-	return generic_query("SELECT max(CAST (id as decimal)) as max_id from rst_nodes WHERE doc=? and project=? and user=?",(doc,project,user))[0][0]
+	return generic_query("SELECT max(id) as max_id from rst_nodes WHERE doc=? and project=? and user=?",(doc,project,user))[0][0]
 
 
 def get_max_right(doc,project,user):
@@ -499,12 +732,17 @@ def get_max_right(doc,project,user):
 
 
 def get_users(doc,project):
-	return generic_query("SELECT user from rst_nodes WHERE doc=? and project=? and not user='_orig'",(doc,project))
+	# One row per annotator version, listed in the docs table (not one per node as in rst_nodes)
+	return generic_query("SELECT DISTINCT user from docs WHERE doc=? and project=? and not user='_orig' ORDER BY user",(doc,project))
 
 
 def generic_query(sql,params):
-	dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
-	conn = sqlite3.connect(dbpath)
+	conn = get_connection()
+
+	if in_transaction():  # Leave committing to the enclosing transaction
+		cur = conn.cursor()
+		cur.execute(sql,params)
+		return cur.fetchall()
 
 	with conn:
 		cur = conn.cursor()
@@ -513,76 +751,165 @@ def generic_query(sql,params):
 		return rows
 
 
+def in_transaction():
+	return getattr(_local, "tx_depth", 0) > 0
+
+
+@contextmanager
+def transaction():
+	"""
+	Runs all queries of the calling thread inside the block as a single transaction, which is committed
+	when the block exits and rolled back if it raises. Nested blocks join the outermost transaction.
+	Yields a dict in which the time taken by the final commit is stored as 'commit_time' (in seconds).
+	"""
+	conn = get_connection()
+	depth = getattr(_local, "tx_depth", 0)
+	if depth == 0:
+		get_cached_settings()  # Load the settings before the transaction, in which no PRAGMA may run
+	stats = {"commit_time": 0.0}
+	_local.tx_depth = depth + 1
+	try:
+		yield stats
+	except:
+		_local.tx_depth = depth
+		if depth == 0:
+			conn.rollback()
+			invalidate_cache()  # Settings or relations written in the transaction may have been cached
+		raise
+	_local.tx_depth = depth
+	if depth == 0:
+		start = time.time()
+		conn.commit()
+		stats["commit_time"] = time.time() - start
+
+
 def export_document(doc, project,exportdir):
-	doc_users = get_users(doc,project)
-	for user in doc_users:
-		this_user = user[0]
-		rst_out = get_export_string(doc, project, this_user)
-		filename = project + "_" + doc + "_" + this_user + ".rs3"
-		f = codecs.open(exportdir + filename, 'w','utf-8')
-		f.write(rst_out)
+	for user, rs3 in iter_export_versions(doc, project):
+		filename = project + "_" + doc + "_" + user + ".rs3"
+		with codecs.open(exportdir + filename, 'w','utf-8') as f:
+			f.write(rs3)
+
+
+def iter_export_versions(doc, project, users=None):
+	"""
+	Generates (user, rs3 XML) for each annotator version of a document, or for the given users only.
+	All versions are built from one read of the document's nodes and signals.
+	"""
+	if users is None:
+		users = [row[0] for row in get_users(doc,project)]
+	conn = get_connection()
+	edus = dict((user, []) for user in users)
+	groups = dict((user, []) for user in users)
+	signals = dict((user, []) for user in users)
+	rows = conn.execute("SELECT user, CAST(id AS text), CAST(parent AS text), kind, contents, relname FROM rst_nodes WHERE doc=? and project=? ORDER BY user, id", (doc,project))
+	for user, node_id, parent, kind, contents, relname in rows:
+		if user in edus:
+			if kind == "edu":
+				edus[user].append((node_id, parent, contents, relname))
+			else:
+				groups[user].append((node_id, parent, kind, relname))
+	rows = conn.execute("SELECT user, CAST(source AS text), type, subtype, tokens FROM rst_signals WHERE doc=? and project=? ORDER BY user, source, rowid", (doc,project))
+	for row in rows:
+		if row[0] in signals:
+			signals[row[0]].append(row[1:])
+	rels = get_relation_catalog(doc,project).rels
+	for user in users:
+		yield user, "".join(iter_rs3_parts(rels, edus[user], groups[user], signals[user]))
 
 
 def get_export_string(doc, project, user):
-	rels = get_rst_rels(doc,project)
-	nodes = get_rst_doc(doc,project,user)
-	signals = get_signals(doc,project,user)
-	rst_out = '''<rst>
+	return "".join(iter_export(doc, project, user))
+
+
+def iter_export(doc, project, user, encoding=None):
+	"""
+	Generates the rs3 XML of a document version in chunks of about EXPORT_CHUNK_SIZE characters, encoded
+	if an encoding is given. Nodes and signals are read from cursors while the chunks are consumed, so
+	memory use does not grow with the size of the document.
+	"""
+	buffered = []
+	size = 0
+	for part in iter_export_parts(doc, project, user):
+		buffered.append(part)
+		size += len(part)
+		if size >= EXPORT_CHUNK_SIZE:
+			chunk = "".join(buffered)
+			yield chunk.encode(encoding) if encoding else chunk
+			buffered = []
+			size = 0
+	chunk = "".join(buffered)
+	yield chunk.encode(encoding) if encoding else chunk
+
+
+def escape_contents(contents):
+	# Handle XML escapes
+	if "&" in contents:
+		contents = AMP_BEFORE_SPACE.sub(r'&amp;\1 ',contents)
+		contents = AMP_AT_END.sub('&amp;',contents)
+	return contents.replace(">","&gt;").replace("<","&lt;")
+
+
+def iter_export_parts(doc, project, user):
+	conn = get_connection()
+	doc_key = (doc,project,user)
+	edus = conn.execute("SELECT CAST(id AS text), CAST(parent AS text), contents, relname FROM rst_nodes WHERE kind='edu' and doc=? and project=? and user=? ORDER BY id", doc_key)
+	groups = conn.execute("SELECT CAST(id AS text), CAST(parent AS text), kind, relname FROM rst_nodes WHERE kind!='edu' and doc=? and project=? and user=? ORDER BY id", doc_key)
+	signals = conn.execute("SELECT CAST(source AS text), type, subtype, tokens FROM rst_signals WHERE doc=? and project=? and user=? ORDER BY source, rowid", doc_key)
+	return iter_rs3_parts(get_relation_catalog(doc,project).rels, edus, groups, signals)
+
+
+def iter_rs3_parts(rels, edus, groups, signals):
+	"""Generates the rs3 XML for relation, EDU, group and signal rows, which may be lists or open cursors"""
+	yield '''<rst>
 \t<header>
 \t\t<relations>
 '''
-	for rel in rels:
-		relname_string = re.sub(r'_[rm]$','',rel[0])
-		rst_out += '\t\t\t<rel name="' + relname_string + '" type="' + rel[1] + '"/>\n'
+	for relname, reltype in rels:
+		yield '\t\t\t<rel name="' + REL_SUFFIX.sub('',relname) + '" type="' + reltype + '"/>\n'
 
-	rst_out += '''\t\t</relations>
+	yield '''\t\t</relations>
 \t</header>
 \t<body>
 '''
-	for node in nodes:
-		if node[5] == "edu":
-			if len(node[7]) > 0:
-				relname_string = re.sub(r'_[rm]$','',node[7])
-			else:
-				relname_string = ""
-			if node[3] == "0":
-				parent_string = ""
-				relname_string = ""
-			else:
-				parent_string = 'parent="'+node[3]+'" '
-			if len(relname_string) > 0:
-				relname_string = 'relname="' + relname_string+'"'
-			contents = node[6]
-			# Handle XML escapes
-			contents = re.sub(r'&([^ ;]*) ',r'&amp;\1 ',contents)
-			contents = re.sub(r'&$','&amp;',contents)
-			contents = contents.replace(">","&gt;").replace("<","&lt;")
-			rst_out += '\t\t<segment id="'+node[0]+'" '+ parent_string + relname_string+'>'+contents+'</segment>\n'
-	for node in nodes:
-		if node[5] != "edu":
-			if len(node[7]):
-				relname_string = re.sub(r'_[rm]$','',node[7])
-				relname_string = 'relname="'+relname_string+'"'
-			else:
-				relname_string = ""
-			if node[3] == "0":
-				parent_string = ""
-				relname_string = ""
-			else:
-				parent_string = 'parent="'+node[3]+'"'
-			if len(relname_string) > 0:
-				parent_string += ' '
-			rst_out += '\t\t<group id="'+node[0]+'" type="'+node[5]+'" ' + parent_string + relname_string+'/>\n'
-
-	if len(signals) > 0:
-		rst_out += "\t\t<signals>\n"
-		for signal in signals:
+	for node_id, parent, contents, relname in edus:
+		if len(relname) > 0:
+			relname_string = REL_SUFFIX.sub('',relname)
+		else:
+			relname_string = ""
+		if parent == "0":
+			parent_string = ""
+			relname_string = ""
+		else:
+			parent_string = 'parent="'+parent+'" '
+		if len(relname_string) > 0:
+			relname_string = 'relname="' + relname_string+'"'
+		yield '\t\t<segment id="'+node_id+'" '+ parent_string + relname_string+'>'+escape_contents(contents)+'</segment>\n'
+
+	for node_id, parent, kind, relname in groups:
+		if len(relname):
+			relname_string = 'relname="'+REL_SUFFIX.sub('',relname)+'"'
+		else:
+			relname_string = ""
+		if parent == "0":
+			parent_string = ""
+			relname_string = ""
+		else:
+			parent_string = 'parent="'+parent+'"'
+		if len(relname_string) > 0:
+			parent_string += ' '
+		yield '\t\t<group id="'+node_id+'" type="'+kind+'" ' + parent_string + relname_string+'/>\n'
+
+	signals = iter(signals)
+	signal = next(signals, None)
+	if signal is not None:
+		yield "\t\t<signals>\n"
+		while signal is not None:
 			source, signal_type, signal_subtype, tokens = signal
-			rst_out += '\t\t\t<signal source="' + source + '" type="' + signal_type + '" subtype="' + signal_subtype + '" tokens="' + tokens + '"/>\n'
-		rst_out += "\t\t</signals>\n"
-	rst_out += '''\t</body>
+			yield '\t\t\t<signal source="' + source + '" type="' + signal_type + '" subtype="' + signal_subtype + '" tokens="' + tokens + '"/>\n'
+			signal = next(signals, None)
+		yield "\t\t</signals>\n"
+	yield '''\t</body>
 </rst>'''
-	return rst_out
 
 
 def delete_document(doc,project):
@@ -590,6 +917,7 @@ def delete_document(doc,project):
 	generic_query("DELETE FROM rst_relations WHERE doc=? and project=?",(doc,project))
 	generic_query("DELETE FROM rst_signals WHERE doc=? and project=?",(doc,project))
 	generic_query("DELETE FROM docs WHERE doc=? and project=?",(doc,project))
+	invalidate_cache()
 
 
 def delete_project(project):
@@ -598,6 +926,7 @@ def delete_project(project):
 	generic_query("DELETE FROM rst_signals WHERE project=?",(project,))
 	generic_query("DELETE FROM docs WHERE project=?",(project,))
 	generic_query("DELETE FROM projects WHERE project=?",(project,))
+	invalidate_cache()
 
 
 def insert_seg(token_num, doc, project, user):
@@ -609,7 +938,7 @@ def insert_seg(token_num, doc, project, user):
 	add_seg(str(int(seg_to_split)+1),parts[1].strip(),doc,project,user)
 
 def get_tok_map(doc,project,user):
-	rows = generic_query("SELECT id, contents FROM rst_nodes WHERE kind='edu' and doc=? and project=? and user=? ORDER BY CAST(id AS int)",(doc,project,user))
+	rows = generic_query("SELECT CAST(id AS text), contents FROM rst_nodes WHERE kind='edu' and doc=? and project=? and user=? ORDER BY id",(doc,project,user))
 	all_tokens = {}
 	token_counter = 0
 	for row in rows:
@@ -623,29 +952,32 @@ def get_tok_map(doc,project,user):
 
 
 def push_up(push_above_this_seg,doc,project,user):
-	ids_above_push = generic_query("SELECT id from rst_nodes WHERE CAST(id as int) > ? and doc=? and project=? and user=? ORDER BY CAST(id as int) DESC",(push_above_this_seg,doc,project,user))
-	for row in ids_above_push: #Do this row-wise to avoid sqlite unique constraint behavior
-		id_to_increment = row[0]
-		generic_query("UPDATE rst_nodes set id = CAST((CAST(id as int) + 1) as text) WHERE id=? and doc=? and project=? and user=?",(id_to_increment,doc,project,user))
-		generic_query("UPDATE rst_signals set source = CAST((CAST(source as int) + 1) as text) WHERE source=? and doc=? and project=? and user=?",(id_to_increment,doc,project,user))
-	generic_query("UPDATE rst_nodes set parent = CAST((CAST(parent as int) + 1) as text) WHERE CAST(parent as int)>? and doc=? and project=? and user=?",(push_above_this_seg,doc,project,user))
-	generic_query("UPDATE rst_nodes set left = left + 1 WHERE left>? and doc=? and project=? and user=?",(push_above_this_seg,doc,project,user))
-	generic_query("UPDATE rst_nodes set right = right + 1 WHERE right>? and doc=? and project=? and user=?",(push_above_this_seg,doc,project,user))
+	shift_node_ids(push_above_this_seg,1,doc,project,user)
 
 
 def push_down(push_above_this_seg,doc,project,user):
-	ids_above_push = generic_query("SELECT id from rst_nodes WHERE CAST(id as int) > ? and doc=? and project=? and user=? ORDER BY CAST(id as int)",(push_above_this_seg,doc,project,user))
-	for row in ids_above_push: #Do this row-wise to avoid sqlite unique constraint behavior
-		id_to_decrement = row[0]
-		generic_query("UPDATE rst_nodes set id = CAST((CAST(id as int) - 1) as text) WHERE id=? and doc=? and project=? and user=?",(id_to_decrement,doc,project,user))
-		generic_query("UPDATE rst_signals set source = CAST((CAST(source as int) - 1) as text) WHERE source=? and doc=? and project=? and user=?",(id_to_decrement,doc,project,user))
-	generic_query("UPDATE rst_nodes set parent = CAST((CAST(parent as int) - 1) as text) WHERE CAST(parent as int)>? and doc=? and project=? and user=?",(push_above_this_seg,doc,project,user))
-	generic_query("UPDATE rst_nodes set left = left - 1 WHERE left>? and doc=? and project=? and user=?",(push_above_this_seg,doc,project,user))
-	generic_query("UPDATE rst_nodes set right = right - 1 WHERE right>? and doc=? and project=? and user=?",(push_above_this_seg,doc,project,user))
+	shift_node_ids(push_above_this_seg,-1,doc,project,user)
+
+
+def shift_node_ids(shift_above_this_seg,delta,doc,project,user):
+	"""
+	Adds delta to all node IDs above a segment and to all references to them (parents, signal sources,
+	EDU spans) with a constant number of statements. IDs are first moved to negative placeholders, so that
+	no intermediate state collides with the UNIQUE constraints, which would silently replace rows.
+	"""
+	doc_key = (doc,project,user)
+	params = (delta,shift_above_this_seg,doc,project,user)
+	generic_query("UPDATE rst_nodes set id = -(id + ?) WHERE id > ? and doc=? and project=? and user=?",params)
+	generic_query("UPDATE rst_nodes set id = -id WHERE id < 0 and doc=? and project=? and user=?",doc_key)
+	generic_query("UPDATE rst_signals set source = -(source + ?) WHERE source > ? and doc=? and project=? and user=?",params)
+	generic_query("UPDATE rst_signals set source = -source WHERE source < 0 and doc=? and project=? and user=?",doc_key)
+	generic_query("UPDATE rst_nodes set parent = parent + ? WHERE parent > ? and doc=? and project=? and user=?",params)
+	generic_query("UPDATE rst_nodes set left = left + ? WHERE left>? and doc=? and project=? and user=?",params)
+	generic_query("UPDATE rst_nodes set right = right + ? WHERE right>? and doc=? and project=? and user=?",params)
 
 
 def get_split_text(tok_num,doc,project,user):
-	rows = generic_query("SELECT id, contents FROM rst_nodes WHERE kind='edu' and doc=? and project=? and user=? ORDER BY CAST(id AS int)",(doc,project,user))
+	rows = generic_query("SELECT CAST(id AS text), contents FROM rst_nodes WHERE kind='edu' and doc=? and project=? and user=? ORDER BY id",(doc,project,user))
 	token_counter = 0
 	do_return = False
 	final = []
@@ -710,31 +1042,27 @@ def merge_seg_forward(last_tok_num,doc,project,user):
 
 
 def copy_doc_to_user(doc, project, user):
-	doc_to_copy = generic_query("SELECT id, left, right, parent, depth, kind, contents, relname, doc, project FROM rst_nodes WHERE doc=? and project=? and user='_orig'", (doc,project))
-	copy = []
-	for row in doc_to_copy:
-		row += (user,)
-		copy += (row,)
-
-	dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
-	conn = sqlite3.connect(dbpath)
-	cur = conn.cursor()
-	cur.executemany('INSERT INTO rst_nodes VALUES(?,?,?,?,?,?,?,?,?,?,?)', copy)
-	cur.execute("INSERT INTO docs VALUES (?,?,?)", (doc,project,user))
-	conn.commit()
+	# Runs as one transaction, or as part of the caller's transaction if one is open
+	with transaction():
+		doc_to_copy = generic_query("SELECT id, left, right, parent, depth, kind, contents, relname, doc, project FROM rst_nodes WHERE doc=? and project=? and user='_orig'", (doc,project))
+		copy = []
+		for row in doc_to_copy:
+			row += (user,)
+			copy += (row,)
+
+		conn = get_connection()
+		cur = conn.cursor()
+		cur.executemany('INSERT INTO rst_nodes VALUES(?,?,?,?,?,?,?,?,?,?,?)', copy)
+		cur.execute("INSERT INTO docs (doc, project, user, modified) VALUES (?,?,?,?)", (doc,project,user,time.time()))
 
-	signals_to_copy = generic_query("SELECT source, type, subtype, tokens, doc, project FROM rst_signals WHERE doc=? and project=? and user='_orig'", (doc,project))
-	copy = []
-	for row in signals_to_copy:
-		row += (user,)
-		copy += (row,)
+		signals_to_copy = generic_query("SELECT source, type, subtype, tokens, doc, project FROM rst_signals WHERE doc=? and project=? and user='_orig'", (doc,project))
+		copy = []
+		for row in signals_to_copy:
+			row += (user,)
+			copy += (row,)
 
-	if len(copy)>0:
-		dbpath = os.path.dirname(os.path.realpath(__file__)) + os.sep +".."+os.sep+"rstweb.db"
-		conn = sqlite3.connect(dbpath)
-		cur = conn.cursor()
-		cur.executemany('INSERT INTO rst_signals VALUES(?,?,?,?,?,?,?)', copy)
-		conn.commit()
+		if len(copy)>0:
+			cur.executemany('INSERT INTO rst_signals VALUES(?,?,?,?,?,?,?)', copy)
 
 
 def get_assigned_users():
@@ -771,20 +1099,22 @@ def update_log(doc,project,user,logging,mode,time):
 
 
 def get_setting(setting):
-	schema = get_schema()
-	if schema > 1:
-		try:
-			return generic_query("SELECT svalue FROM settings where setting=?",(setting,))[0][0]
-		except IndexError:
-			return ""
+	cache = get_cached_settings()
+	if cache["schema"] > 1:
+		return cache["settings"].get(setting, "")
 	else:
 		return ""
 
 
+def setting_exists(setting):
+	return setting in get_cached_settings()["settings"]
+
+
 def save_setting(setting, svalue):
 	schema = get_schema()
 	if schema > 1:
 		generic_query("INSERT INTO settings VALUES (?,?)",(setting,svalue))
+		invalidate_cache()
 
 
 def set_guidelines_url(project,guideline_url):
@@ -839,9 +1169,9 @@ def update_signals(signals_blob, doc, project, user):
 
 def get_signals(doc, project, user):
 	schema = get_schema()
-	if schema < 6:
+	if schema < SCHEMA_VERSION:
 		update_schema()
-	return generic_query("SELECT source, type, subtype, tokens FROM rst_signals WHERE doc=? and project=? and user=?", (doc,project,user))
+	return generic_query("SELECT CAST(source AS text), type, subtype, tokens FROM rst_signals WHERE doc=? and project=? and user=?", (doc,project,user))
 
 def get_signal_types(doc, project):
 	return generic_query("SELECT majtype, subtype FROM rst_signal_types WHERE doc=? and project=?", (doc,project))
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Draws the RST tree of a document as SVG on the server, with the same layout as the structure editor,
+so that images of trees can be made without a browser. SVG images are converted to PNG with the
+optional cairosvg package.
+Author: Amir Zeldes
+"""
+
+from xml.sax.saxutils import escape, unescape
+
+from modules.rstweb_layout import get_anchors
+from modules.rstweb_sql import get_relation_catalog
+from modules.rstweb_tree import get_rel_kinds, load_nodes
+
+try:
+	import cairosvg
+except (ImportError, OSError):  # cairosvg raises OSError if the cairo library is missing
+	cairosvg = None
+
+RENDERER_VERSION = "1"  # Changes whenever the drawing changes, so that cached images are drawn again
+
+# Geometry of the structure editor, in pixels (see recalculate_depth in structure.js and rst.css)
+TOP_SPACING = 20
+LAYER_SPACING = 60
+EDU_WIDTH = 96
+NUM_WIDTH = 78  # Width of the box holding the span label of a group
+MARGIN = 3
+PADDING = 10  # Space around the tree in the image
+CURVINESS = 50  # Distance of the control points of relation arcs from their ends
+FONT_SIZE = 12
+LINE_HEIGHT = 18
+
+LINE_COLOR = "#000000"
+ARC_STYLE = 'stroke="#000000" stroke-opacity="0.5" stroke-width="2" fill="none"'
+NUM_COLOR = "#009933"
+REL_COLOR = "#ff0000"
+FONT = 'font-family="sans-serif" font-size="' + str(FONT_SIZE) + '"'
+
+# Approximate character widths in ems, used to wrap EDU texts
+NARROW_CHARS = set("fijlrtI.,;:'!|()[] ")
+WIDE_CHARS = set("mwMW@")
+
+
+def get_text_width(text):
+	width = 0.0
+	for char in text:
+		if char in NARROW_CHARS:
+			width += 0.35
+		elif char in WIDE_CHARS:
+			width += 0.9
+		elif char.isupper():
+			width += 0.7
+		else:
+			width += 0.6
+	return width * FONT_SIZE
+
+
+def wrap_text(text, width):
+	"""Breaks text into lines at spaces, as the EDU boxes of the editor do"""
+	lines = []
+	line = ""
+	for token in text.split(" "):
+		if line and get_text_width(line + " " + token) > width:
+			lines.append(line)
+			line = token
+		else:
+			line = line + " " + token if line else token
+	lines.append(line)
+	return lines
+
+
+def get_node_top(node):
+	return TOP_SPACING + LAYER_SPACING + int(node.depth) * LAYER_SPACING
+
+
+def get_source_point(node, pix_anchors):
+	"""Returns the point where connections leave a node, the top middle of its EDU box or span label"""
+	if node.kind == "edu":
+		return node.left * 100 - 100 + MARGIN + EDU_WIDTH / 2.0, get_node_top(node) + MARGIN
+	return pix_anchors[node.id] + NUM_WIDTH / 2.0, get_node_top(node) + 4
+
+
+def get_rel_label(relname, reltype):
+	return relname.replace("_m", "") if reltype == "multinuc" else relname.replace("_r", "")
+
+
+def draw_bar(out, left, top, width):
+	"""Draws the line on top of an EDU or group, with short whiskers at both ends"""
+	out.append('<path d="M%s,%s V%s H%s V%s" stroke="%s" stroke-width="3" fill="none"/>' %
+			   (left + 1.5, top + 6, top + 1.5, left + width - 1.5, top + 6, LINE_COLOR))
+
+
+def draw_label(out, x, y, text, color, bold=False):
+	weight = ' font-weight="bold"' if bold else ''
+	out.append('<text x="%s" y="%s" text-anchor="middle" fill="%s" %s%s>%s</text>' % (x, y, color, FONT, weight, escape(text)))
+
+
+def get_bezier_point(points, t):
+	(x0, y0), (x1, y1), (x2, y2), (x3, y3) = points
+	u = 1 - t
+	return (u**3 * x0 + 3 * u**2 * t * x1 + 3 * u * t**2 * x2 + t**3 * x3,
+			u**3 * y0 + 3 * u**2 * t * y1 + 3 * u * t**2 * y2 + t**3 * y3)
+
+
+def get_tree_svg(doc, project, user, scale=1):
+	"""Returns an SVG image of the RST tree of a document as a string, scale times the size of the tree in the editor"""
+	catalog = get_relation_catalog(doc, project)
+	return draw_tree_svg(load_nodes(doc, project, user, get_rel_kinds(catalog)), catalog.types, scale)
+
+
+def draw_tree_svg(nodes, rel_types, scale=1):
+	"""Draws laid out nodes (see rstweb_tree.py) as an SVG string, given a dictionary from relation names to types"""
+	pix_anchors = get_anchors(nodes)[1]
+	shown = [node for node in nodes.values() if node.left > 0]  # Nodes with left 0 cover no EDUs and are hidden
+
+	out = []
+	width = 0
+	height = 0
+	for node in sorted(shown, key=lambda node: int(node.id)):
+		top = get_node_top(node)
+		left = node.left * 100 - 100 + MARGIN
+		if node.kind == "edu":
+			draw_bar(out, left, top + MARGIN, EDU_WIDTH)
+			draw_label(out, left + EDU_WIDTH / 2.0, top + 20, str(node.left), NUM_COLOR, True)
+			bottom = top + 22
+			for line in wrap_text(unescape(node.text), EDU_WIDTH):  # EDU texts are stored with XML escapes
+				bottom += LINE_HEIGHT
+				draw_label(out, left + EDU_WIDTH / 2.0, bottom, line, LINE_COLOR)
+		else:
+			draw_bar(out, left, top + MARGIN, (node.right - node.left + 1) * 100 - 4)
+			draw_label(out, pix_anchors[node.id] + NUM_WIDTH / 2.0, top + 19, str(node.left) + "-" + str(node.right), NUM_COLOR, True)
+			bottom = top + 27
+		width = max(width, node.right * 100)
+		height = max(height, bottom + LINE_HEIGHT // 2)
+
+	for node in shown:
+		if node.parent == "0" or nodes[node.parent].left == 0:
+			continue
+		parent = nodes[node.parent]
+		source_x, source_y = get_source_point(node, pix_anchors)
+		target_x, target_y = get_source_point(parent, pix_anchors)
+		reltype = rel_types.get(node.relname, "span")
+		if node.relname == "span" or (parent.kind == "multinuc" and reltype == "multinuc"):
+			if parent.kind != "edu":
+				target_y += 23  # Straight lines end at the bottom of the span label
+			out.append('<line x1="%s" y1="%s" x2="%s" y2="%s" %s/>' % (source_x, source_y, target_x, target_y, ARC_STYLE))
+			if node.relname != "span":
+				label_x = source_x + (target_x - source_x) * 0.2
+				label_y = source_y + (target_y - source_y) * 0.2
+				draw_label(out, label_x, label_y + 4, get_rel_label(node.relname, reltype), REL_COLOR)
+		else:
+			points = [(source_x, source_y), (source_x, source_y - CURVINESS), (target_x, target_y - CURVINESS), (target_x, target_y)]
+			out.append('<path d="M%s,%s C%s,%s %s,%s %s,%s" %s/>' % (points[0] + points[1] + points[2] + points[3] + (ARC_STYLE,)))
+			out.append('<path d="M%s,%s l-6,-12 l12,0 z" fill="#000000" fill-opacity="0.5"/>' % (target_x, target_y))
+			label_x, label_y = get_bezier_point(points, 0.1)
+			draw_label(out, label_x, label_y - 4, get_rel_label(node.relname, reltype), REL_COLOR)
+
+	width += 2 * PADDING
+	height += 2 * PADDING
+	return ('<svg xmlns="http://www.w3.org/2000/svg" width="%s" height="%s" viewBox="0 0 %s %s">'
+			'<rect width="100%%" height="100%%" fill="#ffffff"/><g transform="translate(%s,%s)">%s</g></svg>'
+			% (width * scale, height * scale, width, height, PADDING, PADDING, "".join(out)))
+
+
+def can_render_png():
+	return cairosvg is not None
+
+
+def get_tree_png(doc, project, user, scale=2):
+	"""Returns a PNG image of the RST tree of a document as bytes, drawn at scale times the editor's size"""
+	return svg_to_png(get_tree_svg(doc, project, user, scale))
+
+
+def svg_to_png(svg):
+	if cairosvg is None:
+		raise RuntimeError("PNG images of RST trees require the cairosvg package")
+	return cairosvg.svg2png(bytestring=svg.encode("utf-8"))
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+HTML templates for the control pages (main_header.html, edit_bar.html, help.html and about.html).
+Templates are read and split at their **placeholder** markers once per process, and read again only
+when the template file changes, so filling in a template is a single join.
+Author: Amir Zeldes
+"""
+
+import codecs
+import os
+import re
+
+PLACEHOLDER = re.compile(r'\*\*([A-Za-z_]+)\*\*')
+SECTION_START = re.compile(r'<div id="([^"]+)"')
+CHUNK_SIZE = 65536  # Characters of HTML the editors collect before sending them on while a page is streamed
+
+_templates = {}  # Loaded templates by file name
+
+
+class Template:
+	def __init__(self, filename):
+		"""A template file split into literal text and placeholders, with the help sections it contains"""
+		self.filename = filename
+		self.mtime = os.path.getmtime(filename)
+		with codecs.open(filename, "r", "utf-8") as f:
+			self.text = f.read()
+		# Even positions hold literal text, odd positions placeholder names
+		self.parts = PLACEHOLDER.split(self.text)
+		# Each help section runs from its opening div to the first closing div
+		self.sections = {}
+		for match in SECTION_START.finditer(self.text):
+			end = self.text.find("</div>", match.start())
+			if end > -1 and match.group(1) not in self.sections:
+				self.sections[match.group(1)] = self.text[match.start():end + len("</div>")]
+
+	def render(self, **values):
+		"""
+		Fills in the placeholders in one pass. Placeholders without a value are kept as they are,
+		and values are not searched for placeholders again.
+		"""
+		parts = self.parts[:]
+		for i in range(1, len(parts), 2):
+			if parts[i] in values:
+				parts[i] = values[parts[i]]
+			else:
+				parts[i] = "**" + parts[i] + "**"
+		return "".join(parts)
+
+
+def get_template(filename):
+	"""Returns the Template for a file, loading it on first use and again whenever the file was modified"""
+	template = _templates.get(filename)
+	if template is None or os.path.getmtime(filename) != template.mtime:
+		template = Template(filename)
+		_templates[filename] = template
+	return template
+
+
+def render_template(filename, **values):
+	return get_template(filename).render(**values)
+
+
+def get_help_section(filename, section_id):
+	"""Returns the help div with the given id from a help template"""
+	return get_template(filename).sections[section_id]
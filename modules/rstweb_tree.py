@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+The laid out RST tree of a document as sent to script/structure.js by structure.py, either for the whole
+document or, for documents too long to render at once, for the nodes overlapping a window of EDUs.
+Author: Amir Zeldes
+"""
+
+from modules.rstweb_classes import NODE
+from modules.rstweb_layout import get_anchors, layout_nodes
+from modules.rstweb_reader import parse_rst
+from modules.rstweb_sql import get_rst_doc
+
+
+def get_rel_kinds(catalog):
+	"""Returns a dictionary from each relation name in a RelationCatalog to its kind, rst or multinuc"""
+	rel_kinds = {}
+	for rel in catalog.rels:
+		rel_kinds[rel[0]] = "multinuc" if rel[1] == "multinuc" else "rst"
+	return rel_kinds
+
+
+def load_nodes(doc, project, user, rel_kinds):
+	"""Reads the nodes of a document into a dictionary of NODE objects by ID and lays them out"""
+	return make_nodes(get_rst_doc(doc, project, user), rel_kinds)
+
+
+def make_nodes(rows, rel_kinds):
+	"""Makes laid out NODE objects by ID from rows of id, left, right, parent, depth, kind, contents and relname"""
+	nodes = {}
+	for row in rows:
+		if row[7] in rel_kinds:
+			relkind = rel_kinds[row[7]]
+		else:
+			relkind = "span"
+		if row[5] == "edu":
+			nodes[row[0]] = NODE(row[0],row[1],row[2],row[3],row[4],row[5],row[6],row[7],relkind)
+		else:
+			nodes[row[0]] = NODE(row[0],0,0,row[3],row[4],row[5],row[6],row[7],relkind)
+	layout_nodes(nodes, rel_kinds)
+	return nodes
+
+
+def parse_nodes(text):
+	"""
+	Reads the contents of an .rs3 file into laid out nodes without storing the document, and returns them together
+	with a dictionary from each relation name to its type. Returns an error message if the file cannot be read.
+	"""
+	rel_hash = {}
+	result = parse_rst(text, rel_hash)
+	if not isinstance(result, tuple):
+		return result
+	rows = [(node.id, node.left, node.right, node.parent, node.depth, node.kind, node.text, node.relname) for node in result[0].values()]
+	rel_kinds = dict((relname, "multinuc" if reltype == "multinuc" else "rst") for relname, reltype in rel_hash.items())
+	return make_nodes(rows, rel_kinds), rel_hash
+
+
+def get_tree_nodes(nodes, catalog, text_window=None):
+	"""
+	Returns the laid out nodes as lists [id, parent, kind, left, right, depth, anchor, relname, reltype, text, tokens],
+	where tokens is the number of tokens in the document before an EDU. EDUs outside of the (first, last) EDU range
+	in text_window have no text, and groups never do.
+	"""
+	pix_anchors = get_anchors(nodes)[1]
+	tokens_before = {}
+	token_count = 0
+	for node_id in sorted((node_id for node_id in nodes if nodes[node_id].kind == "edu"), key=int):
+		tokens_before[node_id] = token_count
+		token_count += len(nodes[node_id].text.split(" "))
+
+	tree_nodes = []
+	for key in nodes:
+		node = nodes[key]
+		if node.relname:
+			safe_relname = node.relname
+		else:
+			safe_relname = "none"
+		text = ""
+		if node.kind == "edu" and (text_window is None or in_window(node, text_window[0], text_window[1])):
+			text = node.text
+		tree_nodes.append([node.id, node.parent, node.kind, int(node.left), int(node.right), int(node.depth),
+						   pix_anchors[node.id], safe_relname, catalog.get_rel_type(node.relname), text,
+						   tokens_before.get(node.id, 0)])
+	return tree_nodes
+
+
+def in_window(node, first, last):
+	"""Checks whether a node covers any EDU from first to last; nodes covering no EDUs are in every window"""
+	return node.left == 0 or (node.left <= last and node.right >= first)
+
+
+def get_window_nodes(nodes, catalog, first, last):
+	"""Returns the tree nodes covering any EDU from first to last, with the texts of the EDUs in that range"""
+	return [tree_node for tree_node in get_tree_nodes(nodes, catalog, (first, last)) if in_window(nodes[tree_node[0]], first, last)]
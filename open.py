@@ -16,6 +16,7 @@ from modules.logintools import login
 from modules.configobj import ConfigObj
 from modules.pathutils import *
 from modules.rstweb_sql import *
+from modules.rstweb_templates import get_help_section, render_template
 
 def open_main(user, admin, mode, **kwargs):
 
@@ -28,17 +29,13 @@ def open_main(user, admin, mode, **kwargs):
 	
 	config = ConfigObj(userdir + 'config.ini')
 	templatedir = scriptpath + config['controltemplates'].replace("/",os.sep)
-	template = "main_header.html"
-	header = readfile(templatedir+template)
-	header = header.replace("**page_title**","Open a file for editing")
-	header = header.replace("**user**",user)
-	
+
 	if mode == "server":
 		cpout += "Content-Type: text/html\n\n\n"
-		header = header.replace("**logout_control**",'(<a href="logout.py">log out</a>)')
+		logout_control = '(<a href="logout.py">log out</a>)'
 	else:
-		header = header.replace("**logout_control**",'')
-	cpout += header
+		logout_control = ''
+	cpout += render_template(templatedir+"main_header.html",page_title="Open a file for editing",user=user,logout_control=logout_control)
 
 	if "current_doc" in theform:
 		current_doc = theform["current_doc"]
@@ -47,45 +44,28 @@ def open_main(user, admin, mode, **kwargs):
 		current_doc = ""
 		current_project = ""
 
-	edit_bar = "edit_bar.html"
-	edit_bar = readfile(templatedir+edit_bar)
-	edit_bar = edit_bar.replace("**doc**",current_doc)
-	edit_bar = edit_bar.replace("**project**",current_project)
-	edit_bar = edit_bar.replace("**structure_disabled**",'')
-	edit_bar = edit_bar.replace("**segment_disabled**",'')
-	edit_bar = edit_bar.replace("**relations_disabled**",'')
-	if mode == "server":
-		edit_bar = edit_bar.replace("**submit_target**",'structure.py')
-	else:
-		edit_bar = edit_bar.replace("**submit_target**",'structure')
-	edit_bar = edit_bar.replace("**action_type**",'')
-	edit_bar = edit_bar.replace("**serve_mode**",mode)
-	edit_bar = edit_bar.replace("**quickexp_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**screenshot_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**open_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**reset_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**save_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**undo_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**redo_disabled**",'disabled="disabled"')
+	edit_bar = render_template(templatedir+"edit_bar.html",
+		doc=current_doc,
+		project=current_project,
+		structure_disabled='',
+		segment_disabled='',
+		relations_disabled='',
+		submit_target='structure.py' if mode == "server" else 'structure',
+		action_type='',
+		serve_mode=mode,
+		quickexp_disabled='disabled="disabled"',
+		screenshot_disabled='disabled="disabled"',
+		open_disabled='disabled="disabled"',
+		reset_disabled='disabled="disabled"',
+		save_disabled='disabled="disabled"',
+		undo_disabled='disabled="disabled"',
+		redo_disabled='disabled="disabled"',
+		admin_disabled='disabled="disabled"' if admin == "0" else '')
 	edit_bar = edit_bar.replace('id="nav_open" class="nav_button"','id="nav_open" class="nav_button nav_button_inset"')
-	
-	
-	if admin == "0":
-		edit_bar = edit_bar.replace("**admin_disabled**",'disabled="disabled"')
-	else:
-		edit_bar = edit_bar.replace("**admin_disabled**",'')
-	
 	cpout += edit_bar
-	help = "help.html"
-	help = readfile(templatedir+help)
-	help_match = re.search(r'(<div id="help_open".*?</div>)',help,re.MULTILINE|re.DOTALL)
-	help = help_match.group(1)
-	cpout += help
-	
-	about = "about.html"
-	about = readfile(templatedir+about)
-	about = about.replace("**version**", _version.__version__)
-	cpout += about
+
+	cpout += get_help_section(templatedir+"help.html","help_open")
+	cpout += render_template(templatedir+"about.html",version=_version.__version__)
 
 	cpout += "<h2>Current Documents</h2>"
 	cpout += '<p>List of documents you are authorized to view:</p>'
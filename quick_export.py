@@ -10,12 +10,13 @@ Author: Amir Zeldes
 
 import cgitb
 import codecs
+import itertools
 import sys
 import cgi
 import os
 from modules.configobj import ConfigObj
 from modules.logintools import login
-from modules.rstweb_sql import get_export_string
+from modules.rstweb_sql import iter_export
 
 def quickexp_main(user, admin, mode, **kwargs):
 
@@ -43,19 +44,13 @@ def quickexp_main(user, admin, mode, **kwargs):
 		current_project = ""
 
 
-	cpout = ""
+	# The export is returned as a generator of chunks, which are written out as they are produced
 	if mode == "server":
-		cpout += "Content-Type: application/download\n"
-		cpout += "Content-Disposition: attachment; filename=" + current_doc + "\n\n"
+		headers = "Content-Type: application/download\n"
+		headers += "Content-Disposition: attachment; filename=" + current_doc + "\n\n"
+		return itertools.chain([headers], iter_export(current_doc,current_project,user))
 	else:
-		#cpout += "Content-Type: application/download\n\n\n"
-		pass
-
-	cpout += get_export_string(current_doc,current_project,user)
-	if mode == "server":
-		return cpout
-	else:
-		return bytes(cpout.encode('utf-8'))
+		return iter_export(current_doc,current_project,user,encoding='utf-8')
 
 # Main script when running from Apache
 def quickexp_main_server():
@@ -71,7 +66,9 @@ def quickexp_main_server():
 	for key in theform:
 		kwargs[key] = theform[key].value
 
-	print(quickexp_main(user, admin, 'server', **kwargs))
+	for chunk in quickexp_main(user, admin, 'server', **kwargs):
+		sys.stdout.write(chunk)
+	print("")
 
 
 scriptpath = os.path.dirname(os.path.realpath(__file__)) + os.sep
@@ -196,6 +196,20 @@ function admin(action){
             document.getElementById("export").value = "export";
 		    docs_to_export=build_from_select("doclist_select");
             document.getElementById("doclist").value = docs_to_export;
+            document.getElementById("sel_tab").value = "docs";
+			break;
+		case "export_zip":
+            if ($('#doclist_select').length == 0) {
+                alert("No documents available!");
+                return;
+            }
+            if (document.getElementById("doclist_select").value ==""){
+                alert("No documents selected for export!");
+                return;
+            }
+            document.getElementById("export").value = "zip";
+		    docs_to_export=build_from_select("doclist_select");
+            document.getElementById("doclist").value = docs_to_export;
             document.getElementById("sel_tab").value = "docs";
 			break;
 		case "create_user":
@@ -135,6 +135,22 @@ function do_quickexp(){
 }
 
 function do_screenshot(){
+    make_screenshot(function(url){
+        // use anchor to download it
+        var a = document.createElement('a');
+        var filename = document.getElementById('current_doc').value.replace(".rs3","");
+        a.setAttribute('href', url);
+        a.setAttribute('download', filename + ".png");
+        $(a).insertAfter($("#canvas"));
+        a.click();
+
+        $(a).remove();
+    });
+}
+
+// Draws the RST tree into a png image and passes its data URL to callback. The REST API
+// calls this in a headless browser to take screenshots (see modules/rstweb_browser.py)
+function make_screenshot(callback){
     // create a deep copy of the canvas (the root html element of the rst tree)
     // so that we can change and discard it once we're done without affecting
     // the real html elements
@@ -210,17 +226,8 @@ function do_screenshot(){
         });
 
         var url = canvas.toDataURL("image/png");
-
-        // use anchor to download it
-        var a = document.createElement('a');
-        var filename = document.getElementById('current_doc').value.replace(".rs3","");
-        a.setAttribute('href', url);
-        a.setAttribute('download', filename + ".png");
-        $(a).insertAfter($("#canvas"));
-        a.click();
-
-        $(a).remove();
         offscreenDiv.remove();
+        callback(url);
     });
 }
 
@@ -3,13 +3,15 @@
  * The initial layout is calculated by the corresponding Python
  * script and saving updates the database and re-renders. Links
  * between nodes are made with jsPlumb and updated via the function
- * recalculate_depth(nodes) which is fed from the data model stored
- * in the hidden input "data".
+ * recalculate_depth(nodes) which is fed from the data model in
+ * tree_data, loaded from the tree sent by structure.py.
  * Author: Amir Zeldes
 */
 
 
-//TODO: get_max_node_id(nodes) can be implemented without reference to nodes, by parsing hidden data model
+// Data model of the tree being edited: [parent, kind, left, relname, reltype] by node ID, where kind is the first letter
+// of the node's kind and left is only set for EDUs. Actions change it and parse_data() derives the layout from it.
+var tree_data = {};
 
 function act(action){
 
@@ -88,7 +90,7 @@ function act(action){
         new_parent_id = nodes["n"+params[0]].parent;
 
         //connect child of element to delete with parent of element to delete
-        update_data("n"+params[1],"n"+params[1]+","+new_parent_id+","+nodes["n"+params[1]].kind.substring(0,1)+","+nodes["n"+params[1]].left.toString()+","+rel_to_parent+","+get_rel_type(rel_to_parent));
+        update_data("n"+params[1],new_parent_id,rel_to_parent,get_rel_type(rel_to_parent));
 
         remove_node_data("n"+params[0]);
         detach_source("g"+params[0]);
@@ -147,17 +149,12 @@ function rst_node(id, parent, kind, left, relname, reltype){
 }
 
 function parse_data() {
-    var data_string = document.getElementById("data").value;
-    var node_array = data_string.split(";");
-    var i;
     var nodes = {};
     var node_args =[];
 
-    for (i = 0; i < node_array.length; i++) {
-        node_args = node_array[i].split(",");
-        node_id = node_args[0];
-        nodes[node_id] = {};
-        nodes[node_id] = new rst_node(node_id,node_args[1],node_args[2],node_args[3],node_args[4],node_args[5]);
+    for (node_id in tree_data) {
+        node_args = tree_data[node_id];
+        nodes[node_id] = new rst_node(node_id,node_args[0],node_args[1],node_args[2],node_args[3],node_args[4]);
     }
 
     //calculate RST effective depth
@@ -186,11 +183,11 @@ function update_parent(node_id,new_parent_id){
     append_undo("+qrl:"+node_id.replace("n","")+","+nodes[node_id].relname);
 
 	if (new_parent_id == "n0"){
-		update_data(node_id,node_id+","+new_parent_id+","+nodes[node_id].kind.substring(0,1)+","+nodes[node_id].left.toString()+","+get_def_rstrel()+",rst");
+		update_data(node_id,new_parent_id,get_def_rstrel(),"rst");
 	}
 	else
 	{
-	    update_data(node_id,node_id+","+new_parent_id+","+nodes[node_id].kind.substring(0,1)+","+nodes[node_id].left.toString()+","+nodes[node_id].relname+","+nodes[node_id].reltype);
+	    update_data(node_id,new_parent_id,nodes[node_id].relname,nodes[node_id].reltype);
 	}
 
     nodes = parse_data();
@@ -221,15 +218,16 @@ function update_parent(node_id,new_parent_id){
 
 }
 
-function update_data(node_id,new_data){
-    var re = new RegExp("(^|;)" + node_id + ",[^;]+","g");
-    document.getElementById("data").value = document.getElementById("data").value.replace(re,"$1" + new_data);
+function update_data(node_id,parent,relname,reltype){
+    var node_data = tree_data[node_id];
+    node_data[0] = parent;
+    node_data[3] = relname;
+    node_data[4] = reltype;
 }
 
 
 function remove_node_data(node_id){
-    var re = new RegExp("(^|;)" + node_id + ",[^;]+","g");
-    document.getElementById("data").value = document.getElementById("data").value.replace(re,"");
+    delete tree_data[node_id];
 }
 
 
@@ -291,13 +289,13 @@ function update_rel(node_id,new_rel,nodes,multinuc_insertion){
                 detach_source(element_id);
                 jsPlumb.connect({source: element_id,target:parent_element_id, overlays: [ ["Arrow" , { width:12, length:12, location:0.95 }], ["Custom", {create:function(component) {return make_relchooser(node_id,"rst",new_rel);},location:0.2,id:"customOverlay"}]]});
             }
-            update_data(node_id,node_id+","+nodes[node_id].parent+","+nodes[node_id].kind.substring(0,1)+","+nodes[node_id].left.toString()+","+new_rel+","+new_rel_type);
+            update_data(node_id,nodes[node_id].parent,new_rel,new_rel_type);
             if ($("#sel"+node_id.replace("n","")).length > 0){
                 document.getElementById('sel'+node_id.replace("n","")).value = new_rel;
             }
 		}
 		else { // New multinuc relation for a multinuc child, change all children to this relation
-            update_data(node_id,node_id+","+nodes[node_id].parent+","+nodes[node_id].kind.substring(0,1)+","+nodes[node_id].left.toString()+","+new_rel+","+new_rel_type);
+            update_data(node_id,nodes[node_id].parent,new_rel,new_rel_type);
             if (new_rel!="span") {
                 if (old_rel_type=="rst"){//this is an rst satellite that has been restored to multinuc child via undo
                     detach_source(element_id);
@@ -307,7 +305,7 @@ function update_rel(node_id,new_rel,nodes,multinuc_insertion){
                     children = get_children(parent_id,nodes);
                     for (var i=0; i<children.length; i++){
                         if (nodes[children[i]].reltype == "multinuc" && nodes[children[i]].id != node_id){
-                            update_data(children[i],children[i]+","+nodes[children[i]].parent+","+nodes[children[i]].kind.substring(0,1)+","+nodes[children[i]].left.toString()+","+new_rel+","+new_rel_type);
+                            update_data(children[i],nodes[children[i]].parent,new_rel,new_rel_type);
                             if ($("#sel"+children[i].replace("n","")).length > 0){
                                 document.getElementById('sel'+children[i].replace("n","")).value = new_rel;
                             }
@@ -318,7 +316,7 @@ function update_rel(node_id,new_rel,nodes,multinuc_insertion){
 		}
 	}
 	else{
-        update_data(node_id,node_id+","+nodes[node_id].parent+","+nodes[node_id].kind.substring(0,1)+","+nodes[node_id].left.toString()+","+new_rel+","+new_rel_type);
+        update_data(node_id,nodes[node_id].parent,new_rel,new_rel_type);
 	}
 }
 
@@ -387,12 +385,15 @@ function delete_node(node_id,nodes){
     {
         element_id = "edu"+node_id.replace("n","");
     }
-    if (node_exists(node_id) && document.getElementById(element_id).style.display!="none"){
+    var element = document.getElementById(element_id);
+    if (node_exists(node_id) && (element == null || element.style.display!="none")){ // Nodes outside of the rendered window have no element
         former_parent = nodes[node_id].parent;
         if (nodes[node_id].kind != "edu"){ //If it's not an EDU, it may be deleted
 
-            document.getElementById("lg"+node_id.replace("n","")).style.display = "none";
-            document.getElementById("g"+node_id.replace("n","")).style.display = "none";
+            if (element != null){
+                document.getElementById("lg"+node_id.replace("n","")).style.display = "none";
+                document.getElementById("g"+node_id.replace("n","")).style.display = "none";
+            }
 
             // If there are still any children, such as rst relations to a deleted span or multinuc, set their parent to n0
             old_children = get_children(node_id,nodes);
@@ -405,10 +406,12 @@ function delete_node(node_id,nodes){
             append_undo("+qup:"+node_id.replace("n","")+","+former_parent.replace("n",""));
             append_undo("+qnd:"+node_id.replace("n","")+","+nodes[node_id].left+","+nodes[node_id].kind+","+nodes[node_id].relname+","+nodes[node_id].reltype);
 
-            detach_source("g"+node_id.replace("n",""));
+            if (element != null){
+                detach_source("g"+node_id.replace("n",""));
+            }
 
             remove_node_data(node_id);
-            //Note: this node is now deleted in the serialized data model and not displayed, but these deletions are not recorded in the action protocol
+            //Note: this node is now deleted in the data model and not displayed, but these deletions are not recorded in the action protocol
         }
 
         nodes = parse_data();
@@ -473,6 +476,14 @@ function show_warnings(nodes){
 
 }
 
+function mark_warning(element_id, warning){
+    var element = document.getElementById(element_id);
+    if (element){ // Nodes outside of the rendered window are not marked
+        element.style.backgroundColor = "rgba(255, 255, 136, 0.5)";
+        element.title = warning;
+    }
+}
+
 function warn_empty_hierarchy(n_list){
 
     for (n in n_list){
@@ -485,8 +496,7 @@ function warn_empty_hierarchy(n_list){
                     child = node_children[child_idx];
                     if (count_children(child,n_list)==1 && n_list[child].kind=="span" && n_list[child].reltype=="span"){
                         child_element_id = get_element_id(child,n_list);
-                        document.getElementById(child_element_id).style.backgroundColor = "rgba(255, 255, 136, 0.5)";
-                        document.getElementById(child_element_id).title = "Warn: span with single span child (empty hierarchy)";
+                        mark_warning(child_element_id, "Warn: span with single span child (empty hierarchy)");
                     }
                 }
             }
@@ -494,16 +504,14 @@ function warn_empty_hierarchy(n_list){
                 child = node_children[0];
                 if (count_children(child,n_list)==0 && n_list[child].kind=="edu") { //span with EDU child that has no children
                     element_id = get_element_id(n,n_list);
-                    document.getElementById(element_id).style.backgroundColor = "rgba(255, 255, 136, 0.5)";
-                    document.getElementById(element_id).title = "Warn: span with single span child (empty hierarchy)";
+                    mark_warning(element_id, "Warn: span with single span child (empty hierarchy)");
                 }
             }
         }
         if (n_list[n].kind=="edu" && n_list[n].relname == "span"){
             if (node_children.length == 0){ // EDU without children but a span above
                     element_id = get_element_id(n,n_list);
-                    document.getElementById(element_id).style.backgroundColor = "rgba(255, 255, 136, 0.5)";
-                    document.getElementById(element_id).title = "Warn: EDU with span above but no satellites (empty hierarchy)";
+                    mark_warning(element_id, "Warn: EDU with span above but no satellites (empty hierarchy)");
             }
         }
     }
@@ -526,8 +534,7 @@ function warn_multiple_flat_rst(n_list) {
                 }
                 if (found_children > 1){
                     element_id = get_element_id(n,n_list);
-                    document.getElementById(element_id).style.backgroundColor = "rgba(255, 255, 136, 0.5)";
-                    document.getElementById(element_id).title = "Warn: multiple incoming RST relations (needs hierarchy)";
+                    mark_warning(element_id, "Warn: multiple incoming RST relations (needs hierarchy)");
                 }
             }
         }
@@ -545,8 +552,7 @@ function warn_mononuc(n_list){
                 child_id = get_multinuc_children(n,n_list)[0];
                 child = node_children[child_id];
                 element_id = get_element_id(n,n_list);
-                document.getElementById(element_id).style.backgroundColor = "rgba(255, 255, 136, 0.5)";
-                document.getElementById(element_id).title = "Warn: multinuc with single child";
+                mark_warning(element_id, "Warn: multinuc with single child");
             }
         }
     }
@@ -577,6 +583,9 @@ function recalculate_depth(nodes){
             element_id = "lg" + node_id.replace("n","");
             expected_width = (nodes[node_id].right - nodes[node_id].left + 1)*100 - 4;
         }
+        if (!document.getElementById(element_id)){ // Outside of the rendered window
+            continue;
+        }
         expected_top = top_spacing + layer_spacing + nodes[node_id].depth*layer_spacing;
         expected_left = nodes[node_id].left*100 - 100;
         nid = element_id.replace(/l?g|edu/g,"n");
@@ -599,9 +608,19 @@ function recalculate_depth(nodes){
         else{
             continue;
         }
+        parent_rendered = nodes[node_id].parent=="n0" || document.getElementById(parent_element_id) != null;
+        if (tree_window != null){ // Connections to parents outside of the rendered window are stubbed
+            if (parent_rendered){
+                $("#"+element_id.replace("l","")).removeClass("window_stub");
+            }
+            else{
+                detach_source(element_id.replace("l",""));
+                $("#"+element_id.replace("l","")).addClass("window_stub");
+            }
+        }
 
         //Check if a new parent was initiated programmatically and needs the connection to be rendered
-        if (nodes[node_id].parent!="n0" && nodes[node_id].left > 0){ //if left is 0 then this is a deleted/hidden node
+        if (nodes[node_id].parent!="n0" && nodes[node_id].left > 0 && parent_rendered){ //if left is 0 then this is a deleted/hidden node
             if (jsPlumb.getConnections({ source: element_id.replace("l",""), target: parent_element_id }).length <1){
                 detach_source(element_id.replace("l",""));
                 if (relname == "span"){
@@ -627,7 +646,7 @@ function recalculate_depth(nodes){
                     }
                     else if (nodes[node_id].relname != "none") //it's not a span, but the select is missing, reconnect
                     {
-                        if (nodes[node_id].parent!="n0"){
+                        if (nodes[node_id].parent!="n0" && parent_rendered){
                             detach_source(element_id);
                             if (parent_kind == "multinuc" && reltype=="multinuc"){
                                 jsPlumb.connect({source: element_id.replace("l",""),target:parent_element_id, connector:"Straight", anchors: ["Top","Bottom"], overlays: [ ["Custom", {create:function(component) {return make_relchooser(nid,"multi",relname);},location:0.2,id:"customOverlay"}]]});
@@ -865,7 +884,7 @@ function get_max_node_id(nodes){
 }
 
 function add_node(node_id,parent,node_kind_abbr,relname,reltype){
-    document.getElementById("data").value = document.getElementById("data").value + ";" + node_id + "," + parent +","+node_kind_abbr+",0,"+relname+","+reltype;
+    tree_data[node_id] = [parent, node_kind_abbr, 0, relname, reltype];
 }
 
 function create_node_div(id,depth,left,right,anchor){
@@ -937,6 +956,280 @@ jsPlumb.repaint("g"+id);
 
 }
 
+// Nodes in the tree sent by structure.py are [id, parent, kind, left, right, depth, anchor, relname, reltype, text, tokens],
+// where tokens is the number of tokens before an EDU. Documents with more than tree.window_size EDUs are rendered in
+// windows of that many EDUs around the visible part of the canvas, and the texts of EDUs are loaded as they are shown.
+var tree_buttons = [true, true]; // Whether span and multinuc buttons are used
+var tree_window = null; // First and last EDU currently rendered, or null if all nodes are rendered
+var window_size = 0;
+var window_loading = false;
+var window_timer = null;
+var edu_texts = {}; // Number of preceding tokens and text of each EDU loaded so far, by node ID
+
+function render_tree(tree){
+
+    tree_buttons = [tree.span_buttons, tree.multinuc_buttons];
+    load_tree_data(tree);
+    var nodes = get_tree_model(tree.nodes);
+    if (tree.window_size > 0){
+        window_size = tree.window_size;
+        tree_window = [1, window_size];
+        document.getElementById("inner_canvas").style.minWidth = (tree.edu_count * 100) + "px";
+        document.getElementById("canvas").addEventListener("scroll", schedule_window_update);
+    }
+    document.getElementById("inner_canvas").insertAdjacentHTML("beforeend", get_nodes_html(nodes, {}));
+
+}
+
+// Returns tree nodes in the format of parse_data() and keeps the texts of EDUs that have them
+function get_tree_model(tree_nodes){
+
+    var nodes = {};
+    for (var i = 0; i < tree_nodes.length; i++) {
+        var node = tree_nodes[i];
+        var node_id = "n" + node[0];
+        nodes[node_id] = {id: node_id, parent: "n" + node[1], kind: node[2], left: node[3], right: node[4],
+                          depth: node[5], anchor: node[6], relname: node[7], reltype: node[8]};
+        if (node[2] == "edu" && node[9] != ""){
+            edu_texts[node_id] = [node[10], node[9]];
+        }
+    }
+    return nodes;
+
+}
+
+function in_window(node, first, last){
+    return node.left == 0 || (node.left <= last && node.right >= first);
+}
+
+function get_source_id(node_id, nodes){
+    return (nodes[node_id].kind == "edu" ? "edu" : "g") + node_id.replace("n","");
+}
+
+// Returns the HTML of all nodes in the current window which are not rendered yet, and adds their IDs to added
+function get_nodes_html(nodes, added){
+
+    var top_spacing = 20;
+    var layer_spacing = 60;
+    var node_ids = [];
+    for (var node_id in nodes){
+        node_ids.push(node_id);
+    }
+    node_ids.sort(function(a, b) {return parseInt(a.replace("n","")) - parseInt(b.replace("n",""));});
+    var html = [];
+    for (var i = 0; i < node_ids.length; i++) {
+        var node = nodes[node_ids[i]];
+        if (tree_window != null && (!in_window(node, tree_window[0], tree_window[1]) || document.getElementById(get_source_id(node.id, nodes)))){
+            continue;
+        }
+        if (node.kind == "edu" && !(node.id in edu_texts)){
+            continue;
+        }
+        added[node.id] = true;
+        var id = node.id.replace("n","");
+        var left = node.left;
+        var right = node.right;
+        var top = top_spacing + layer_spacing + node.depth*layer_spacing;
+        var span_button = tree_buttons[0] ? '<td><button id="aspan_'+ id+'" title="add span above" class="minibtn" onclick="act('+"'sp:"+id+"'"+');">T</button></td>' : '';
+        var multinuc_button = tree_buttons[1] ? '<tr><td><button id="amulti_'+ id+'" title="add multinuc above" class="minibtn" onclick="act('+"'mn:"+id+"'"+');">Λ</button></td></tr>' : '';
+        if (node.kind != "edu"){
+            var g_wid = (right - left + 1)*100 - 4;
+            html.push('<div id="lg'+ id +'" class="group" style="left: ' + (left*100 - 100) + '; width: ' + g_wid + '; top:'+ top +'px; z-index:1"><div id="wsk'+id+'" class="whisker" style="width:'+g_wid+';"></div></div>');
+            html.push('<div id="g'+ id +'" class="num_cont" style="position: absolute; left:' + node.anchor +'px; top:'+ (4 + top) +'px; z-index:'+ (200-(right-left)) +'"><table class="btn_tb"><tr><td rowspan="2"><button id="unlink_'+ id+'"  title="unlink this node" class="minibtn" onclick="act('+"'up:"+id+",0'"+');">X</button></td><td rowspan="2"><span class="num_id">'+left+"-"+right+'</span></td>');
+            html.push(span_button + '</tr>' + multinuc_button + '</table></div><br/>');
+        }
+        else{
+            html.push('<div id="edu'+id+'" class="edu" title="'+id+'" style="left:'+(parseInt(id)*100 - 100) +'; top:'+top+'; width: 96px">');
+            html.push('<div id="wsk'+id+'" class="whisker" style="width:96px;"></div><div class="edu_num_cont"><table class="btn_tb"><tr><td rowspan="2"><button id="unlink_'+ id+'" title="unlink this node" class="minibtn" onclick="act('+"'up:"+id+",0'"+');">X</button></td><td rowspan="2"><span class="num_id">&nbsp;'+left+'&nbsp;</span></td>');
+            html.push(span_button + '</tr>' + multinuc_button + '</table></div>');
+            var tok_count = edu_texts[node.id][0];
+            var tokens = edu_texts[node.id][1].split(" ");
+            for (var j = 0; j < tokens.length; j++) {
+                tok_count++;
+                html.push('<span id="tok' + tok_count + '" class="tok">' + tokens[j] + '</span> ');
+            }
+            html.push('</div>');
+        }
+    }
+    return html.join("");
+
+}
+
+// Fills the data model read by parse_data() from the tree
+function load_tree_data(tree){
+
+    tree_data = {};
+    for (var i = 0; i < tree.nodes.length; i++) {
+        var node = tree.nodes[i];
+        var left = node[2] == "edu" ? node[3] : 0;
+        tree_data["n" + node[0]] = ["n" + node[1], node[2].substring(0,1), left, node[7], node[8]];
+    }
+
+}
+
+function connect_tree(tree){
+
+    connect_nodes(get_tree_model(tree.nodes), null);
+    if (tree_window != null){
+        var scroll_left = sessionStorage.getItem(get_scroll_key());
+        if (scroll_left != null){ // Return to the part of the document shown before the page was reloaded
+            document.getElementById("canvas").scrollLeft = parseInt(scroll_left);
+        }
+    }
+
+}
+
+// Makes connections for the rendered nodes in added, or for all rendered nodes if added is null. Nodes attached
+// to a parent outside the current window get a stub instead of a connection.
+function connect_nodes(nodes, added){
+
+    var node_id;
+    for (node_id in nodes){
+        var element_id = get_source_id(node_id, nodes);
+        if ((added == null || node_id in added) && document.getElementById(element_id)){
+            jsPlumb.makeSource(element_id, {anchor: "Top", filter: ".num_id", allowLoopback:false});
+            jsPlumb.makeTarget(element_id, {anchor: "Top", filter: ".num_id", allowLoopback:false});
+        }
+    }
+    for (node_id in nodes){
+        var node = nodes[node_id];
+        if (node.parent == "n0" || !(node.parent in nodes)){
+            continue;
+        }
+        var source_id = get_source_id(node_id, nodes);
+        if (!document.getElementById(source_id)){
+            continue;
+        }
+        if (tree_window != null){
+            if (!document.getElementById(get_source_id(node.parent, nodes))){
+                $("#" + source_id).addClass("window_stub");
+                continue;
+            }
+            $("#" + source_id).removeClass("window_stub");
+        }
+        if (added == null || node_id in added || node.parent in added){
+            connect_node(node_id.replace("n",""), node.kind, node.parent.replace("n",""), nodes[node.parent].kind, node.relname, node.reltype);
+        }
+    }
+
+}
+
+function get_scroll_key(){
+    return "rstweb_scroll:" + document.getElementById("current_project").value + ":" + document.getElementById("current_doc").value;
+}
+
+function schedule_window_update(){
+
+    sessionStorage.setItem(get_scroll_key(), document.getElementById("canvas").scrollLeft);
+    if (window_timer == null){
+        window_timer = setTimeout(function(){window_timer = null; update_window();}, 100);
+    }
+
+}
+
+// Renders a new window around the visible EDUs once the canvas is scrolled close to the edge of the current one
+function update_window(){
+
+    if (window_loading){ // The window is updated again once loading has finished
+        return;
+    }
+    var canvas = document.getElementById("canvas");
+    var first_visible = Math.max(1, Math.floor(canvas.scrollLeft / 100) + 1);
+    var last_visible = Math.floor((canvas.scrollLeft + canvas.clientWidth) / 100) + 1;
+    if (first_visible >= tree_window[0] && last_visible <= tree_window[1]){
+        return;
+    }
+    var margin = Math.max(0, Math.floor((window_size - (last_visible - first_visible + 1)) / 2));
+    var first = Math.max(1, first_visible - margin);
+    var last = Math.max(first + window_size - 1, last_visible);
+    window_loading = true;
+    load_edu_texts(first, last, function(){
+        show_window(first, last);
+        window_loading = false;
+        update_window();
+    });
+
+}
+
+function load_edu_texts(first, last, callback){
+
+    var nodes = parse_data();
+    var missing = false;
+    for (var node_id in nodes){
+        if (nodes[node_id].kind == "edu" && in_window(nodes[node_id], first, last) && !(node_id in edu_texts)){
+            missing = true;
+            break;
+        }
+    }
+    if (!missing){
+        callback();
+        return;
+    }
+    var params = {current_doc: document.getElementById("current_doc").value,
+                  current_project: document.getElementById("current_project").value,
+                  edus: first + "-" + last};
+    $.getJSON(document.getElementById("edit_form").getAttribute("action"), params, function(data){
+        get_tree_model(data.nodes);
+        callback();
+    }).fail(function(){
+        window_loading = false;
+    });
+
+}
+
+function show_window(first, last){
+
+    var nodes = parse_data();
+    jsPlumb.setSuspendDrawing(true);
+    for (var node_id in nodes){
+        if (!in_window(nodes[node_id], first, last)){
+            remove_node_elements(node_id, nodes);
+        }
+    }
+    tree_window = [first, last];
+    var added = {};
+    document.getElementById("inner_canvas").insertAdjacentHTML("beforeend", get_nodes_html(nodes, added));
+    connect_nodes(nodes, added);
+    jsPlumb.setSuspendDrawing(false, true);
+    show_warnings(nodes);
+
+}
+
+function remove_node_elements(node_id, nodes){
+
+    var source_id = get_source_id(node_id, nodes);
+    var element = document.getElementById(source_id);
+    if (!element){
+        return;
+    }
+    if (element.nextSibling && element.nextSibling.tagName == "BR"){
+        element.parentNode.removeChild(element.nextSibling);
+    }
+    jsPlumb.unmakeSource(source_id);
+    jsPlumb.unmakeTarget(source_id);
+    jsPlumb.remove(source_id);
+    if (nodes[node_id].kind != "edu"){
+        jsPlumb.remove("l" + source_id);
+    }
+
+}
+
+function connect_node(id, kind, parent, parent_kind, relname, reltype){
+
+    var node_id_str = (kind == "edu" ? "edu" : "g") + id;
+    var parent_id_str = (parent_kind == "edu" ? "edu" : "g") + parent;
+    if (relname == "span"){
+        jsPlumb.connect({source:node_id_str,target:parent_id_str, connector:"Straight", anchors: ["Top","Bottom"]});
+    }
+    else if (parent_kind == "multinuc" && reltype == "multinuc"){
+        jsPlumb.connect({source:node_id_str,target:parent_id_str, connector:"Straight", anchors: ["Top","Bottom"], overlays: [ ["Custom", {create:function(component) {return make_relchooser(id,"multi",relname);},location:0.2,id:"customOverlay"}]]});
+    }
+    else{
+        jsPlumb.connect({source:node_id_str,target:parent_id_str, overlays: [ ["Arrow" , { width:12, length:12, location:0.95 }],["Custom", {create:function(component) {return make_relchooser(id,"rst",relname);},location:0.1,id:"customOverlay"}]]});
+    }
+
+}
+
 function get_multinuc_children_lr(multinuc_id,nodes){
     right = 0;
     left = 10000;
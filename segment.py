@@ -12,8 +12,12 @@ Author: Amir Zeldes
 import _version
 import cgitb
 from modules.rstweb_sql import *
+from modules.rstweb_cache import get_render_key, iter_cached_page, send_cgi_etag
+from modules.rstweb_templates import CHUNK_SIZE, get_help_section, render_template
 import codecs
 import sys
+import sqlite3
+import traceback
 import re
 from modules.configobj import ConfigObj
 from modules.pathutils import *
@@ -23,6 +27,32 @@ from modules.logintools import login
 import datetime
 
 def segment_main(user, admin, mode, **kwargs):
+	return "".join(iter_segment(user, admin, mode, prepare_segment(user, admin, mode, kwargs), **kwargs))
+
+
+def prepare_segment(user, admin, mode, theform):
+	"""
+	Removes floating non-terminal nodes from the requested document before it is rendered (e.g. due to browsing back and
+	re-submitting old actions or other data corruption), and returns the render cache key of its page, or None
+	"""
+	if "current_doc" in theform and "current_project" in theform:
+		clean_floating_nodes(theform["current_doc"], theform["current_project"], user)
+	return get_render_key("segment", user, admin, mode, theform)
+
+
+def iter_segment(user, admin, mode, render_key, **kwargs):
+	"""
+	Returns the segmentation editor page as an iterator of HTML chunks, which can be sent while the rest is rendered.
+	Unchanged documents are served from the render cache as they were last rendered. render_key is the
+	key returned by prepare_segment, which must run first.
+	"""
+	chunks = generate_segment(user, admin, mode, **kwargs)
+	if mode != "server":
+		chunks = (chunk.replace(".py","") for chunk in chunks)
+	return iter_cached_page(render_key, chunks)
+
+
+def generate_segment(user, admin, mode, **kwargs):
 
 	cpout = ""
 	theform = kwargs
@@ -37,24 +67,14 @@ def segment_main(user, admin, mode, **kwargs):
 
 	config = ConfigObj(userdir + 'config.ini')
 	templatedir = scriptpath + config['controltemplates'].replace("/",os.sep)
-	template = "main_header.html"
-	header = readfile(templatedir+template)
-	header = header.replace("**page_title**","Segmentation editor")
-	header = header.replace("**user**",user)
-	header = header.replace("**open_disabled**",'')
-
-	if admin == "0":
-		header = header.replace("**admin_disabled**",'disabled="disabled"')
-	else:
-		header = header.replace("**admin_disabled**",'')
 
 	cpout = ""
 	if mode == "server":
 		cpout += "Content-Type: text/html\n\n\n"
-		header = header.replace("**logout_control**",'(<a href="logout.py">log out</a>)')
+		logout_control = '(<a href="logout.py">log out</a>)'
 	else:
-		header = header.replace("**logout_control**",'')
-	cpout += header
+		logout_control = ''
+	cpout += render_template(templatedir+"main_header.html",page_title="Segmentation editor",user=user,logout_control=logout_control)
 
 
 	if "current_doc" in theform:
@@ -67,44 +87,31 @@ def segment_main(user, admin, mode, **kwargs):
 		current_guidelines = ""
 
 
-	edit_bar = "edit_bar.html"
-	edit_bar = readfile(templatedir+edit_bar)
-	edit_bar = edit_bar.replace("**doc**",current_doc)
-	edit_bar = edit_bar.replace("**project**",current_project)
-	edit_bar = edit_bar.replace("**structure_disabled**",'')
-	edit_bar = edit_bar.replace("**quickexp_disabled**",'')
-	edit_bar = edit_bar.replace("**screenshot_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**save_disabled**",'')
-	edit_bar = edit_bar.replace("**reset_disabled**",'')
-	edit_bar = edit_bar.replace("**segment_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**submit_target**",'segment.py')
-	edit_bar = edit_bar.replace("**action_type**",'seg_action')
-	edit_bar = edit_bar.replace("**current_guidelines**",current_guidelines)
-	edit_bar = edit_bar.replace("**serve_mode**",mode)
-	edit_bar = edit_bar.replace("**open_disabled**",'')
+	edit_bar = render_template(templatedir+"edit_bar.html",
+		doc=current_doc,
+		project=current_project,
+		structure_disabled='',
+		quickexp_disabled='',
+		screenshot_disabled='disabled="disabled"',
+		save_disabled='',
+		reset_disabled='',
+		segment_disabled='disabled="disabled"',
+		submit_target='segment.py',
+		action_type='seg_action',
+		current_guidelines=current_guidelines,
+		serve_mode=mode,
+		open_disabled='',
+		admin_disabled='disabled="disabled"' if admin == "0" else '')
 	edit_bar = edit_bar.replace('id="nav_segment" class="nav_button"','id="nav_segment" class="nav_button nav_button_inset"')
-
-	if admin == "0":
-		edit_bar = edit_bar.replace("**admin_disabled**",'disabled="disabled"')
-	else:
-		edit_bar = edit_bar.replace("**admin_disabled**",'')
-
 	cpout += edit_bar
 
-	help = "help.html"
-	help = readfile(templatedir+help)
-	help_match = re.search(r'(<div.*?help_seg.*?</div>)',help,re.MULTILINE|re.DOTALL)
-	help = help_match.group(1)
-	cpout += help
-
-	about = "about.html"
-	about = readfile(templatedir+about)
-	about = about.replace("**version**", _version.__version__)
-	cpout += about
+	cpout += get_help_section(templatedir+"help.html","help_seg")
+	cpout += render_template(templatedir+"about.html",version=_version.__version__)
 
 	if current_doc =="":
 		cpout += '<p class="warn">No file found - please select a file to open</p>'
-		return cpout
+		yield cpout
+		return
 
 	cpout += '<input id="undo_log" type="hidden" value=""/>'
 	cpout += '<input id="redo_log" type="hidden" value=""/>'
@@ -113,16 +120,13 @@ def segment_main(user, admin, mode, **kwargs):
 	cpout += '''<div class="canvas">
 	<div id="inner_canvas">'''
 
-	# Remove floating non-terminal nodes if found
-	# (e.g. due to browsing back and re-submitting old actions or other data corruption)
-	clean_floating_nodes(current_doc, current_project, user)
-
 	timestamp = ""
 	if "timestamp" in theform:
 		if len(theform["timestamp"]) > 1:
 			timestamp = theform["timestamp"]
 
 	refresh = check_refresh(user, timestamp)
+	save_stats = None  # Number of saved actions and commit time in seconds, if any actions were submitted
 
 	if "reset" in theform or user=="demo":
 		if len(theform["reset"]) > 1 or user=="demo":
@@ -140,39 +144,68 @@ def segment_main(user, admin, mode, **kwargs):
 			action_log = theform["seg_action"]
 			if len(action_log) > 0:
 				actions = action_log.split(";")
-				set_timestamp(user,timestamp)
-				for action in actions:
-					action_type = action.split(":")[0]
-					action_params = action.split(":")[1]
-					if action_type =="ins":
-						insert_seg(int(action_params.replace("tok","")),current_doc,current_project,user)
-					elif action_type =="del":
-						merge_seg_forward(int(action_params.replace("tok","")),current_doc,current_project,user)
+				applied = 0
+				try:
+					# Apply the whole action log atomically: either all actions are saved or none are
+					with transaction() as tx:
+						set_timestamp(user,timestamp)
+						for action in actions:
+							action_type = action.split(":")[0]
+							action_params = action.split(":")[1]
+							if action_type =="ins":
+								insert_seg(int(action_params.replace("tok","")),current_doc,current_project,user)
+								applied += 1
+							elif action_type =="del":
+								merge_seg_forward(int(action_params.replace("tok","")),current_doc,current_project,user)
+								applied += 1
+						if applied > 0:
+							touch_doc(current_doc,current_project,user)
+					save_stats = (applied, tx["commit_time"])
+				except (sqlite3.Error, ValueError, IndexError, KeyError):  # Database failures and malformed actions
+					sys.stderr.write("Could not save actions for " + current_doc + " in " + current_project + ":\n" + traceback.format_exc())
+					cpout += '<script>alert("Your changes could not be saved and have been discarded.");</script>\n'
 
 	segs={}
 
 
 	rows = get_rst_doc(current_doc,current_project,user)
+	for row in rows:
+		if row[5] == "edu":
+			segs[int(row[0])] = SEGMENT(row[0],row[6])
+	segs = collections.OrderedDict(sorted(segs.items()))
+
+	# Check that each segment boundary follows the last token of the preceding EDU before the page is sent
+	del_token_to_seg = {}
+	seg_counter = 0
+	tok_counter = 0
+	for seg_id in segs:
+		seg_counter += 1
+		if seg_counter > 1:
+			del_token_to_seg[tok_counter] = seg_counter
+		tok_counter += len(segs[seg_id].tokens)
+
+	tok_seg_map = get_tok_map(current_doc,current_project,user)
+	incorrect_segs = [token_key for token_key in del_token_to_seg if int(tok_seg_map[token_key])+1 != del_token_to_seg[token_key]]
+	warning = ''
+	if len(incorrect_segs) > 0:
+		warning = '<p class="warn">Attention! Empty segments detected - markup may be broken! Please contact your administrator.</p>'
 
 	if current_guidelines != "":
 		cpout += '<script>enable_guidelines();</script>'
 
 	cpout += '\t<script src="script/segment.js"></script>'
 	cpout += '<h2>Edit segmentation</h2>'
-	cpout += '**warning**'
+	cpout += warning
 	cpout += '\t<div id="control">'
 	cpout += '\t<p>Document: <b>'+current_doc+'</b> (project: <i>'+current_project+'</i>)</p>'
+	if save_stats is not None:
+		cpout += '<input id="actions_applied" type="hidden" value="'+str(save_stats[0])+'"/>'
+		cpout += '<input id="commit_ms" type="hidden" value="'+str(round(save_stats[1]*1000,1))+'"/>'
 	cpout += '\t<div id="segment_canvas">'
 
-	for row in rows:
-		if row[5] == "edu":
-			segs[int(row[0])] = SEGMENT(row[0],row[6])
-
 	seg_counter = 0
 	tok_counter = 0
 
-	segs = collections.OrderedDict(sorted(segs.items()))
-	del_token_to_seg = {}
 	first_seg = True
 	for seg_id in segs:
 		first_tok = True
@@ -183,7 +216,6 @@ def segment_main(user, admin, mode, **kwargs):
 		else:
 			cpout += '<div class="tok_space" id="tok'+str(tok_counter)+'" style="display:none" onclick="act('+"'ins:"+'tok'+str(tok_counter)+"'"+')">&nbsp;</div>'
 			cpout += '\t\t\t<div id="segend_post_tok'+str(tok_counter)+'" class="seg_end" onclick="act('+"'del:"+'tok'+str(tok_counter)+"'"+')">||</div>'
-			del_token_to_seg[tok_counter] = seg_counter
 			cpout += '\t\t</div>'
 		cpout += '\t\t<div id="seg'+ str(seg_counter) + '" class="seg">'
 		for token in seg.tokens:
@@ -193,24 +225,16 @@ def segment_main(user, admin, mode, **kwargs):
 			else:
 				cpout += '<div class="tok_space" id="tok'+str(tok_counter-1)+'" onclick="act('+"'ins:"+'tok'+str(tok_counter-1)+"'"+')">&nbsp;</div>'
 			cpout += '\t\t\t<div class="token" id="string_tok'+str(tok_counter)+'">' + token + '</div>'
+		if len(cpout) > CHUNK_SIZE:
+			yield cpout
+			cpout = ""
 	cpout += '\t\t</div>'
 	cpout += '''\t</div></div>
 	</body>
 	</html>
 
 	'''
-
-	tok_seg_map = get_tok_map(current_doc,current_project,user)
-	incorrect_segs = [token_key for token_key in del_token_to_seg if int(tok_seg_map[token_key])+1 != del_token_to_seg[token_key]]
-	warning = ''
-	if len(incorrect_segs) > 0:
-		warning = '<p class="warn">Attention! Empty segments detected - markup may be broken! Please contact your administrator.</p>'
-
-	cpout = cpout.replace("**warning**",warning)
-
-	if mode != "server":
-		cpout = cpout.replace(".py","")
-	return cpout
+	yield cpout
 
 
 # Main script when running from Apache
@@ -226,7 +250,14 @@ def segment_main_server():
 	kwargs={}
 	for key in theform:
 		kwargs[key] = theform[key].value
-	print(segment_main(user, admin, 'server', **kwargs))
+	render_key = prepare_segment(user, admin, 'server', kwargs)
+	if send_cgi_etag(render_key):
+		return
+	# Write the page as it is rendered instead of holding all of it in memory
+	for chunk in iter_segment(user, admin, 'server', render_key, **kwargs):
+		sys.stdout.write(chunk)
+		sys.stdout.flush()
+	sys.stdout.write("\n")
 
 
 scriptpath = os.path.dirname(os.path.realpath(__file__)) + os.sep
@@ -12,10 +12,12 @@ import cherrypy
 import os, sys
 from api import APIController, create_api_dispatcher, jsonify_error
 from open import open_main
-from structure import structure_main
-from segment import segment_main
+from structure import structure_main, iter_structure, prepare_structure, structure_tree_main
+from segment import iter_segment, prepare_segment
 from admin import admin_main
 from quick_export import quickexp_main
+from modules.rstweb_sql import close_connection
+from modules.rstweb_cache import get_etag
 
 from cherrypy.lib import file_generator
 try:
@@ -26,6 +28,18 @@ except ImportError:
 
 print_out = sys.stdout.write
 
+
+def validate_editor_etag(key):
+	"""
+	Sends an ETag for editor pages that can be cached, given their render key, and answers requests for unchanged
+	pages with 304 Not Modified
+	"""
+	if key is not None:
+		cherrypy.response.headers['ETag'] = get_etag(key)
+		cherrypy.response.headers['Cache-Control'] = "no-cache"
+		cherrypy.lib.cptools.validate_etags()  # Raises a 304 redirect for GET requests if the browser has the page
+
+
 class Root(object):
 	@cherrypy.expose
 	def default(self,**kwargs):
@@ -49,8 +63,18 @@ class Root(object):
 				return file_generator(StringIO(structure_main("local", "3", 'local', **kwargs)))
 			else:
 				return file_generator(BytesIO(b64decode(structure_main("local", "3", 'local', **kwargs))))
+		elif "edus" in kwargs:
+			try:
+				tree = structure_tree_main("local","3",'local',**kwargs)
+			except ValueError as e:
+				raise cherrypy.HTTPError(400, str(e))
+			cherrypy.response.headers['Content-Type'] = "application/json"
+			return tree.encode("utf-8")  # CherryPy only encodes text/* responses
 		else:
-			return structure_main("local","3",'local',**kwargs)
+			render_key = prepare_structure("local","3",'local',kwargs)
+			validate_editor_etag(render_key)
+			return iter_structure("local","3",'local',render_key,**kwargs)
+	structure._cp_config = {'response.stream': True}  # Send the page while it is rendered
 
 	@cherrypy.expose
 	def segment(self,**kwargs):
@@ -58,7 +82,10 @@ class Root(object):
 		if "current_doc" not in kwargs:
 			return '<script>document.location.href="open";</script>'
 		else:
-			return segment_main("local","3",'local',**kwargs)
+			render_key = prepare_segment("local","3",'local',kwargs)
+			validate_editor_etag(render_key)
+			return iter_segment("local","3",'local',render_key,**kwargs)
+	segment._cp_config = {'response.stream': True}
 
 	@cherrypy.expose
 	def quick_export(self,**kwargs):
@@ -69,6 +96,7 @@ class Root(object):
 			cherrypy.response.headers['Content-Type'] = "application/download"
 			cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="'+kwargs["quickexp_doc"]+'"'
 			return quickexp_main("local","3",'local',**kwargs)
+	quick_export._cp_config = {'response.stream': True}  # Send the export while it is generated
 
 	@cherrypy.expose
 	def admin(self,**kwargs):
@@ -101,6 +129,8 @@ api_conf = {
 api_conf.update(conf)
 
 cherrypy.tools.CORS = cherrypy.Tool('before_handler', CORS)
+# Each worker thread keeps one database connection; release it when the thread stops
+cherrypy.engine.subscribe('stop_thread', lambda thread_index: close_connection())
 cherrypy.tree.mount(root=Root(), config=conf)
 cherrypy.tree.mount(root=APIController(), script_name='/api', config=api_conf)
 
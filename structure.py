@@ -2,17 +2,24 @@
 # -*- coding: utf-8 -*-
 
 """
-The main interface for editing RST structures. Reads a document and sets up the initial layout of
-HTML elements representing RST nodes and their connections (using calls to jsPlumb). Further
-manipulations of the interface are managed by script/structure.js.
+The main interface for editing RST structures. Reads a document, calculates the initial layout of
+RST nodes and sends it as JSON, from which script/structure.js builds the HTML elements representing
+the nodes and their connections (using calls to jsPlumb). Further manipulations of the interface are
+also managed by script/structure.js.
 Author: Amir Zeldes
 """
 
 
 import cgitb
 from modules.rstweb_sql import *
+from modules.rstweb_session import DocumentSession
+from modules.rstweb_tree import get_rel_kinds, get_tree_nodes, get_window_nodes, load_nodes
+from modules.rstweb_cache import get_render_key, iter_cached_page, send_cgi_etag
+from modules.rstweb_templates import CHUNK_SIZE, get_help_section, render_template
 import codecs
 import sys
+import sqlite3
+import traceback
 import cgi
 import os
 import datetime
@@ -24,6 +31,32 @@ from modules.logintools import login
 
 
 def structure_main(user, admin, mode, **kwargs):
+	return "".join(iter_structure(user, admin, mode, prepare_structure(user, admin, mode, kwargs), **kwargs))
+
+
+def prepare_structure(user, admin, mode, theform):
+	"""
+	Removes floating non-terminal nodes from the requested document before it is rendered (e.g. due to browsing back and
+	re-submitting old actions or other data corruption), and returns the render cache key of its page, or None
+	"""
+	if "current_doc" in theform and "current_project" in theform:
+		clean_floating_nodes(theform["current_doc"], theform["current_project"], user)
+	return get_render_key("structure", user, admin, mode, theform)
+
+
+def iter_structure(user, admin, mode, render_key, **kwargs):
+	"""
+	Returns the structure editor page as an iterator of HTML chunks, which can be sent while the rest is rendered.
+	Unchanged documents are served from the render cache as they were last rendered. render_key is the
+	key returned by prepare_structure, which must run first.
+	"""
+	chunks = generate_structure(user, admin, mode, **kwargs)
+	if mode != "server":
+		chunks = (chunk.replace(".py","") for chunk in chunks)
+	return iter_cached_page(render_key, chunks)
+
+
+def generate_structure(user, admin, mode, **kwargs):
 
 	scriptpath = os.path.dirname(os.path.realpath(__file__)) + os.sep
 	userdir = scriptpath + "users" + os.sep
@@ -38,18 +71,14 @@ def structure_main(user, admin, mode, **kwargs):
 	config = ConfigObj(userdir + 'config.ini')
 	templatedir = scriptpath + config['controltemplates'].replace("/",os.sep)
 
-	template = "main_header.html"
-	header = readfile(templatedir+template)
-	header = header.replace("**page_title**","Structure editor")
-	header = header.replace("**user**",user)
 
 	cpout = ""
 	if mode == "server":
 		cpout += "Content-Type: text/html\n\n\n"
-		header = header.replace("**logout_control**",'(<a href="logout.py">log out</a>)')
+		logout_control = '(<a href="logout.py">log out</a>)'
 	else:
-		header = header.replace("**logout_control**",'')
-	cpout += header
+		logout_control = ''
+	cpout += render_template(templatedir+"main_header.html",page_title="Structure editor",user=user,logout_control=logout_control)
 
 	if "current_doc" in theform:
 		current_doc = theform["current_doc"]
@@ -64,52 +93,33 @@ def structure_main(user, admin, mode, **kwargs):
 	sys.stdout = UTF8Writer(sys.stdout)
 
 
-	edit_bar = "edit_bar.html"
-	edit_bar = readfile(templatedir+edit_bar)
-	edit_bar = edit_bar.replace("**doc**",current_doc)
-	edit_bar = edit_bar.replace("**project**",current_project)
-	edit_bar = edit_bar.replace("**structure_disabled**",'disabled="disabled"')
-	edit_bar = edit_bar.replace("**segment_disabled**",'')
-	edit_bar = edit_bar.replace("**relations_disabled**",'')
-	edit_bar = edit_bar.replace("**screenshot_disabled**",'')
-	edit_bar = edit_bar.replace("**quickexp_disabled**",'')
-	edit_bar = edit_bar.replace("**current_guidelines**",current_guidelines)
-	if mode == "server":
-		edit_bar = edit_bar.replace("**submit_target**",'structure.py')
-	else:
-		edit_bar = edit_bar.replace("**submit_target**",'structure')
-	edit_bar = edit_bar.replace("**action_type**",'action')
-	edit_bar = edit_bar.replace("**serve_mode**",mode)
-	edit_bar = edit_bar.replace("**open_disabled**",'')
+	edit_bar = render_template(templatedir+"edit_bar.html",
+		doc=current_doc,
+		project=current_project,
+		structure_disabled='disabled="disabled"',
+		segment_disabled='',
+		relations_disabled='',
+		screenshot_disabled='',
+		quickexp_disabled='',
+		current_guidelines=current_guidelines,
+		submit_target='structure.py' if mode == "server" else 'structure',
+		action_type='action',
+		serve_mode=mode,
+		open_disabled='',
+		admin_disabled='' if admin == "3" else 'disabled="disabled"')
 	edit_bar = edit_bar.replace('id="nav_edit" class="nav_button"','id="nav_edit" class="nav_button nav_button_inset"')
-
-	if admin == "3":
-		edit_bar = edit_bar.replace("**admin_disabled**",'')
-	else:
-		edit_bar = edit_bar.replace("**admin_disabled**",'disabled="disabled"')
-
 	cpout += edit_bar
 
-	help = "help.html"
-	help = readfile(templatedir+help)
-	help_match = re.search(r'(<div id="help_edit".*?</div>)',help,re.MULTILINE|re.DOTALL)
-	help = help_match.group(1)
-	if sys.version_info[0] == 2:
-		cpout += help.decode("utf-8")
-	else:
-		cpout += help
-
-	about = "about.html"
-	about = readfile(templatedir+about)
-	about = about.replace("**version**", _version.__version__)
-	cpout += about
+	cpout += get_help_section(templatedir+"help.html","help_edit")
+	cpout += render_template(templatedir+"about.html",version=_version.__version__)
 
 	if current_guidelines != "":
 		cpout += '<script>enable_guidelines();</script>'
 
 	if current_doc =="":
 		cpout += '<p class="warn">No file found - please select a file to open</p>'
-		return cpout
+		yield cpout
+		return
 
 	cpout += '''
           <div id="container" class="container">
@@ -143,13 +153,10 @@ def structure_main(user, admin, mode, **kwargs):
 	cpout += '''<div id="inner_canvas">'''
 	cpout += '<script src="/script/structure.js"></script>'
 
-	# Remove floating non-terminal nodes if found
-	# (e.g. due to browsing back and re-submitting old actions or other data corruption)
-	clean_floating_nodes(current_doc, current_project, user)
-
-	rels = get_rst_rels(current_doc, current_project)
-	def_multirel = get_def_rel("multinuc",current_doc, current_project)
-	def_rstrel = get_def_rel("rst",current_doc, current_project)
+	catalog = get_relation_catalog(current_doc, current_project)
+	rels = catalog.rels
+	def_multirel = catalog.get_def_rel("multinuc")
+	def_rstrel = catalog.get_def_rel("rst")
 	multi_options =""
 	rst_options =""
 	rel_kinds = {}
@@ -168,29 +175,43 @@ def structure_main(user, admin, mode, **kwargs):
 			timestamp = theform["timestamp"]
 
 	refresh = check_refresh(user, timestamp)
+	save_stats = None  # Number of saved actions and commit time in seconds, if any actions were submitted
 
 	if "action" in theform and not refresh:
 		if len(theform["action"]) > 1:
 			action_log = theform["action"]
 			if len(action_log) > 0:
 				actions = action_log.split(";")
-				set_timestamp(user,timestamp)
-				for action in actions:
-					action_type = action.split(":")[0]
-					action_params = action.split(":")[1] if len(action.split(":")) > 1 else ""
-					params = action_params.split(",")
-					if action_type == "up":
-						update_parent(params[0],params[1],current_doc,current_project,user)
-					elif action_type == "sp":
-						insert_parent(params[0],"span","span",current_doc,current_project,user)
-					elif action_type == "mn":
-						insert_parent(params[0],def_multirel,"multinuc",current_doc,current_project,user)
-					elif action_type == "rl":
-						update_rel(params[0],params[1],current_doc,current_project,user)
-					elif action_type == "sg":
-						update_signals(action.split(":")[1:], current_doc, current_project, user)
-					else:
-						cpout += '<script>alert("the action was: " + theform["action"]);</script>\n'
+				applied = 0
+				try:
+					# Apply the whole action log atomically: either all actions are saved or none are
+					with transaction() as tx:
+						set_timestamp(user,timestamp)
+						# Apply all actions to an in-memory copy of the document and write back the changes at once
+						session = DocumentSession(current_doc,current_project,user)
+						for action in actions:
+							action_type = action.split(":")[0]
+							action_params = action.split(":")[1] if len(action.split(":")) > 1 else ""
+							params = action_params.split(",")
+							if action_type == "up":
+								session.update_parent(params[0],params[1])
+							elif action_type == "sp":
+								session.insert_parent(params[0],"span","span")
+							elif action_type == "mn":
+								session.insert_parent(params[0],def_multirel,"multinuc")
+							elif action_type == "rl":
+								session.update_rel(params[0],params[1])
+							elif action_type == "sg":
+								session.update_signals(action.split(":")[1:])
+							else:
+								cpout += '<script>alert("the action was: " + theform["action"]);</script>\n'
+								continue
+							applied += 1
+						session.flush()
+					save_stats = (applied, tx["commit_time"])
+				except (sqlite3.Error, ValueError, IndexError, KeyError):  # Database failures and malformed actions
+					sys.stderr.write("Could not save actions for " + current_doc + " in " + current_project + ":\n" + traceback.format_exc())
+					cpout += '<script>alert("Your changes could not be saved and have been discarded.");</script>\n'
 
 	if "logging" in theform and not refresh:
 		if len(theform["logging"]) > 1:
@@ -203,25 +224,11 @@ def structure_main(user, admin, mode, **kwargs):
 		if len(theform["reset"]) > 1 or user == "demo":
 			reset_rst_doc(current_doc,current_project,user)
 
-	nodes={}
-	rows = get_rst_doc(current_doc,current_project,user)
-	for row in rows:
-		if row[7] in rel_kinds:
-			relkind = rel_kinds[row[7]]
-		else:
-			relkind = "span"
-		if row[5] == "edu":
-			nodes[row[0]] = NODE(row[0],row[1],row[2],row[3],row[4],row[5],row[6],row[7],relkind)
-		else:
-			nodes[row[0]] = NODE(row[0],0,0,row[3],row[4],row[5],row[6],row[7],relkind)
-
-	for key in nodes:
-		node = nodes[key]
-		get_depth(node,node,nodes)
+	# All changes are saved before the first chunk is sent, so that they are kept even if the browser disconnects
+	yield cpout
+	cpout = ""
 
-	for key in nodes:
-		if nodes[key].kind == "edu":
-			get_left_right(key, nodes,0,0,rel_kinds)
+	nodes = load_nodes(current_doc, current_project, user, rel_kinds)
 
 	signals = {}
 	for signal in get_signals(current_doc, current_project, user):
@@ -242,51 +249,6 @@ def structure_main(user, admin, mode, **kwargs):
 	cpout += 'window.rstWebDefaultSignalSubtype = window.rstWebSignalTypes[window.rstWebDefaultSignalType][0];'
 	cpout += '</script>'
 
-	anchors = {}
-	pix_anchors = {}
-
-	# Calculate anchor points for nodes
-	# First get proportional position for anchor
-	for key in sorted(nodes, key = lambda id: nodes[id].depth, reverse=True):
-		node = nodes[key]
-		if node.kind=="edu":
-			anchors[node.id]= "0.5"
-		if node.parent!="0":
-			parent = nodes[node.parent]
-			parent_wid = (parent.right- parent.left+1) * 100 - 4
-			child_wid = (node.right- node.left+1) * 100 - 4
-			if node.relname == "span":
-				if node.id in anchors:
-					anchors[parent.id] = str(((node.left - parent.left)*100)/parent_wid+float(anchors[node.id])*float(child_wid/parent_wid))
-				else:
-					anchors[parent.id] = str(((node.left - parent.left)*100)/parent_wid+(0.5*child_wid)/parent_wid)
-			elif node.relkind=="multinuc" and parent.kind =="multinuc":
-				# For multinucs, the anchor is in the middle between leftmost and rightmost of the multinuc children
-				# (not including other rst children)
-				lr = get_multinuc_children_lr(node.parent,current_doc,current_project,user)
-				lr_wid = (lr[0] + lr[1]) /2
-				lr_ids = get_multinuc_children_lr_ids(node.parent,lr[0],lr[1],current_doc,current_project,user)
-				left_child = lr_ids[0]
-				right_child = lr_ids[1]
-				if left_child == right_child:
-					anchors[parent.id] = "0.5"
-				else:
-					if left_child in anchors and right_child in anchors: #both leftmost and rightmost multinuc children have been found
-						len_left = nodes[left_child].right-nodes[left_child].left+1
-						len_right = nodes[right_child].right-nodes[right_child].left+1
-						anchors[parent.id] = str(((float(anchors[left_child]) * len_left*100 + float(anchors[right_child]) * len_right * 100 + (nodes[right_child].left - parent.left) * 100)/2)/parent_wid)
-					else:
-						anchors[parent.id] = str((lr_wid - parent.left+1) / (parent.right - parent.left+1))
-
-			else:
-				if not parent.id in anchors:
-					anchors[parent.id] = "0.5"
-
-	# Place anchor element to center on proportional position relative to parent
-	for key in nodes:
-		node = nodes[key]
-		pix_anchors[node.id] = str(int(3+node.left * 100 -100 - 39 + float(anchors[node.id])*((node.right- node.left+1) * 100 - 4)))
-
 	# Check that span and multinuc buttons should be used (if the interface is not used for RST, they may be disabled)
 	if int(get_schema()) > 2:
 		use_span_buttons = True if get_setting("use_span_buttons") == "True" else False
@@ -295,65 +257,35 @@ def structure_main(user, admin, mode, **kwargs):
 		use_span_buttons = True
 		use_multinuc_buttons = True
 
-	if sys.version_info[0] == 2:
-		lambda_button = "Λ".decode("utf-8")
+	# Documents with more EDUs than structure_window in config.ini are rendered in windows of that many EDUs,
+	# and script/structure.js requests the texts of other EDUs from structure_tree_main when they are shown.
+	# Pages opened with full_tree, such as those screenshots are taken of, show the whole tree.
+	window_size = int(config.get("structure_window", 0))
+	edu_count = len([key for key in nodes if nodes[key].kind == "edu"])
+	if window_size == 0 or edu_count <= window_size or "full_tree" in theform:
+		window_size = 0
+		tree_nodes = get_tree_nodes(nodes, catalog)
 	else:
-		lambda_button = "Λ"
-
-	tok_count = 0
-	for key in sorted(nodes.keys(), key=int):
-		node = nodes[key]
-		if node.kind != "edu":
-			g_wid = str(int((node.right- node.left+1) *100 -4 ))
-			cpout += '<div id="lg'+ node.id +'" class="group" style="left: ' +str(int(node.left*100 - 100))+ '; width: ' + g_wid + '; top:'+ str(int(top_spacing + layer_spacing+node.depth*layer_spacing)) +'px; z-index:1"><div id="wsk'+node.id+'" class="whisker" style="width:'+g_wid+';"></div></div>'
-			cpout += '<div id="g'+ node.id +'" class="num_cont" style="position: absolute; left:' + pix_anchors[node.id] +'px; top:'+ str(int(4+ top_spacing + layer_spacing+node.depth*layer_spacing))+'px; z-index:'+str(int(200-(node.right-node.left)))+'"><table class="btn_tb"><tr><td rowspan="2"><button id="unlink_'+ node.id+'"  title="unlink this node" class="minibtn" onclick="act('+"'up:"+node.id+",0'"+');">X</button></td><td rowspan="2"><span class="num_id">'+str(int(node.left))+"-"+str(int(node.right))+'</span></td>'
-			if use_span_buttons:
-				cpout += '<td><button id="aspan_'+ node.id+'" title="add span above" class="minibtn" onclick="act('+"'sp:"+node.id+"'"+');">T</button></td>'
-			cpout += '</tr>'
-			if use_multinuc_buttons:
-				cpout += '<tr><td><button id="amulti_'+ node.id+'" title="add multinuc above" class="minibtn" onclick="act('+"'mn:"+node.id+"'"+');">' + lambda_button + '</button></td></tr>'
-			cpout += '</table></div><br/>'
-
-		elif node.kind=="edu":
-			cpout += '<div id="edu'+str(node.id)+'" class="edu" title="'+str(node.id)+'" style="left:'+str(int(node.id)*100 - 100) +'; top:'+str(int(top_spacing +layer_spacing+node.depth*layer_spacing))+'; width: 96px">'
-			cpout += '<div id="wsk'+node.id+'" class="whisker" style="width:96px;"></div><div class="edu_num_cont"><table class="btn_tb"><tr><td rowspan="2"><button id="unlink_'+ node.id+'" title="unlink this node" class="minibtn" onclick="act('+"'up:"+node.id+",0'"+');">X</button></td><td rowspan="2"><span class="num_id">&nbsp;'+str(int(node.left))+'&nbsp;</span></td>'
-			if use_span_buttons:
-				cpout += '<td><button id="aspan_'+ node.id+'" title="add span above" class="minibtn" onclick="act('+"'sp:"+node.id+"'"+');">T</button></td>'
-			cpout += '</tr>'
-			if use_multinuc_buttons:
-				cpout += '<tr><td><button id="amulti_'+ node.id+'" title="add multinuc above" class="minibtn" onclick="act('+"'mn:"+node.id+"'"+');">' + lambda_button + '</button></td></tr>'
-			cpout += '</table></div>'
-
-			for tok in node.text.split(" "):
-				tok_count += 1
-				cpout += '<span id="tok' + str(tok_count) + '" class="tok">' + tok + '</span> '
-
-			cpout += '</div>'
-
+		tree_nodes = get_tree_nodes(nodes, catalog, (1, window_size))
+
+	# Send all nodes as one JSON document, from which script/structure.js builds their elements, data and connections.
+	# The document is written node by node, so that it can be streamed.
+	cpout += '<script>window.rstWebTree = {"span_buttons": ' + json.dumps(use_span_buttons)
+	cpout += ', "multinuc_buttons": ' + json.dumps(use_multinuc_buttons)
+	cpout += ', "window_size": ' + str(window_size) + ', "edu_count": ' + str(edu_count) + ', "nodes": ['
+	separator = ""
+	for tree_node in tree_nodes:
+		cpout += separator + json.dumps(tree_node, separators=(",", ":")).replace("</", "<\\/")
+		separator = ","
+		if len(cpout) > CHUNK_SIZE:
+			yield cpout
+			cpout = ""
+	cpout += ']};render_tree(window.rstWebTree);</script>'
 
 	max_right = get_max_right(current_doc,current_project,user)
 
-	# Serialize data in hidden input for JavaScript
-	cpout += '<input id="data" name="data" type="hidden" '
-	hidden_val=""
-	for key in nodes:
-		node = nodes[key]
-		if node.relname:
-			safe_relname = node.relname
-		else:
-			safe_relname = "none"
-		if node.kind =="edu":
-			hidden_val += "n" + node.id +",n" +node.parent+",e,"+ str(int(node.left)) + "," + safe_relname + "," + get_rel_type(node.relname,current_doc,current_project) + ";"
-		elif node.kind =="span":
-			hidden_val += "n" + node.id +",n" +node.parent+",s,0," + safe_relname + "," + get_rel_type(node.relname,current_doc,current_project) + ";"
-		else:
-			hidden_val += "n"+node.id +",n" +node.parent+",m,0," + safe_relname + "," + get_rel_type(node.relname,current_doc,current_project) + ";"
-	hidden_val = hidden_val[0:len(hidden_val)-1]
-	cpout += 'value="' + hidden_val + '"/>'
-
-
-	cpout += '<input id="def_multi_rel" type="hidden" value="' + get_def_rel("multinuc",current_doc,current_project) +'"/>\n'
-	cpout += '<input id="def_rst_rel" type="hidden" value="' + get_def_rel("rst",current_doc,current_project) +'"/>\n'
+	cpout += '<input id="def_multi_rel" type="hidden" value="' + def_multirel +'"/>\n'
+	cpout += '<input id="def_rst_rel" type="hidden" value="' + def_rstrel +'"/>\n'
 	cpout += '<input id="undo_log" type="hidden" value=""/>\n'
 	cpout += '<input id="redo_log" type="hidden" value=""/>\n'
 	cpout += '<input id="undo_state" type="hidden" value=""/>\n'
@@ -361,12 +293,14 @@ def structure_main(user, admin, mode, **kwargs):
 	cpout += '<input id="validations" type="hidden" value="'+get_project_validations(current_project)+'"/>\n'
 	cpout += '<input id="use_span_buttons" type="hidden" value="'+str(use_span_buttons)+'"/>\n'
 	cpout += '<input id="use_multinuc_buttons" type="hidden" value="'+str(use_multinuc_buttons)+'"/>\n'
+	if save_stats is not None:
+		cpout += '<input id="actions_applied" type="hidden" value="'+str(save_stats[0])+'"/>\n'
+		cpout += '<input id="commit_ms" type="hidden" value="'+str(round(save_stats[1]*1000,1))+'"/>\n'
 
 	cpout += '''	<script src="/script/jquery.jsPlumb-1.7.5-min.js"></script>
 
 			<script>
 			'''
-
 	cpout += 'function select_my_rel(options,my_rel){'
 	cpout += 'var multi_options = `' + multi_options +'`;\n'
 	cpout += 'var rst_options = `' + rst_options +'`;\n'
@@ -413,36 +347,7 @@ def structure_main(user, admin, mode, **kwargs):
 	cpout += "jsPlumb.setSuspendDrawing(true);"
 
 
-	for key in nodes:
-		node = nodes[key]
-		if node.kind == "edu":
-			node_id_str = "edu" + node.id
-		else:
-			node_id_str = "g" + node.id
-		cpout += 'jsPlumb.makeSource("'+node_id_str+'", {anchor: "Top", filter: ".num_id", allowLoopback:false});'
-		cpout += 'jsPlumb.makeTarget("'+node_id_str+'", {anchor: "Top", filter: ".num_id", allowLoopback:false});'
-
-
-	# Connect nodes
-	for key in nodes:
-		node = nodes[key]
-		if node.parent!="0":
-			parent = nodes[node.parent]
-			if node.kind == "edu":
-				node_id_str = "edu" + node.id
-			else:
-				node_id_str = "g" + node.id
-			if parent.kind == "edu":
-				parent_id_str = "edu" + parent.id
-			else:
-				parent_id_str = "g" + parent.id
-
-			if node.relname == "span":
-				cpout += 'jsPlumb.connect({source:"'+node_id_str+'",target:"'+parent_id_str+ '", connector:"Straight", anchors: ["Top","Bottom"]});'
-			elif parent.kind == "multinuc" and node.relkind=="multinuc":
-				cpout += 'jsPlumb.connect({source:"'+node_id_str+'",target:"'+parent_id_str+ '", connector:"Straight", anchors: ["Top","Bottom"], overlays: [ ["Custom", {create:function(component) {return make_relchooser("'+node.id+'","multi","'+node.relname+'");},location:0.2,id:"customOverlay"}]]});'
-			else:
-				cpout += 'jsPlumb.connect({source:"'+node_id_str+'",target:"'+parent_id_str+'", overlays: [ ["Arrow" , { width:12, length:12, location:0.95 }],["Custom", {create:function(component) {return make_relchooser("'+node.id+'","rst","'+node.relname+'");},location:0.1,id:"customOverlay"}]]});'
+	cpout += "connect_tree(window.rstWebTree);"
 
 	cpout += '''
 
@@ -513,10 +418,37 @@ def structure_main(user, admin, mode, **kwargs):
 	</html>
 
 	'''
-	if mode != "server":
-		cpout = cpout.replace(".py","")
+	yield cpout
+
+
+def parse_edu_range(value):
+	"""Returns the first and last EDU number of a range given as first-last, or raises ValueError if it is invalid"""
+	bounds = value.split("-")
+	if len(bounds) != 2 or not bounds[0].isdigit() or not bounds[1].isdigit():
+		raise ValueError("EDU ranges must be given as first-last: " + value)
+	first, last = int(bounds[0]), int(bounds[1])
+	if first < 1 or last < first:
+		raise ValueError("Invalid EDU range: " + value)
+	return first, last
+
+
+def structure_tree_main(user, admin, mode, **kwargs):
+	"""
+	Returns the nodes of the current document which cover any EDU in the range given as edus=first-last,
+	with the texts of the EDUs in that range, as JSON for windowed rendering in script/structure.js
+	"""
+	current_doc = kwargs["current_doc"]
+	current_project = kwargs["current_project"]
+	first, last = parse_edu_range(kwargs["edus"])
+	catalog = get_relation_catalog(current_doc, current_project)
+	nodes = load_nodes(current_doc, current_project, user, get_rel_kinds(catalog))
+	cpout = ""
+	if mode == "server":
+		cpout += "Content-Type: application/json\n\n"
+	cpout += json.dumps({"nodes": get_window_nodes(nodes, catalog, first, last)}, separators=(",", ":"))
 	return cpout
 
+
 # Main script when running from Apache
 def structure_main_server():
 	thisscript = os.environ.get('SCRIPT_NAME', '')
@@ -530,9 +462,20 @@ def structure_main_server():
 	kwargs={}
 	for key in theform:
 		kwargs[key] = theform[key].value
-	output = structure_main(user, admin, 'server', **kwargs)
-
-	print(output)
+	if "edus" in kwargs:
+		try:
+			print(structure_tree_main(user, admin, 'server', **kwargs))
+		except ValueError as e:
+			print("Status: 400 Bad Request\nContent-Type: text/plain\n\n" + str(e))
+		return
+	render_key = prepare_structure(user, admin, 'server', kwargs)
+	if send_cgi_etag(render_key):
+		return
+	# Write the page as it is rendered instead of holding all of it in memory
+	for chunk in iter_structure(user, admin, 'server', render_key, **kwargs):
+		sys.stdout.write(chunk)
+		sys.stdout.flush()
+	sys.stdout.write("\n")
 
 
 if "/" in os.environ.get('SCRIPT_NAME', ''):
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared fixtures for tests that use the SQLite backend directly.
+"""
+
+import os
+import sys
+
+import pytest  # pylint: disable=import-error
+
+ROOTDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOTDIR)
+
+from modules import rstweb_sql  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def db(tmpdir, monkeypatch):
+    """Points rstweb_sql at a fresh database in a temporary directory."""
+    monkeypatch.chdir(ROOTDIR)  # signal type files are read relative to the rstWeb folder
+    monkeypatch.setattr(rstweb_sql, 'DB_PATH', str(tmpdir.join('rstweb.db')))
+    rstweb_sql.setup_db()
+    rstweb_sql.create_project('project')
+    yield rstweb_sql
+    rstweb_sql.close_connection()
+
+
+@pytest.fixture
+def flat_rs3(tmpdir):
+    """Writes an .rs3 file with unattached EDUs and returns a function creating it for a given size."""
+    def make_rs3(edu_count, name='flat.rs3'):
+        segments = "".join(
+            '\t\t<segment id="{0}">token{0}a token{0}b</segment>\n'.format(i)
+            for i in range(1, edu_count + 1))
+        path = tmpdir.join(name)
+        path.write('<rst>\n\t<header>\n\t\t<relations>\n'
+                   '\t\t\t<rel name="elaboration" type="rst"/>\n'
+                   '\t\t\t<rel name="cause" type="rst"/>\n'
+                   '\t\t\t<rel name="joint" type="multinuc"/>\n'
+                   '\t\t\t<rel name="contrast" type="multinuc"/>\n'
+                   '\t\t</relations>\n\t</header>\n\t<body>\n' + segments + '\t</body>\n</rst>')
+        return str(path)
+    return make_rs3
@@ -24,6 +24,7 @@ TEMP_PROJECT = '_temp_convert' # TODO: import it once we have a setup.py
 TESTDIR = os.path.dirname(__file__)
 RS3_FILEPATH = os.path.join(TESTDIR, 'test1.rs3')
 EXPECTED_PNG1 = os.path.join(TESTDIR, 'result1.png')
+EXPECTED_SVG_PNG1 = os.path.join(TESTDIR, 'result1_svg.png')  # drawn on the server by modules/rstweb_svg.py
 BASEURL = "http://127.0.0.1:8080/api"
 
 
@@ -102,7 +103,7 @@ def delete_projects():
     assert res.status_code == 200
 
 
-def image_matches(produced_file, expected_files=(EXPECTED_PNG1,)):
+def image_matches(produced_file, expected_files=(EXPECTED_PNG1, EXPECTED_SVG_PNG1)):
     """Return True, iff the average hash of the produced image matches any of the
     expected images.
     """
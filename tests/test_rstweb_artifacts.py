@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the disk cache of exports and images in modules/rstweb_artifacts.py.
+"""
+
+import os
+
+from modules import rstweb_artifacts
+from modules.rstweb_artifacts import ArtifactCache
+
+
+def test_least_recently_used_files_are_evicted(tmpdir):
+    cache = ArtifactCache(str(tmpdir.join('artifacts')), 1000)
+    for i in range(3):
+        cache.put(['doc', i], 'png', b'x' * 300)
+        path = cache.get_path(['doc', i], 'png')
+        os.utime(path, (i, i))  # Files are used in the order they were stored
+    assert cache.size == 900
+
+    os.utime(cache.get_path(['doc', 0], 'png'), (5, 5))
+    assert cache.get(['doc', 0], 'png') == b'x' * 300  # Now the most recently used file
+
+    cache.put(['doc', 3], 'png', b'y' * 300)  # 1200 bytes, evicted down to 900
+    assert cache.get(['doc', 1], 'png') is None
+    assert cache.get(['doc', 2], 'png') == b'x' * 300 and cache.get(['doc', 0], 'png') is not None
+    assert cache.size == 900
+    assert ArtifactCache(cache.cache_dir, 1000).size == 900
+
+    cache.put(['doc', 3], 'png', b'z' * 200)  # Stored again by a concurrent request
+    assert cache.size == 800 == ArtifactCache(cache.cache_dir, 1000).size
+
+
+def test_artifacts_are_made_again_when_documents_change(db, flat_rs3, tmpdir, monkeypatch):
+    monkeypatch.setattr(rstweb_artifacts, '_artifact_cache', ArtifactCache(str(tmpdir.join('artifacts')), 10 ** 6))
+    db.import_document(flat_rs3(3), 'project', 'local')
+    renders = []
+
+    def render():
+        renders.append(1)
+        return b'image ' + str(len(renders)).encode('ascii')
+
+    key = rstweb_artifacts.get_artifact_key('png-1', 'flat.rs3', 'project', 'local')
+    assert rstweb_artifacts.get_artifact(key, 'png', render) == b'image 1'
+    assert rstweb_artifacts.get_artifact(key, 'png', render) == b'image 1'
+    assert rstweb_artifacts.get_artifact_key('svg-1', 'flat.rs3', 'project', 'local') != key
+
+    db.update_parent('1', '2', 'flat.rs3', 'project', 'local')
+    key = rstweb_artifacts.get_artifact_key('png-1', 'flat.rs3', 'project', 'local')
+    assert rstweb_artifacts.get_artifact(key, 'png', render) == b'image 2'
+    assert rstweb_artifacts.get_artifact_key('png-1', 'missing.rs3', 'project', 'local') is None
+
+    db.generic_query("INSERT INTO rst_relations VALUES ('purpose_r', 'rst', 'flat.rs3', 'project')", ())
+    db.invalidate_cache()
+    assert rstweb_artifacts.get_artifact_key('png-1', 'flat.rs3', 'project', 'local') != key
+
+    chunks = list(rstweb_artifacts.iter_artifact(key, 'rs3', iter([b'<rst>', b'</rst>'])))
+    assert chunks == [b'<rst>', b'</rst>']
+    assert list(rstweb_artifacts.iter_artifact(key, 'rs3', iter([]))) == [b'<rst></rst>']
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the pool of headless browsers taking screenshots in modules/rstweb_browser.py.
+"""
+
+import threading
+
+import pytest  # pylint: disable=import-error
+
+from modules.rstweb_browser import BrowserPool
+
+
+class FakeDriver(object):
+    """Stands in for a Selenium WebDriver."""
+    def __init__(self):
+        self.alive = True
+        self.quit_count = 0
+
+    def execute_script(self, script):
+        if not self.alive:
+            raise IOError('browser crashed')
+        return 1
+
+    def quit(self):
+        self.quit_count += 1
+
+
+def make_pool(max_size=2, max_uses=3):
+    started = []
+
+    def factory():
+        started.append(FakeDriver())
+        return started[-1]
+    return BrowserPool(max_size, max_uses, factory), started
+
+
+def test_browsers_are_reused_and_recycled():
+    pool, started = make_pool(max_uses=3)
+    for _ in range(3):
+        with pool.browser():
+            pass
+    assert len(started) == 1 and started[0].quit_count == 1  # Quit after its third use
+
+    with pool.browser() as driver:
+        assert driver is started[1]
+    started[1].alive = False
+    with pool.browser() as driver:  # The unresponsive browser is replaced
+        assert driver is started[2]
+    assert started[1].quit_count == 1
+
+    with pytest.raises(ValueError):
+        with pool.browser():
+            raise ValueError('page failed')
+    assert started[2].quit_count == 1 and pool.size == 0
+
+    pool.close()
+
+
+def test_pool_is_bounded():
+    pool, started = make_pool(max_size=1)
+    first = pool.acquire()
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    waiter.start()
+    waiter.join(0.1)
+    assert acquired == [] and len(started) == 1  # Waits for the only browser
+
+    pool.release(*first)
+    waiter.join(1)
+    assert acquired == [(started[0], 1)]
+    pool.release(*acquired[0])
+    pool.close()
+    assert started[0].quit_count == 1 and pool.size == 0
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for document versions and the rendered page cache in modules/rstweb_cache.py.
+"""
+
+import pytest  # pylint: disable=import-error
+
+from modules import rstweb_cache
+from modules.rstweb_cache import RenderCache, etag_matches, get_etag, get_render_key
+
+DOC = 'flat.rs3'
+PROJECT = 'project'
+
+
+@pytest.fixture
+def render_cache(monkeypatch):
+    cache = RenderCache(8)
+    monkeypatch.setattr(rstweb_cache, '_render_cache', cache)
+    return cache
+
+
+def test_every_write_gives_a_new_document_version(db, flat_rs3):
+    """Versions grow with every change to a document's nodes or signals, and never repeat after a reimport."""
+    db.import_document(flat_rs3(4), PROJECT, 'local')
+    versions = [db.get_doc_version(DOC, PROJECT, 'local')]
+    db.get_rst_doc(DOC, PROJECT, 'local')
+    assert db.get_doc_version(DOC, PROJECT, 'local') == versions[-1]
+
+    db.insert_seg(1, DOC, PROJECT, 'local')
+    versions.append(db.get_doc_version(DOC, PROJECT, 'local'))
+    db.update_signals(['2,dm,dm,1'], DOC, PROJECT, 'local')
+    versions.append(db.get_doc_version(DOC, PROJECT, 'local'))
+    db.copy_doc_to_user(DOC, PROJECT, 'annotator')
+    assert db.get_doc_version(DOC, PROJECT, 'local') == versions[-1]
+    versions.append(db.get_doc_version(DOC, PROJECT, 'annotator'))
+    db.import_document(flat_rs3(4), PROJECT, 'local')
+    versions.append(db.get_doc_version(DOC, PROJECT, 'local'))
+
+    assert versions == sorted(set(versions))
+    assert db.get_doc_version(DOC, PROJECT, 'nobody') is None
+
+
+def test_editor_pages_are_cached_until_the_document_changes(db, flat_rs3, render_cache, monkeypatch):
+    """Unchanged documents are not rendered again, and saving actions renders the new version."""
+    import structure
+    db.import_document(flat_rs3(4), PROJECT, 'local')
+    form = {'current_doc': DOC, 'current_project': PROJECT, 'logging': '', 'timestamp': ''}
+    page = structure.structure_main('local', '3', 'local', **form)
+    key = get_render_key('structure', 'local', '3', 'local', form)
+    assert render_cache.get(key) == page
+
+    def no_render(*args):
+        raise AssertionError('document was rendered again')
+    with monkeypatch.context() as m:
+        m.setattr(structure, 'get_rst_doc', no_render)
+        assert structure.structure_main('local', '3', 'local', **form) == page
+
+    assert get_render_key('structure', 'local', '3', 'local', dict(form, action='sp:1')) is None
+    saved = structure.structure_main('local', '3', 'local', **dict(form, action='sp:1'))
+    assert 'id="actions_applied" type="hidden" value="1"' in saved
+    new_key = get_render_key('structure', 'local', '3', 'local', form)
+    assert get_etag(new_key) != get_etag(key)
+    assert structure.structure_main('local', '3', 'local', **form) != page
+
+    db.save_setting('signals', 'True')
+    assert get_render_key('structure', 'local', '3', 'local', form) != new_key
+    assert get_render_key('segment', 'local', '3', 'local', form) != new_key
+    assert get_render_key('structure', 'local', '3', 'local', dict(form, full_tree='1')) not in [
+        None, get_render_key('structure', 'local', '3', 'local', form)]
+
+
+def test_render_cache_evicts_to_disk(tmpdir):
+    """The least recently used pages leave memory but stay available from the cache folder."""
+    cache = RenderCache(2, str(tmpdir.join('cache')))
+    for i in range(3):
+        cache.put(['page', i], u'page {0} …'.format(i))
+    assert cache.get(['page', 1]) == u'page 1 …'
+    assert len(cache.pages) == 2 and cache.get(['page', 0]) == u'page 0 …'
+    assert len(tmpdir.join('cache').listdir()) == 3
+    assert RenderCache(2, str(tmpdir.join('cache'))).get(['page', 2]) == u'page 2 …'
+    assert RenderCache(2).get(['page', 2]) is None
+
+
+def test_etag_matches():
+    etag = get_etag(['structure', DOC])
+    assert etag_matches(etag, etag)
+    assert etag_matches(etag, '"other", W/' + etag)
+    assert etag_matches(etag, '*')
+    assert not etag_matches(etag, '"other"')
+    assert not etag_matches(etag, None)
+
+
+@pytest.mark.parametrize('view', ['structure', 'segment'])
+def test_editor_pages_are_streamed_in_chunks(db, flat_rs3, render_cache, monkeypatch, view):
+    """Streamed pages are the same as pages rendered at once, and are cached once all chunks were sent."""
+    module = __import__(view)
+    render = getattr(module, view + '_main')
+    iter_page = getattr(module, 'iter_' + view)
+    db.import_document(flat_rs3(40), PROJECT, 'local')
+    form = {'current_doc': DOC, 'current_project': PROJECT}
+    page = render('local', '3', 'local', **form)
+    render_cache.clear()
+
+    monkeypatch.setattr(module, 'CHUNK_SIZE', 1000)
+    key = getattr(module, 'prepare_' + view)('local', '3', 'local', form)
+    chunks = iter_page('local', '3', 'local', key, **form)
+    first = next(chunks)
+    assert page.startswith(first)
+    assert render_cache.get(get_render_key(view, 'local', '3', 'local', form)) is None
+    chunks = [first] + list(chunks)
+    assert len(chunks) > 3
+    assert "".join(chunks) == page
+    assert render_cache.get(get_render_key(view, 'local', '3', 'local', form)) == page
+
+
+def test_render_keys_follow_config_and_floating_node_cleanup(db, flat_rs3, render_cache, tmpdir, monkeypatch):
+    """Pages are keyed by config.ini, and by the document as the editors leave it after removing floating nodes."""
+    import structure
+    db.import_document(flat_rs3(3), PROJECT, 'local')
+    form = {'current_doc': DOC, 'current_project': PROJECT}
+    key = get_render_key('structure', 'local', '3', 'local', form)
+
+    config = tmpdir.join('config.ini')
+    config.write('controltemplates = templates/\n')
+    monkeypatch.setattr(db, 'CONFIG_PATH', str(config))
+    assert get_render_key('structure', 'local', '3', 'local', form) != key
+    config.setmtime(config.mtime() + 10)
+    assert get_render_key('structure', 'local', '3', 'local', form) != key
+
+    db.generic_query('INSERT INTO rst_nodes VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                     (9, 1, 1, 0, 0, 'span', '', 'span', DOC, PROJECT, 'local'))  # A span without children
+    floating = get_render_key('structure', 'local', '3', 'local', form)
+    assert get_render_key('structure', 'local', '3', 'local', form) == floating  # Keys are computed without writes
+    key = structure.prepare_structure('local', '3', 'local', form)
+    assert key != floating and get_render_key('structure', 'local', '3', 'local', form) == key
+    page = "".join(structure.iter_structure('local', '3', 'local', key, **form))
+    assert render_cache.get(key) == page
+    assert structure.structure_main('local', '3', 'local', **form) == page
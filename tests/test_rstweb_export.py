@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the corpus ZIP export in modules/rstweb_export.py.
+"""
+
+import io
+import sys
+import time
+import zipfile
+
+from modules import rstweb_export
+
+PROJECT = 'project'
+
+
+def import_corpus(db, flat_rs3, count):
+    for i in range(count):
+        db.import_document(flat_rs3(3 + i % 5, name='doc{0}.rs3'.format(i)), PROJECT, 'local')
+
+
+def test_corpus_export_in_worker_processes(db, flat_rs3, tmpdir):
+    """Documents rendered by the process pool match the single document export."""
+    import_corpus(db, flat_rs3, 12)
+    db.copy_doc_to_user('doc3.rs3', PROJECT, 'annotator')
+    calls = []
+    target = str(tmpdir.join('corpus.zip'))
+
+    assert rstweb_export.export_corpus(target, processes=2, progress=lambda done, total: calls.append((done, total))) == 13
+    assert calls == [(i, 13) for i in range(1, 14)]
+    with zipfile.ZipFile(target) as archive:
+        assert archive.testzip() is None
+        assert len(archive.namelist()) == 13
+        assert archive.read('project_doc3.rs3_annotator.rs3').decode('utf-8') == \
+            db.get_export_string('doc3.rs3', PROJECT, 'annotator')
+        assert archive.read('project_doc11.rs3_local.rs3').decode('utf-8') == \
+            db.get_export_string('doc11.rs3', PROJECT, 'local')
+
+
+def test_corpus_export_selection(db, flat_rs3, tmpdir):
+    """Versions can be selected by user, document list and modification time."""
+    import_corpus(db, flat_rs3, 3)
+    db.copy_doc_to_user('doc0.rs3', PROJECT, 'annotator')
+    since = time.time()
+    db.generic_query("UPDATE docs SET modified=? WHERE user='local'", (since - 100,))
+    db.update_seg_contents('1', 'edited', 'doc1.rs3', PROJECT, 'local')
+    db.touch_doc('doc1.rs3', PROJECT, 'local')
+
+    names = lambda **kwargs: [rstweb_export.get_archive_name(*version[:3])
+                              for version in rstweb_export.select_versions(**kwargs)]
+    assert names(users=['annotator']) == ['project_doc0.rs3_annotator.rs3']
+    assert names(docs=[('doc2.rs3', PROJECT)]) == ['project_doc2.rs3_local.rs3']
+    assert names(users=['local'], modified_since=since) == ['project_doc1.rs3_local.rs3']
+    assert names(projects=['other']) == []
+    assert rstweb_export.parse_since('1234.5') == 1234.5
+
+
+def test_corpus_zip_is_streamed(db, flat_rs3):
+    """The generated chunks form a valid archive and are sent before the last document is rendered."""
+    import_corpus(db, flat_rs3, 5)
+    chunks = list(rstweb_export.iter_corpus_zip(processes=1))
+    if sys.version_info[0] > 2:  # Python 2 spools the archive to a temporary file, which is sent at once
+        assert len(chunks) == 6
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+        assert sorted(archive.namelist()) == ['project_doc{0}.rs3_local.rs3'.format(i) for i in range(5)]
+        assert archive.read('project_doc4.rs3_local.rs3').decode('utf-8') == \
+            db.get_export_string('doc4.rs3', PROJECT, 'local')
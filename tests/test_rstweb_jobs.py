@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the background jobs rendering images of documents in modules/rstweb_jobs.py.
+"""
+
+import io
+import os
+import threading
+import time
+import zipfile
+
+from modules import rstweb_jobs
+
+
+def wait_for(job):
+    for _ in range(200):
+        if job.get_status()['status'] == 'finished':
+            return job.get_status()
+        time.sleep(0.01)
+    raise AssertionError('job did not finish')
+
+
+def render(doc, project):
+    if doc == 'broken.rs3':
+        raise ValueError('cannot draw ' + doc)
+    return (project + '/' + doc).encode('utf-8')
+
+
+def test_job_reports_progress_and_zips_images():
+    documents = [('p', 'a.rs3'), ('p', 'broken.rs3'), ('q', 'b.rs3')]
+    job = rstweb_jobs.start_job(documents, 'svg', render)
+    assert rstweb_jobs.get_job(job.id) is job
+
+    status = wait_for(job)
+    assert (status['total'], status['done'], status['failed']) == (3, 2, 1)
+    assert [document['status'] for document in status['documents']] == ['done', 'failed', 'done']
+    assert status['documents'][1]['error'] == 'cannot draw broken.rs3'
+
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(job.iter_zip())))
+    assert sorted(archive.namelist()) == ['p_a.rs3.svg', 'q_b.rs3.svg']
+    assert archive.read('q_b.rs3.svg') == b'q/b.rs3'
+
+    assert rstweb_jobs.delete_job(job.id)
+    assert rstweb_jobs.get_job(job.id) is None and not os.path.exists(job.folder)
+    assert not rstweb_jobs.delete_job(job.id)
+
+
+def test_deleted_jobs_skip_queued_documents():
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_render(doc, project):
+        started.set()
+        release.wait(1)
+        return b'png'
+
+    job = rstweb_jobs.start_job([('p', str(i)) for i in range(6)], 'png', slow_render)
+    started.wait(1)
+    rstweb_jobs.delete_job(job.id)
+    release.set()
+    status = wait_for(job)
+    assert status['failed'] >= 4  # At most one document per worker was being rendered
+    assert 'The job was deleted' in [document.get('error') for document in status['documents']]
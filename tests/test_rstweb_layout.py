@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the tree layout functions in modules/rstweb_layout.py.
+"""
+
+import copy
+import json
+import os
+import random
+
+from modules.rstweb_classes import NODE, get_depth, get_left_right
+from modules.rstweb_layout import get_anchors, get_multinuc_extents, layout_nodes
+
+REL_HASH = {'elaboration_r': 'rst', 'cause_r': 'rst', 'joint_m': 'multinuc', 'contrast_m': 'multinuc'}
+
+
+def random_tree(rng, edu_count, group_count):
+    """Builds NODE objects like structure.py does, attaching nodes to random earlier groups or EDUs."""
+    rows = []
+    for i in range(1, group_count + 1):
+        group_id = str(edu_count + i)
+        kind = rng.choice(['span', 'multinuc'])
+        rows.append((group_id, kind, rng.choice(['0'] + [row[0] for row in rows])))
+    nodes = {}
+    for group_id, kind, parent in rows:
+        nodes[group_id] = NODE(group_id, 0, 0, parent, 0, kind, '', '', 'span')
+    for i in range(1, edu_count + 1):
+        candidates = ['0'] + [row[0] for row in rows] + [str(j) for j in range(1, i)]
+        nodes[str(i)] = NODE(str(i), i, i, rng.choice(candidates), 0, 'edu', 'edu', '', 'span')
+    for node in nodes.values():
+        if node.parent == '0':
+            continue
+        parent = nodes[node.parent]
+        if parent.kind == 'multinuc':
+            node.relname = rng.choice(['joint_m', 'contrast_m', 'cause_r'])
+        elif parent.kind == 'span':
+            node.relname = rng.choice(['span', 'span', 'elaboration_r'])
+        else:
+            node.relname = rng.choice(['elaboration_r', 'cause_r'])
+        node.relkind = REL_HASH.get(node.relname, 'span')
+    return nodes
+
+
+def recursive_layout(nodes, rel_hash):
+    for key in nodes:
+        get_depth(nodes[key], nodes[key], nodes)
+    for key in nodes:
+        if nodes[key].kind == 'edu':
+            get_left_right(key, nodes, 0, 0, rel_hash)
+
+
+def test_layout_matches_recursive_functions():
+    """The linear layout gives every node the same depth, sortdepth and span as the recursive functions."""
+    rng = random.Random(14)
+    for _ in range(300):
+        nodes = random_tree(rng, rng.randint(1, 25), rng.randint(0, 12))
+        expected = copy.deepcopy(nodes)
+        recursive_layout(expected, REL_HASH)
+        layout_nodes(nodes, REL_HASH)
+        for key in nodes:
+            assert vars(nodes[key]) == vars(expected[key])
+
+
+def test_layout_of_deep_chains():
+    """Right-branching chains deeper than the recursion limit are laid out in one pass."""
+    size = 5000
+    nodes = {}
+    for i in range(1, size + 1):
+        nodes[str(i)] = NODE(str(i), i, i, str(size + i), 0, 'edu', 'edu', 'span', 'span')
+        parent = '0' if i == 1 else str(size + i - 1)
+        nodes[str(size + i)] = NODE(str(size + i), 0, 0, parent, 0, 'span', '', 'span' if i > 1 else '', 'span')
+    layout_nodes(nodes, REL_HASH)
+    top, bottom = nodes[str(size + 1)], nodes[str(2 * size)]
+    assert (top.left, top.right, top.depth) == (1, size, 0)
+    assert (bottom.left, bottom.right, bottom.depth) == (size, size, size - 1)
+    assert nodes[str(size)].depth == size
+
+
+GUM_KEY = ('GUM_news_worship_annotated.rs3', 'project', 'local')
+
+
+def import_gum(db):
+    """Imports the GUM sample document and returns its nodes, laid out as in structure.py."""
+    db.import_document(os.path.join('import', GUM_KEY[0]), GUM_KEY[1], GUM_KEY[2])
+    rel_kinds = dict(db.get_rst_rels(*GUM_KEY[:2]))
+    nodes = {}
+    for row in db.get_rst_doc(*GUM_KEY):
+        left, right = (row[1], row[2]) if row[5] == 'edu' else (0, 0)
+        nodes[row[0]] = NODE(row[0], left, right, row[3], row[4], row[5], row[6], row[7], rel_kinds.get(row[7], 'span'))
+    layout_nodes(nodes, rel_kinds)
+    return nodes
+
+
+def test_anchors_from_imported_document(db):
+    """Multinuc extents match the database queries they replace, and every node gets an anchor."""
+    nodes = import_gum(db)
+    doc_key = GUM_KEY
+
+    extents = get_multinuc_extents(nodes)
+    assert extents
+    for parent_id, (left, right, left_child, right_child) in extents.items():
+        assert db.get_multinuc_children_lr(parent_id, *doc_key) == [left, right]
+        assert db.get_multinuc_children_lr_ids(parent_id, left, right, *doc_key) == (left_child, right_child)
+
+    anchors, pix_anchors = get_anchors(nodes)
+    assert sorted(anchors) == sorted(pix_anchors) == sorted(nodes)
+    assert all(0 < anchors[node_id] < 1 for node_id in anchors)
+    assert pix_anchors['1'] == 3 - 39 + 48
+
+
+def test_structure_page_sends_tree_as_json(db):
+    """The structure editor sends each node once, with its layout, for script/structure.js to build the page from."""
+    import structure
+    nodes = import_gum(db)
+    pix_anchors = get_anchors(nodes)[1]
+    page = structure.structure_main('local', '3', 'local', current_doc=GUM_KEY[0], current_project=GUM_KEY[1])
+    payload = page.split('window.rstWebTree = ', 1)[1].split(';render_tree(window.rstWebTree);', 1)[0]
+    tree = json.loads(payload)
+    assert tree['span_buttons'] is True and tree['multinuc_buttons'] is True
+    assert [node[0] for node in tree['nodes']] == list(nodes)
+    for node_id, parent, kind, left, right, depth, anchor, relname, reltype, text, tokens in tree['nodes']:
+        node = nodes[node_id]
+        assert (parent, kind, left, right, depth, anchor) == (node.parent, node.kind, node.left, node.right, node.depth, pix_anchors[node_id])
+        assert text == (node.text if kind == 'edu' else '')
+        assert relname == (node.relname or 'none')
+    assert 'jsPlumb.connect({source:"' not in page and 'class="edu"' not in page
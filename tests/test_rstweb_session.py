@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the in-memory document session, which must edit trees exactly like rstweb_sql.
+"""
+
+import random
+
+from modules.rstweb_session import DocumentSession
+
+DOC = 'flat.rs3'
+PROJECT = 'project'
+
+
+def is_ancestor(db, candidate, node_id, user):
+    while node_id != "0":
+        if node_id == candidate:
+            return True
+        node_id = db.get_parent(node_id, DOC, PROJECT, user)
+    return False
+
+
+def random_actions(db, rng, count):
+    """Applies random editor actions through rstweb_sql and returns them for replay."""
+    actions = []
+    rels = ['elaboration_r', 'cause_r', 'joint_m', 'contrast_m', 'span']
+    for _ in range(count):
+        ids = [row[0] for row in db.get_rst_doc(DOC, PROJECT, 'sql')]
+        node_id = rng.choice(ids)
+        action_type = rng.choice(['up', 'up', 'up', 'sp', 'mn', 'rl'])
+        if action_type == 'up':
+            parent = rng.choice(ids + ['0'])
+            if parent != '0' and is_ancestor(db, node_id, parent, 'sql'):
+                continue
+            db.update_parent(node_id, parent, DOC, PROJECT, 'sql')
+            actions.append(('update_parent', node_id, parent))
+        elif action_type == 'sp':
+            db.insert_parent(node_id, 'span', 'span', DOC, PROJECT, 'sql')
+            actions.append(('insert_parent', node_id, 'span', 'span'))
+        elif action_type == 'mn':
+            db.insert_parent(node_id, 'joint_m', 'multinuc', DOC, PROJECT, 'sql')
+            actions.append(('insert_parent', node_id, 'joint_m', 'multinuc'))
+        else:
+            rel = rng.choice(rels)
+            db.update_rel(node_id, rel, DOC, PROJECT, 'sql')
+            actions.append(('update_rel', node_id, rel))
+    return actions
+
+
+def test_session_matches_sql_edits(db, flat_rs3):
+    """Replaying random actions in a session yields the same rows as the SQL functions."""
+    db.import_document(flat_rs3(12), PROJECT, 'sql')
+    db.copy_doc_to_user(DOC, PROJECT, 'session')
+    rng = random.Random(42)
+    actions = random_actions(db, rng, 300)
+
+    session = DocumentSession(DOC, PROJECT, 'session')
+    for action in actions:
+        getattr(session, action[0])(*action[1:])
+    session.flush()
+
+    expected = [row[:8] for row in db.get_rst_doc(DOC, PROJECT, 'sql')]
+    assert [row[:8] for row in db.get_rst_doc(DOC, PROJECT, 'session')] == expected
+
+
+def test_session_signals(db, flat_rs3):
+    """Signals are replaced by update_signals and removed together with their nodes."""
+    db.import_document(flat_rs3(3), PROJECT, 'local')
+    session = DocumentSession(DOC, PROJECT, 'local')
+    session.insert_parent('1', 'span', 'span')
+    session.update_signals(['4,dm,but,1-2', '2,lexical,synonymy,3'])
+    session.flush()
+    assert sorted(db.get_signals(DOC, PROJECT, 'local')) == [
+        ('2', 'lexical', 'synonymy', '3'), ('4', 'dm', 'but', '1,2')]
+
+    session.update_parent('1', '0')  # span 4 loses its last child and is deleted
+    session.flush()
+    assert db.get_signals(DOC, PROJECT, 'local') == [('2', 'lexical', 'synonymy', '3')]
+    assert not db.node_exists('4', DOC, PROJECT, 'local')
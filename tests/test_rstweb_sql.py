@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the SQLite data access functions in modules/rstweb_sql.py.
+"""
+
+import sqlite3
+import threading
+
+import pytest  # pylint: disable=import-error
+
+DOC = 'flat.rs3'
+PROJECT = 'project'
+
+# Statement tracing, used to count queries, is only available on Python 3
+needs_trace = pytest.mark.skipif(not hasattr(sqlite3.Connection, 'set_trace_callback'),
+                                 reason='sqlite3 cannot trace statements')
+
+
+def test_transaction_rolls_back_action_log(db, flat_rs3):
+    """A failing action discards all earlier actions of the same transaction."""
+    db.import_document(flat_rs3(3), PROJECT, 'local')
+    before = db.get_rst_doc(DOC, PROJECT, 'local')
+
+    with pytest.raises(KeyError):
+        with db.transaction():
+            db.insert_seg(1, DOC, PROJECT, 'local')
+            db.insert_parent('1', 'span', 'span', DOC, PROJECT, 'local')
+            db.insert_seg(999, DOC, PROJECT, 'local')  # no such token
+
+    assert db.get_rst_doc(DOC, PROJECT, 'local') == before
+
+
+def test_malformed_action_log_is_discarded_and_logged(db, flat_rs3, capsys):
+    """Editors roll back action logs that cannot be applied and log why."""
+    import structure
+    db.import_document(flat_rs3(3), PROJECT, 'local')
+    before = db.get_rst_doc(DOC, PROJECT, 'local')
+    form = {'current_doc': DOC, 'current_project': PROJECT, 'timestamp': ''}
+
+    page = structure.structure_main('local', '3', 'local', **dict(form, action='sp:1;up:1'))
+    assert 'could not be saved' in page
+    assert db.get_rst_doc(DOC, PROJECT, 'local') == before
+    assert 'IndexError' in capsys.readouterr().err
+
+
+def test_failed_segmentation_keeps_document_unchanged(db, flat_rs3):
+    """An action failing after earlier actions were written leaves the document and its copies as they were."""
+    import segment
+    db.import_document(flat_rs3(3), PROJECT, 'local')
+    before = db.get_rst_doc(DOC, PROJECT, 'local')
+    form = {'current_doc': DOC, 'current_project': PROJECT, 'timestamp': ''}
+
+    page = segment.segment_main('local', '3', 'local', **dict(form, seg_action='ins:tok1;del:tok3;ins:tok999'))
+    assert 'could not be saved' in page
+    assert db.get_rst_doc(DOC, PROJECT, 'local') == before
+
+    with pytest.raises(KeyError):
+        with db.transaction():
+            db.copy_doc_to_user(DOC, PROJECT, 'annotator')
+            db.insert_seg(999, DOC, PROJECT, 'annotator')
+    assert db.get_users(DOC, PROJECT) == [('local',)]
+    assert db.get_rst_doc(DOC, PROJECT, 'annotator') == []
+
+
+def test_transaction_commits_once(db, flat_rs3):
+    """Nested transactions join the outer one, which reports its commit time."""
+    db.import_document(flat_rs3(3), PROJECT, 'local')
+    with db.transaction() as outer:
+        db.insert_seg(1, DOC, PROJECT, 'local')
+        with db.transaction() as inner:
+            db.merge_seg_forward(1, DOC, PROJECT, 'local')
+        assert db.in_transaction()
+    assert not db.in_transaction()
+    assert inner['commit_time'] == 0.0
+    assert outer['commit_time'] > 0.0
+    assert [row[6] for row in db.get_rst_doc(DOC, PROJECT, 'local')] == [
+        'token1a token1b', 'token2a token2b', 'token3a token3b']
+
+
+def test_push_up_and_down_shift_ids_and_signals(db, flat_rs3):
+    """Splitting and merging a segment renumbers nodes, parents, spans and signal sources."""
+    db.import_document(flat_rs3(4), PROJECT, 'local')
+    db.insert_parent('3', 'span', 'span', DOC, PROJECT, 'local')  # new node 5
+    db.update_parent('4', '5', DOC, PROJECT, 'local')
+    db.update_signals(['3,dm,dm,1', '4,dm,dm,2-3', '5,lexical,lexical,4'], DOC, PROJECT, 'local')
+    before = db.get_rst_doc(DOC, PROJECT, 'local')
+
+    db.insert_seg(1, DOC, PROJECT, 'local')
+    rows = dict((row[0], row) for row in db.get_rst_doc(DOC, PROJECT, 'local'))
+    assert sorted(rows, key=int) == ['1', '2', '3', '4', '5', '6']
+    assert rows['2'][6] == 'token1b'
+    assert rows['5'][3:8:4] == ('6', 'elaboration_r')
+    assert rows['6'][1:4] == (4, 4, '0')
+    assert [row[0] for row in db.get_signals(DOC, PROJECT, 'local')] == ['4', '5', '6']
+
+    db.merge_seg_forward(1, DOC, PROJECT, 'local')
+    assert db.get_rst_doc(DOC, PROJECT, 'local') == before
+    assert [row[0] for row in db.get_signals(DOC, PROJECT, 'local')] == ['3', '4', '5']
+
+
+def test_text_ids_are_migrated_to_integers(db, flat_rs3):
+    """Databases storing IDs as text and spans as reals are upgraded on their first connection."""
+    db.import_document(flat_rs3(3), PROJECT, 'local')
+    db.insert_parent('2', 'span', 'span', DOC, PROJECT, 'local')
+    db.update_signals(['4,dm,dm,1-2'], DOC, PROJECT, 'local')
+    nodes = db.get_rst_doc(DOC, PROJECT, 'local')
+    signals = db.get_signals(DOC, PROJECT, 'local')
+
+    conn = db.get_connection()
+    conn.executescript('''
+        ALTER TABLE rst_nodes RENAME TO rst_nodes_int;
+        CREATE TABLE rst_nodes (id text, left real, right real, parent text, depth real, kind text, contents text, relname text, doc text, project text, user text, UNIQUE (id, doc, project, user) ON CONFLICT REPLACE);
+        INSERT INTO rst_nodes SELECT CAST(id AS text), left, right, CAST(parent AS text), depth, kind, contents, relname, doc, project, user FROM rst_nodes_int;
+        DROP TABLE rst_nodes_int;
+        ALTER TABLE rst_signals RENAME TO rst_signals_int;
+        CREATE TABLE rst_signals (source text, type text, subtype text, tokens text, doc text, project text, user text, UNIQUE (source, type, subtype, tokens, doc, project, user) ON CONFLICT REPLACE);
+        INSERT INTO rst_signals SELECT CAST(source AS text), type, subtype, tokens, doc, project, user FROM rst_signals_int;
+        DROP TABLE rst_signals_int;
+        CREATE TABLE docs_7 (doc text, project text, user text,  UNIQUE (doc, project, user) ON CONFLICT REPLACE);
+        INSERT INTO docs_7 SELECT doc, project, user FROM docs;
+        DROP TABLE docs;
+        ALTER TABLE docs_7 RENAME TO docs;
+        PRAGMA user_version=7;
+    ''')
+    db.close_connection()
+
+    assert db.get_rst_doc(DOC, PROJECT, 'local') == nodes
+    assert db.get_signals(DOC, PROJECT, 'local') == signals
+    assert db.get_schema() == db.SCHEMA_VERSION
+    assert db.generic_query("SELECT DISTINCT typeof(id), typeof(left), typeof(parent) FROM rst_nodes", ()) == [
+        ('integer', 'integer', 'integer')]
+    assert db.generic_query("SELECT typeof(source) FROM rst_signals", ()) == [('integer',)]
+    assert db.get_max_node_id(DOC, PROJECT, 'local') == 4
+    assert db.generic_query("SELECT count(*) FROM sqlite_stat1 WHERE tbl='rst_nodes'", ())[0][0] > 0  # Analyzed
+
+
+@needs_trace
+def test_settings_are_cached_until_another_connection_commits(db, monkeypatch):
+    """Repeated setting reads run no SQL; changes made by other connections are picked up."""
+    monkeypatch.setattr(db, 'SETTINGS_CHECK_INTERVAL', 3600)
+    db.save_setting('signals', 'True')
+    assert db.get_setting('signals') == 'True'
+
+    statements = []
+    db.get_connection().set_trace_callback(statements.append)
+    for _ in range(10):
+        assert db.get_schema() == db.SCHEMA_VERSION
+        assert db.get_setting('signals') == 'True'
+        assert db.get_setting('no_such_setting') == ''
+    assert statements == []
+
+    other = sqlite3.connect(db.DB_PATH)
+    other.execute("INSERT INTO settings VALUES ('signals', 'False')")
+    other.commit()
+    other.close()
+    monkeypatch.setattr(db, 'SETTINGS_CHECK_INTERVAL', 0)
+    assert db.get_setting('signals') == 'False'
+    assert statements[0] == 'PRAGMA data_version'
+
+
+def test_settings_are_read_without_ending_transactions(db, flat_rs3, monkeypatch):
+    """Settings read inside a transaction run no PRAGMA, which would commit the transaction on Python 2."""
+    db.import_document(flat_rs3(3), PROJECT, 'local')
+    before = db.get_rst_doc(DOC, PROJECT, 'local')
+    monkeypatch.setattr(db, 'SETTINGS_CHECK_INTERVAL', 0)
+    with pytest.raises(KeyError):
+        with db.transaction():
+            db.insert_seg(1, DOC, PROJECT, 'local')
+            db.invalidate_cache()
+            assert db.get_schema() == db.SCHEMA_VERSION
+            assert db.get_setting('signals') == 'False'
+            db.insert_seg(999, DOC, PROJECT, 'local')  # no such token
+    assert db.get_rst_doc(DOC, PROJECT, 'local') == before
+
+
+@needs_trace
+def test_relation_catalog_is_cached_per_document(db, flat_rs3):
+    """Relation lookups run no SQL once loaded, and reimporting a document reloads its relations."""
+    db.import_document(flat_rs3(2), PROJECT, 'local')
+    assert db.get_def_rel('multinuc', DOC, PROJECT) == 'contrast_m'
+
+    statements = []
+    db.get_connection().set_trace_callback(statements.append)
+    assert db.get_rel_type('joint_m', DOC, PROJECT) == 'multinuc'
+    assert db.get_rel_type('span', DOC, PROJECT) == 'span'
+    assert db.get_def_rel('rst', DOC, PROJECT) == 'cause_r'
+    assert db.get_def_rel('multinuc', 'other.rs3', PROJECT) == '--_m'
+    assert len(statements) == 1 and 'FROM rst_relations' in statements[0]  # only the unseen document
+
+    db.get_connection().set_trace_callback(None)
+    path = flat_rs3(2)
+    with open(path) as rs3:
+        contents = rs3.read().replace('"contrast"', '"comparison"')
+    with open(path, 'w') as rs3:
+        rs3.write(contents)
+    db.import_document(path, PROJECT, 'local')
+    assert db.get_def_rel('multinuc', DOC, PROJECT) == 'comparison_m'
+
+
+def test_bulk_plaintext_import(db, tmpdir):
+    """Plain text imports write the user and '_orig' copies in one go and report their throughput."""
+    path = tmpdir.join('plain.txt')
+    path.write(''.join('edu number {0}\n'.format(i) for i in range(1, 5001)))
+    stats = {}
+    assert db.import_plaintext(str(path), PROJECT, 'local', {}, stats=stats) is None
+
+    nodes = db.get_rst_doc('plain.txt', PROJECT, 'local')
+    assert len(nodes) == 5000
+    assert nodes[-1][:8] == ('5000', 5000, 5000, '0', 0, 'edu', 'edu number 5000', 'elaboration_r')
+    assert [row[:8] for row in db.get_rst_doc('plain.txt', PROJECT, '_orig')] == [row[:8] for row in nodes]
+    assert db.get_rel_type('joint_m', 'plain.txt', PROJECT) == 'multinuc'
+    assert stats['rows'] >= 10000 and stats['rows_per_sec'] > 0
+    assert stats['seconds'] < 5
+
+
+def test_concurrent_saves_and_reads(db, flat_rs3):
+    """Many annotators can save and open documents at the same time without lock errors."""
+    from modules.rstweb_session import DocumentSession
+    db.import_document(flat_rs3(20), PROJECT, 'local')
+    assert db.generic_query('PRAGMA journal_mode', ()) == [('wal',)]
+    errors = []
+    start = threading.Event()
+
+    def annotate(user):
+        try:
+            start.wait()
+            db.copy_doc_to_user(DOC, PROJECT, user)
+            for edu in range(1, 11):
+                with db.transaction():
+                    db.update_log(DOC, PROJECT, user, 'sp:' + str(edu), 'structure', '')
+                    session = DocumentSession(DOC, PROJECT, user)
+                    session.insert_parent(str(edu), 'span', 'span')
+                    session.flush()
+                assert len(db.get_rst_doc(DOC, PROJECT, 'local')) == 20
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+        finally:
+            db.close_connection()
+
+    threads = [threading.Thread(target=annotate, args=('user' + str(i),)) for i in range(30)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for i in range(30):
+        assert len(db.get_rst_doc(DOC, PROJECT, 'user' + str(i))) == 30
+
+
+def test_export_is_streamed_in_chunks(db, flat_rs3, monkeypatch):
+    """The exporter yields bounded chunks which add up to the complete rs3 document."""
+    db.import_document(flat_rs3(50), PROJECT, 'local')
+    db.update_signals(['1,dm,dm,1-2', '50,lexical,lexical,99'], DOC, PROJECT, 'local')
+    db.update_seg_contents('2', 'AT&T & co <b>', DOC, PROJECT, 'local')
+    export = db.get_export_string(DOC, PROJECT, 'local')
+    assert export.startswith('<rst>\n\t<header>\n\t\t<relations>\n\t\t\t<rel name="cause" type="rst"/>\n')
+    assert '\t\t<segment id="2" >AT&amp;T &amp; co &lt;b&gt;</segment>\n' in export
+    assert export.endswith('\t\t\t<signal source="50" type="lexical" subtype="lexical" tokens="99"/>\n'
+                           '\t\t</signals>\n\t</body>\n</rst>')
+
+    monkeypatch.setattr(db, 'EXPORT_CHUNK_SIZE', 100)
+    chunks = list(db.iter_export(DOC, PROJECT, 'local', encoding='utf-8'))
+    assert len(chunks) > 10
+    assert all(len(chunk) < 200 for chunk in chunks)
+    assert b''.join(chunks) == export.encode('utf-8')
+
+
+@needs_trace
+def test_export_document_writes_each_version_once(db, flat_rs3, tmpdir):
+    """Annotator versions come from the docs table and are all rendered from one read of the document."""
+    db.import_document(flat_rs3(30), PROJECT, 'local')
+    db.copy_doc_to_user(DOC, PROJECT, 'annotator')
+    db.update_signals(['2,dm,dm,3', '1,dm,dm,1'], DOC, PROJECT, 'annotator')
+    assert db.get_users(DOC, PROJECT) == [('annotator',), ('local',)]
+
+    statements = []
+    db.get_connection().set_trace_callback(statements.append)
+    versions = dict(db.iter_export_versions(DOC, PROJECT))
+    assert len([sql for sql in statements if 'FROM rst_nodes' in sql]) == 1
+    db.get_connection().set_trace_callback(None)
+    for user in ('local', 'annotator'):
+        assert versions[user] == db.get_export_string(DOC, PROJECT, user)
+    assert versions['annotator'].index('source="1"') < versions['annotator'].index('source="2"')
+
+    exportdir = str(tmpdir.mkdir('export')) + '/'
+    db.export_document(DOC, PROJECT, exportdir)
+    assert sorted(tmpdir.join('export').listdir()) == [
+        tmpdir.join('export', 'project_flat.rs3_' + user + '.rs3') for user in ('annotator', 'local')]
+    assert tmpdir.join('export', 'project_flat.rs3_local.rs3').read() == versions['local']
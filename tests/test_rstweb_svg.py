@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the server-side SVG images of RST trees in modules/rstweb_svg.py.
+"""
+
+import io
+import os
+import xml.etree.ElementTree as ET
+
+import pytest  # pylint: disable=import-error
+
+from modules import rstweb_svg
+from modules.rstweb_tree import parse_nodes
+
+TESTDIR = os.path.dirname(__file__)
+SVG = '{http://www.w3.org/2000/svg}'
+
+
+def test_tree_svg_draws_nodes_and_relations(db):
+    db.import_document(os.path.join(TESTDIR, 'test1.rs3'), 'project', 'local')
+    svg = ET.fromstring(rstweb_svg.get_tree_svg('test1.rs3', 'project', 'local'))
+    labels = [text.text for text in svg.iter(SVG + 'text')]
+    assert labels[:2] == ['1', 'Although they']
+    assert 'concession' in labels and '1-2' in labels and 'accepted the' not in labels
+    assert len(svg.findall('.//' + SVG + 'line')) == 1  # The span above EDU 2
+    arcs = [path for path in svg.iter(SVG + 'path') if ' C' in path.get('d')]
+    assert len(arcs) == 1  # The concession from EDU 1 to EDU 2
+    assert svg.get('width') == '220'
+
+    big = ET.fromstring(rstweb_svg.get_tree_svg('test1.rs3', 'project', 'local', scale=2))
+    assert big.get('width') == '440' and big.get('viewBox') == svg.get('viewBox')
+
+
+def test_tree_png_requires_cairosvg(db, monkeypatch):
+    monkeypatch.setattr(rstweb_svg, 'cairosvg', None)
+    assert not rstweb_svg.can_render_png()
+    with pytest.raises(RuntimeError):
+        rstweb_svg.get_tree_png('test1.rs3', 'project', 'local')
+
+
+def test_parsed_documents_are_drawn_like_stored_ones(db):
+    """Images can be drawn straight from an .rs3 file, and EDU texts are escaped once."""
+    path = os.path.join(TESTDIR, 'test1.rs3')
+    db.import_document(path, 'project', 'local')
+    with io.open(path, encoding='utf-8') as rs3:
+        text = rs3.read()
+    nodes, rel_types = parse_nodes(text)
+    assert rstweb_svg.draw_tree_svg(nodes, rel_types) == rstweb_svg.get_tree_svg('test1.rs3', 'project', 'local')
+
+    nodes, rel_types = parse_nodes(text.replace("didn't like it", 'R&amp;D &lt;b&gt;'))
+    svg = rstweb_svg.draw_tree_svg(nodes, rel_types)
+    assert 'R&amp;D &lt;b&gt;' in svg
+    assert 'R&D <b>,' in [label.text for label in ET.fromstring(svg).iter(SVG + 'text')]
+    assert parse_nodes('<rst>') == 'Invalid .rs3 file'
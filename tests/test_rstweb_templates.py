@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the control page templates in modules/rstweb_templates.py.
+"""
+
+import os
+import re
+
+from modules.rstweb_templates import get_help_section, get_template, render_template
+
+HELP = os.path.join(os.path.dirname(__file__), '..', 'templates', 'control', 'help.html')
+
+
+def test_render_fills_placeholders_in_one_pass(tmpdir):
+    """Known placeholders are replaced, unknown ones are kept, and values are inserted verbatim."""
+    path = tmpdir.join('bar.html')
+    path.write('<b>**doc**</b> **project**/**doc** **unknown**')
+    assert render_template(str(path), doc='**project**', project=u'ü') == u'<b>**project**</b> ü/**project** **unknown**'
+
+
+def test_templates_are_reloaded_when_modified(tmpdir):
+    path = tmpdir.join('about.html')
+    path.write('version **version**')
+    template = get_template(str(path))
+    assert get_template(str(path)) is template
+    path.write('rstWeb **version**')
+    os.utime(str(path), (template.mtime + 10, template.mtime + 10))
+    assert render_template(str(path), version='1') == 'rstWeb 1'
+
+
+def test_help_sections_match_the_help_file():
+    with open(HELP, 'rb') as f:
+        text = f.read().decode('utf-8')
+    for section in ['help_seg', 'help_edit', 'help_open', 'help_admin']:
+        expected = re.search(r'(<div id="' + section + '".*?</div>)', text, re.MULTILINE | re.DOTALL).group(1)
+        assert get_help_section(HELP, section) == expected
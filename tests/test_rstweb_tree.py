@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the tree sent to script/structure.js, and its windows for long documents, in modules/rstweb_tree.py.
+"""
+
+import json
+
+import pytest  # pylint: disable=import-error
+
+from modules import rstweb_sql
+from modules.rstweb_tree import get_rel_kinds, get_tree_nodes, get_window_nodes, load_nodes
+
+DOC = 'flat.rs3'
+PROJECT = 'project'
+
+
+def load_tree(db, flat_rs3, edu_count):
+    """Imports a flat document, adds a span above EDU 2 with EDU 3 as a satellite and attaches EDU 1 to EDU 6."""
+    db.import_document(flat_rs3(edu_count), PROJECT, 'local')
+    db.insert_parent('2', 'span', 'span', DOC, PROJECT, 'local')
+    span = str(edu_count + 1)
+    db.update_parent('3', span, DOC, PROJECT, 'local')
+    db.update_parent('1', '6', DOC, PROJECT, 'local')
+    catalog = rstweb_sql.get_relation_catalog(DOC, PROJECT)
+    return load_nodes(DOC, PROJECT, 'local', get_rel_kinds(catalog)), catalog, span
+
+
+def test_tree_nodes_count_tokens_before_edus(db, flat_rs3):
+    nodes, catalog, span = load_tree(db, flat_rs3, 8)
+    tree_nodes = dict((tree_node[0], tree_node) for tree_node in get_tree_nodes(nodes, catalog))
+    assert [tree_nodes[str(i)][10] for i in range(1, 9)] == [0, 2, 4, 6, 8, 10, 12, 14]
+    assert tree_nodes['4'][9] == 'token4a token4b'
+    assert tree_nodes[span][2:5] == ['span', 2, 2] and tree_nodes[span][9] == ''
+    assert tree_nodes['1'][1] == '6' and tree_nodes['1'][7] == 'elaboration_r'
+
+    texts = dict((tree_node[0], tree_node[9]) for tree_node in get_tree_nodes(nodes, catalog, (3, 5)))
+    assert [i for i in range(1, 9) if texts[str(i)]] == [3, 4, 5]
+
+
+def test_window_nodes_cover_the_requested_edus(db, flat_rs3):
+    """Windows hold the EDUs in their range and every group covering any of them, whatever its parent."""
+    nodes, catalog, span = load_tree(db, flat_rs3, 8)
+    window = get_window_nodes(nodes, catalog, 2, 6)
+    assert sorted(int(tree_node[0]) for tree_node in window) == [2, 3, 4, 5, 6, int(span)]
+    assert sorted(int(tree_node[0]) for tree_node in get_window_nodes(nodes, catalog, 3, 6)) == [3, 4, 5, 6]
+    assert all(tree_node[9] for tree_node in window if tree_node[2] == 'edu')
+    assert [tree_node[0] for tree_node in get_window_nodes(nodes, catalog, 1, 1)] == ['1']
+
+
+def test_long_documents_are_rendered_in_windows(db, flat_rs3, monkeypatch):
+    """The structure editor sends all nodes of long documents, but only the texts of the first window."""
+    import structure
+    from modules import configobj
+    load_tree(db, flat_rs3, 30)
+    get = configobj.ConfigObj.get
+    monkeypatch.setattr(configobj.ConfigObj, 'get',
+                        lambda self, key, default=None: '10' if key == 'structure_window' else get(self, key, default))
+    page = structure.structure_main('local', '3', 'local', current_doc=DOC, current_project=PROJECT)
+    payload = page.split('window.rstWebTree = ', 1)[1].split(';render_tree(window.rstWebTree);', 1)[0]
+    tree = json.loads(payload)
+    assert (tree['window_size'], tree['edu_count'], len(tree['nodes'])) == (10, 30, 31)
+    assert sorted(int(node[0]) for node in tree['nodes'] if node[9]) == list(range(1, 11))
+
+    window = json.loads(structure.structure_tree_main('local', '3', 'local', current_doc=DOC,
+                                                      current_project=PROJECT, edus='20-25'))
+    assert sorted(int(node[0]) for node in window['nodes']) == list(range(20, 26))
+
+    page = structure.structure_main('local', '3', 'local', current_doc=DOC, current_project=PROJECT, full_tree='1')
+    payload = page.split('window.rstWebTree = ', 1)[1].split(';render_tree(window.rstWebTree);', 1)[0]
+    tree = json.loads(payload)
+    assert tree['window_size'] == 0  # Pages for screenshots show the whole tree
+    assert len([node for node in tree['nodes'] if node[9]]) == 30
+
+    for edus in ['abc', '5', '0-3', '5-3', '1-2-3', '-1-3']:
+        with pytest.raises(ValueError):
+            structure.structure_tree_main('local', '3', 'local', current_doc=DOC, current_project=PROJECT, edus=edus)